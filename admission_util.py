@@ -0,0 +1,244 @@
+"""Admission control in front of generation: bounded turns in flight and token buckets per tenant and plan"""
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from firebase_admin import firestore
+
+from cache_util import LRUCache
+
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 16))
+# turns waiting for a slot, beyond them a turn is rejected at once
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 32))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 2))
+# turns per second and burst size of the buckets, a rate of 0 turns the bucket off
+TENANT_RATE = float(os.environ.get('TENANT_RATE', 10))
+TENANT_BURST = float(os.environ.get('TENANT_BURST', 50))
+PLAN_RATE = float(os.environ.get('PLAN_RATE', 5))
+PLAN_BURST = float(os.environ.get('PLAN_BURST', 25))
+BUCKET_CACHE_SIZE = 100000
+
+
+class AdmissionRejectedError(Exception):
+    """Exception raised when a turn is over its rate limit or every slot and queue place is taken.
+
+    Attributes:
+        reason -- 'tenant', 'plan' or 'queue'
+        retry_after -- seconds the client should wait before retrying
+    """
+
+    def __init__(self, message, reason, retry_after):
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        super().__init__(message)
+
+
+def refill(tokens, updated, now, rate, burst):
+    """@return: the tokens of a bucket last updated at {updated}, at {now}"""
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+def take_tokens(buckets, now, limits):
+    """Take a token of every bucket of {buckets}, or of none when one of them is empty.
+    A bucket is a (tokens, updated) tuple, or None for a full bucket.
+    @param limits: the (rate, burst) of each bucket
+    @return: (buckets, waits), the waits are all 0 when the tokens were taken, \
+    else the seconds until each bucket has a token, 0 for the ones having one
+    """
+    tokens = [burst if bucket is None else refill(bucket[0], bucket[1], now, rate, burst)
+              for bucket, (rate, burst) in zip(buckets, limits)]
+    waits = [0 if t >= 1 else (1 - t) / rate for t, (rate, _) in zip(tokens, limits)]
+    taken = 0 if any(waits) else 1
+    return [(t - taken, now) for t in tokens], waits
+
+
+def give_tokens(buckets, now, limits):
+    """Give a token back to every bucket of {buckets}, up to its burst
+    @return: the buckets, None for the ones never taken from
+    """
+    return [None if bucket is None else (min(burst, refill(bucket[0], bucket[1], now, rate, burst) + 1), now)
+            for bucket, (rate, burst) in zip(buckets, limits)]
+
+
+def take_token(bucket, now, rate, burst):
+    """Take a token of {bucket}
+    @return: (bucket, wait), wait is 0 when a token was taken, else the seconds until there is one
+    """
+    buckets, waits = take_tokens([bucket], now, [(rate, burst)])
+    return buckets[0], waits[0]
+
+
+class LocalBucketBackend(object):
+    """Token buckets held in this process, the default backend of AdmissionController."""
+
+    def __init__(self, maxsize=BUCKET_CACHE_SIZE):
+        # an evicted bucket starts full again
+        self._buckets = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def take(self, limits):
+        """Take a token of each bucket of {limits}, (key, rate, burst) tuples, or of none
+        @return: the wait of each bucket, see take_tokens
+        """
+        with self._lock:
+            buckets, waits = take_tokens([self._buckets.get(key) for key, _, _ in limits], time.monotonic(),
+                                         [(rate, burst) for _, rate, burst in limits])
+            for (key, _, _), bucket in zip(limits, buckets):
+                self._buckets.put(key, bucket)
+            return waits
+
+    def give(self, limits):
+        """Give a token back to each bucket of {limits}, (key, rate, burst) tuples"""
+        with self._lock:
+            buckets = give_tokens([self._buckets.get(key) for key, _, _ in limits], time.monotonic(),
+                                  [(rate, burst) for _, rate, burst in limits])
+            for (key, _, _), bucket in zip(limits, buckets):
+                if bucket is not None:
+                    self._buckets.put(key, bucket)
+
+
+class FirestoreBucketBackend(object):
+    """Token buckets stored as documents of {collection}, shared by every process of the app."""
+
+    def __init__(self, db_connection, collection='rate_limits'):
+        self.db_connection = db_connection
+        self.collection = collection
+
+    def take(self, limits):
+        refs = [self.db_connection.cli.collection(self.collection).document(key) for key, _, _ in limits]
+
+        @firestore.transactional
+        def take(transaction):
+            # a transaction reads every document before it writes any
+            stored = [ref.get(transaction=transaction).to_dict() for ref in refs]
+            buckets, waits = take_tokens([(s["tokens"], s["updated"]) if s else None for s in stored], time.time(),
+                                         [(rate, burst) for _, rate, burst in limits])
+            for ref, bucket in zip(refs, buckets):
+                transaction.set(ref, {"tokens": bucket[0], "updated": bucket[1]})
+            return waits
+
+        return take(self.db_connection.cli.transaction())
+
+    def give(self, limits):
+        refs = [self.db_connection.cli.collection(self.collection).document(key) for key, _, _ in limits]
+
+        @firestore.transactional
+        def give(transaction):
+            stored = [ref.get(transaction=transaction).to_dict() for ref in refs]
+            buckets = give_tokens([(s["tokens"], s["updated"]) if s else None for s in stored], time.time(),
+                                  [(rate, burst) for _, rate, burst in limits])
+            for ref, bucket in zip(refs, buckets):
+                if bucket is not None:
+                    transaction.set(ref, {"tokens": bucket[0], "updated": bucket[1]})
+
+        give(self.db_connection.cli.transaction())
+
+
+class AdmissionController(object):
+    """Admits a turn when its tenant and plan have a token left and one of {max_in_flight} slots is free.
+
+    A turn finding every slot taken waits up to {queue_timeout} seconds, behind at most
+    {max_queue} others. Rejected turns carry the seconds after which a retry may be admitted.
+    """
+
+    def __init__(self, backend=None, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_queue=ADMISSION_MAX_QUEUE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT, retry_after=ADMISSION_RETRY_AFTER,
+                 tenant_rate=TENANT_RATE, tenant_burst=TENANT_BURST, plan_rate=PLAN_RATE, plan_burst=PLAN_BURST):
+        self.backend = backend or LocalBucketBackend()
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.limits = {'tenant': (tenant_rate, tenant_burst), 'plan': (plan_rate, plan_burst)}
+        self.reset()
+
+    def reset(self):
+        """Forget the turns in flight, e.g. in a forked worker, the lock may have been held at the fork"""
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._stats = {"admitted": 0, "rejected_tenant": 0, "rejected_plan": 0, "rejected_queue": 0}
+
+    def _reject(self, message, reason, retry_after):
+        # the condition lock is reentrant, enter rejects while holding it
+        with self._condition:
+            self._stats["rejected_" + reason] += 1
+        raise AdmissionRejectedError(message, reason, retry_after)
+
+    def _checked(self, tenant, plan_id):
+        """@return: the (reason, key) of the buckets of a turn that are limited"""
+        return [(reason, key) for reason, key in (('tenant', tenant), ('plan', plan_id))
+                if key is not None and self.limits[reason][0] > 0]
+
+    def _bucket_limits(self, checked):
+        return [("{}-{}".format(reason, key),) + tuple(self.limits[reason]) for reason, key in checked]
+
+    def check_rate(self, tenant=None, plan_id=None):
+        """Take a token of the tenant and of the plan, of neither when one of them has none left
+        @raise AdmissionRejectedError: a bucket is empty
+        """
+        checked = self._checked(tenant, plan_id)
+        if not checked:
+            return
+        waits = self.backend.take(self._bucket_limits(checked))
+        for (reason, key), wait in zip(checked, waits):
+            if wait:
+                self._reject("the {} {} is over its rate limit".format(reason, key), reason, wait)
+
+    def refund(self, tenant=None, plan_id=None):
+        """Give back the tokens check_rate took for a turn that was not generated"""
+        checked = self._checked(tenant, plan_id)
+        if checked:
+            self.backend.give(self._bucket_limits(checked))
+
+    def enter(self, wait=True):
+        """Take a slot, waiting for one when {wait} and the queue has room
+        @raise AdmissionRejectedError: no slot was free in time
+        """
+        with self._condition:
+            if self._in_flight >= self.max_in_flight:
+                if not wait or self._waiting >= self.max_queue:
+                    self._reject("too many responses are being generated", 'queue', self.retry_after)
+                self._waiting += 1
+                try:
+                    if not self._condition.wait_for(lambda: self._in_flight < self.max_in_flight,
+                                                    self.queue_timeout):
+                        self._reject("no response slot was free in time", 'queue', self.retry_after)
+                finally:
+                    self._waiting -= 1
+            self._in_flight += 1
+            self._stats["admitted"] += 1
+
+    def enter_turn(self, tenant=None, plan_id=None, wait=True):
+        """Take a slot for a turn check_rate admitted, giving back its tokens when no slot is free
+        @raise AdmissionRejectedError: no slot was free in time
+        """
+        try:
+            self.enter(wait)
+        except AdmissionRejectedError:
+            self.refund(tenant, plan_id)
+            raise
+
+    def leave(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def admit(self, tenant=None, plan_id=None, wait=True):
+        """Admit a turn for the duration of the block, e.g. `with admission.admit(tenant, plan_id):`"""
+        self.check_rate(tenant, plan_id)
+        self.enter_turn(tenant, plan_id, wait)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update(in_flight=self._in_flight, waiting=self._waiting)
+        return stats
@@ -1,14 +1,61 @@
+import asyncio
+import hashlib
+import json
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
 from langchain import PromptTemplate
 from langchain.llms import OpenAI
 from langchain.chat_models import ChatOpenAI
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import (
     HumanMessage,
     SystemMessage,
 )
 
-from ai.utilities import parsing_response
+from ai.utilities import parse_structured_output, count_tokens, StreamingResponseParser
+from ai.clients import get_llm
+from ai.hedging import Hedger, HEDGE_ENABLED
+from ai.resilience import (Deadline, DeadlineExceededError, CircuitOpenError, call_with_timeout, get_breaker,
+                           LLM_DEADLINE_SECONDS, LLM_FALLBACK_MODEL)
+from cache_util import LRUCache
+import metrics_util
+from metrics_util import stage, LLM_TOKENS, LLM_RETRIES, LLM_FALLBACKS
 
 MAX_TRYOUT = 3
+AGENT_CACHE_SIZE = 512
+PLAN_CACHE_SIZE = 256
+# prompt tokens the dialogue history may take before older turns are summarized, overridable per plan
+DEFAULT_CONTEXT_BUDGET = 2000
+DEFAULT_VERBATIM_TURNS = 8
+OPENING_POOL_SIZE = 5
+OPENING_TEMPERATURE = 0.9
+# plan fields written back by the ai itself, they do not change the plan version
+PLAN_DERIVED_FIELDS = ("openings",)
+
+COVERAGE_TEMPLATE = """Please conduct the interview with the following suggested questions with the most ideal and smooth order as the plan:
+        {questions}
+        """
+
+HISTORY_TEMPLATE = """Given the current dialogue history(this part would be empty, if the dialogue has not started yet):
+        {history}
+        """
+
+SUMMARY_TEMPLATE = """Progressively summarize the interview dialogue below, adding onto the previous summary.
+Keep every fact the interviewee shared and which questions have been covered, in less than 200 words.
+
+Previous summary:
+{summary}
+
+New lines of dialogue:
+{lines}
+
+New summary:"""
+
+# live interview agents keyed by (session id, plan id)
+AGENT_CACHE = LRUCache(maxsize=AGENT_CACHE_SIZE)
+# compiled prompt prefixes keyed by (plan id, plan version, agent name)
+COMPILED_PLAN_CACHE = LRUCache(maxsize=PLAN_CACHE_SIZE)
 
 
 class DialogueAgent:
@@ -67,19 +114,118 @@ class HumanAgent(DialogueAgent):
         return human_response, signal_quit
 
 
+class ParseStats(object):
+    """Counts how LLM outputs were parsed, per plan."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, plan_id, parsed: bool, repaired: bool, attempt: int) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(plan_id, {"outputs": 0, "repairs": 0, "parse_failures": 0, "retries": 0})
+            stats["outputs"] += 1
+            stats["repairs"] += int(parsed and repaired)
+            stats["parse_failures"] += int(not parsed)
+            stats["retries"] += int(attempt > 0)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {str(plan_id): dict(stats) for plan_id, stats in self._stats.items()}
+
+
+PARSE_STATS = ParseStats()
+# hedges the slow completions of every agent of the process, see ai/hedging.py
+HEDGER = Hedger()
+
+
+class CompiledPlan(object):
+    """The pre-rendered, history independent prefix of an interview prompt."""
+
+    def __init__(self, prefix: str, token_count: int) -> None:
+        self.prefix = prefix
+        self.token_count = token_count
+
+
+def get_plan_version(plan: dict):
+    """Return the explicit plan version, or a digest of its content."""
+    version = plan.get("version")
+    if version is not None:
+        return version
+    content = {key: value for key, value in plan.items() if key not in PLAN_DERIVED_FIELDS}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class StreamingCallback(BaseCallbackHandler):
+    """Forwards the response text of streamed tokens to {on_token}."""
+
+    def __init__(self, parser: StreamingResponseParser, on_token) -> None:
+        self.parser = parser
+        self.on_token = on_token
+        self.closed = False
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        text = self.parser.feed(token)
+        if text and not self.closed:
+            self.on_token(text)
+
+    def close(self) -> None:
+        """Stops forwarding the tokens of an abandoned attempt"""
+        self.closed = True
+
+
+def get_request_options(timeout) -> dict:
+    """
+    Returns the client options bounding a request by {timeout} seconds,
+    so the thread of a call abandoned at the deadline is freed
+    """
+    return {"request_timeout": timeout} if timeout is not None else {}
+
+
+def check_deadline(deadline: Deadline, error: Exception) -> None:
+    """
+    Raises DeadlineExceededError in place of the {error} of a call that failed once {deadline} passed,
+    the client gives up at the request timeout of the deadline as the wait for it ends
+    """
+    if deadline is not None and deadline.expired() and not isinstance(error, DeadlineExceededError):
+        raise DeadlineExceededError("the deadline of the turn has passed") from error
+
+
+def get_model_name(model) -> str:
+    return getattr(model, "model_name", None) or type(model).__name__
+
+
+def get_message_id(utterance):
+    if utterance == "":
+        return None
+    return utterance.get("messageId")
+
+
 class InterviewAgent(DialogueAgent):
     def __init__(
             self,
             name: str,
             model: OpenAI,
             plan: dict,
+            plan_id: str = None,
     ) -> None:
         super().__init__(name, "", model)
         self.plan = plan
+        self.plan_id = plan_id
+        self.streaming_model = None
+        # used while the circuit of the model is open
+        self.fallback_model = None
+        # the plan questions covered by the session, listed after the prompt prefix when known
+        self.coverage = None
+        # held by every turn and summary of the agent, threaded or asyncio
+        self.lock = threading.Lock()
+        # orders the coroutines of the event loop waiting for the agent
+        self.async_lock = asyncio.Lock()
         self.promptTemplate = self.generate_interview_system_message()
         # self.system_message = SystemMessage(content=self.generate_interview_system_message)
 
     def generate_interview_system_message(self):
+        # static sections come first so the prompt prefix is identical on every turn of a plan
         template = """/
         Your role and persona is described deblow:
         Your name is {name}. You are an intelligent, sensitive and polite interviewer.
@@ -88,12 +234,7 @@ class InterviewAgent(DialogueAgent):
         Your current goal is conducting an interview for {purpose}.
         The background of this interview is: {background}.
         The target audience are: {target_audience}.
-        
-        Please conduct the interview with the following suggested questions with the most ideal and smooth order as the plan: 
-        {questions}
-        
-        Given the current dialogue history(this part would be empty, if the dialogue has not started yet):
-        {history}
+        The suggested questions of the interview are listed after these instructions.
         
         First please choose one of the action type from below:
         "#NEXTQUESTION": If the previous question or task has been completed, please move on to the next question.
@@ -109,62 +250,392 @@ class InterviewAgent(DialogueAgent):
         
         --------
 
-        Put the final output message, including the action_type and response, in the format
+        Put the final output message, including the action_type and response, as a single json object in the format
         
-        "action_type": ".."
-        "response": ".."
+        {{"action_type": "..", "response": ".."}}
         
         for example:
-        "action_type": "#NEXTQUESTION"
-        "response": "What are the common challenges or pain points faced by startups during the problem validation phase?"
+        {{"action_type": "#NEXTQUESTION", "response": "What are the common challenges or pain points faced by startups during the problem validation phase?"}}
         
         """
 
         prompt = PromptTemplate(
-            input_variables=["name", "purpose", "background", "target_audience", "questions", "history"],
+            input_variables=["name", "purpose", "background", "target_audience"],
             template=template,
         )
 
         return prompt
 
-    def send(self) -> str:
+    @contextmanager
+    def held(self, deadline: Deadline = None):
+        """
+        Holds the agent for a thread,
+        raises DeadlineExceededError when {lock} is not free before {deadline}
+        """
+        timeout = deadline.remaining() if deadline is not None else None
+        if not self.lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise DeadlineExceededError("the agent was busy until the deadline of the turn")
+        try:
+            yield self
+        finally:
+            self.lock.release()
+
+    @asynccontextmanager
+    async def hold(self, deadline: Deadline = None):
+        """
+        Holds the agent for a coroutine,
+        waiting for {lock} off the event loop while a thread holds it,
+        raises DeadlineExceededError when it is not free before {deadline}
+        """
+        timeout = deadline.remaining() if deadline is not None else None
+        try:
+            await asyncio.wait_for(self.async_lock.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError("the agent was busy until the deadline of the turn")
+        try:
+            if not self.lock.acquire(blocking=False):
+                timeout = deadline.remaining() if deadline is not None else None
+                acquiring = asyncio.get_running_loop().run_in_executor(
+                    None, lambda: self.lock.acquire(timeout=-1 if timeout is None else timeout))
+                try:
+                    acquired = await asyncio.shield(acquiring)
+                except asyncio.CancelledError:
+                    # the thread may still take the lock, give it back once it has
+                    acquiring.add_done_callback(lambda acquired: acquired.result() and self.lock.release())
+                    raise
+                if not acquired:
+                    raise DeadlineExceededError("the agent was busy until the deadline of the turn")
+            try:
+                yield self
+            finally:
+                self.lock.release()
+        finally:
+            self.async_lock.release()
+
+    def reset(self):
+        super().reset()
+        self.history = ""
+        self.conversation_length = 0
+        self.last_message_id = None
+        self.summary = ""
+        self.summary_upto = 0
+
+    def set_summary(self, summary: str, upto: int) -> None:
+        """
+        Uses {summary} in place of the first {upto} lines of the message history
+        """
+        if summary and self.summary_upto < upto <= len(self.message_history):
+            self.summary = summary
+            self.summary_upto = upto
+
+    def receive(self, name: str, message: str) -> None:
+        """
+        Concatenates {message} spoken by {name} into message history
+        and keeps the formatted history text up to date
+        """
+        super().receive(name, message)
+        if len(self.message_history) > 1:
+            self.history += "\n"
+        self.history += self.message_history[-1]
+
+    def sync_conversation(self, conversation: list) -> None:
+        """
+        Receives only the utterances of {conversation} that were not seen yet,
+        rebuilding the history when it does not extend the one already received
+        """
+        seen = self.conversation_length
+        if seen > len(conversation) or (seen and (
+                self.last_message_id is None or get_message_id(conversation[seen - 1]) != self.last_message_id)):
+            self.reset()
+            seen = 0
+        for utterance in conversation[seen:]:
+            if utterance != "" and utterance["message"]:
+                self.receive(utterance["speaker"], utterance["message"])
+        self.conversation_length = len(conversation)
+        self.last_message_id = get_message_id(conversation[-1]) if conversation else None
+
+    def compile_plan(self) -> CompiledPlan:
+        """
+        Renders the static prompt prefix of the plan once
+        and shares it between every agent of the same plan version
+        """
+        key = (self.plan_id, get_plan_version(self.plan), self.name)
+        compiled = COMPILED_PLAN_CACHE.get(key)
+        if compiled is None:
+            prefix = self.promptTemplate.format(name=self.name,
+                                                purpose=self.plan["purpose"],
+                                                background=self.plan["background"],
+                                                target_audience=self.plan["target_audience"])
+            compiled = CompiledPlan(prefix, count_tokens(prefix))
+            COMPILED_PLAN_CACHE.put(key, compiled)
+        return compiled
+
+    def complete_turn(self, result: dict) -> bool:
+        """
+        Records the parsed turn in the question coverage
+        and returns whether it completes the interview,
+        a completing turn or one moving on from the last question to cover
+        """
+        completing = result["action_type"] == "#COMPLETING"
+        if self.coverage is not None:
+            self.coverage.update(result["action_type"], result["response"])
+            completing = completing or (result["action_type"] == "#NEXTQUESTION" and self.coverage.complete())
+        return completing
+
+    def parse_output(self, prompt: str, output: str, attempt: int):
+        result, repaired = parse_structured_output(output)
+        PARSE_STATS.record(self.plan_id, result is not None, repaired, attempt)
+        if metrics_util.METRICS_ENABLED:
+            LLM_TOKENS.observe(count_tokens(prompt), kind="prompt")
+            LLM_TOKENS.observe(count_tokens(output), kind="completion")
+            if attempt:
+                LLM_RETRIES.inc()
+        return result
+
+    def render_history(self) -> str:
+        """
+        Renders the dialogue history within the context budget of the plan,
+        the rolling summary followed by the turns it does not cover
+        """
+        if not self.summary_upto and count_tokens(self.history) <= self.context_budget():
+            return self.history
+        lines = self.message_history[self.summary_upto:]
+        summary = "Summary of the earlier dialogue: {}\n".format(self.summary) if self.summary else ""
+        rendered = summary + "\n".join(lines)
+        if count_tokens(rendered) > self.context_budget():
+            # the summary has not caught up yet, keep the most recent turns only
+            rendered = summary + "\n".join(lines[-self.verbatim_turns():])
+        return rendered
+
+    def context_budget(self) -> int:
+        return self.plan.get("context_budget", DEFAULT_CONTEXT_BUDGET)
+
+    def verbatim_turns(self) -> int:
+        return self.plan.get("verbatim_turns", DEFAULT_VERBATIM_TURNS)
+
+    def needs_summary(self) -> bool:
+        return (len(self.message_history) - self.summary_upto > self.verbatim_turns()
+                and count_tokens("\n".join(self.message_history[self.summary_upto:])) > self.context_budget())
+
+    def update_summary(self, deadline: Deadline = None):
+        """
+        Folds the turns older than the verbatim window into the rolling summary,
+        raises DeadlineExceededError once {deadline} passed
+        @return: (summary, upto) the new summary and the number of history lines it covers
+        """
+        upto = len(self.message_history) - self.verbatim_turns()
+        prompt = SUMMARY_TEMPLATE.format(summary=self.summary or "(empty)",
+                                         lines="\n".join(self.message_history[self.summary_upto:upto]))
+        timeout = deadline.remaining() if deadline is not None else None
+        model, breaker = self.select_model()
+        try:
+            summary = call_with_timeout(lambda: model(prompt, **get_request_options(timeout)), timeout).strip()
+        except Exception as e:
+            breaker.record(False)
+            check_deadline(deadline, e)
+            raise
+        breaker.record(True)
+        self.set_summary(summary, upto)
+        return self.summary, self.summary_upto
+
+    def hedged(self) -> bool:
+        return self.plan.get("hedge", HEDGE_ENABLED)
+
+    def select_model(self):
+        """
+        Returns the model of the next attempt and the circuit breaker of its upstream,
+        the fallback model while the circuit of the plan model is open
+        """
+        breaker = get_breaker(get_model_name(self.model))
+        if breaker.allow():
+            return self.model, breaker
+        if self.fallback_model is not None:
+            fallback_breaker = get_breaker(get_model_name(self.fallback_model))
+            if fallback_breaker.allow():
+                if metrics_util.METRICS_ENABLED:
+                    LLM_FALLBACKS.inc()
+                return self.fallback_model, fallback_breaker
+        raise CircuitOpenError("the circuit of {} is open".format(get_model_name(self.model)))
+
+    def render_coverage(self) -> str:
+        """
+        Renders the questions still to ask, after the static prefix,
+        every question of the plan when the coverage of the session is unknown
+        """
+        if self.coverage is None:
+            return COVERAGE_TEMPLATE.format(questions="\n".join(self.plan["questions"]))
+        return COVERAGE_TEMPLATE.format(questions=self.coverage.render())
+
+    def build_prompt(self) -> str:
+        return (self.compile_plan().prefix + self.render_coverage()
+                + HISTORY_TEMPLATE.format(history=self.render_history()))
+
+    def send(self, on_token=None, deadline: Deadline = None) -> str:
         """
         Applies the chatmodel to the message history
-        and returns the message string
+        and returns the message string,
+        passing the response text to {on_token} while it is generated if given,
+        raises DeadlineExceededError once {deadline} passed
         """
         signal_quit = False
         response = None
 
-        questions = "\n".join(self.plan["questions"])
-        history = "\n".join(self.message_history)
-        _input = self.promptTemplate.format_prompt(name=self.name,
-                                                   purpose=self.plan["purpose"],
-                                                   background=self.plan["background"],
-                                                   target_audience=self.plan["target_audience"],
-                                                   questions=questions,
-                                                   history=history)
+        # a streamed response cannot be hedged, the client sees it while it is generated
+        hedged = not on_token and self.hedged()
+        with stage('prompt'):
+            _input = self.build_prompt()
         for i in range(MAX_TRYOUT):
-            output = self.model(_input.to_string())
-            result = parsing_response(output)
+            timeout = None
+            if deadline is not None:
+                deadline.check()
+                timeout = deadline.remaining()
+            model, breaker = self.select_model()
+            options = get_request_options(timeout)
+            parser = callback = None
+            try:
+                with stage('llm'):
+                    if on_token:
+                        parser = StreamingResponseParser()
+                        callback = StreamingCallback(parser, on_token)
+                        streaming_model = (self.streaming_model or model) if model is self.model else model
+                        output = call_with_timeout(
+                            lambda: streaming_model(_input, callbacks=[callback], **options), timeout)
+                    elif hedged:
+                        result, output = HEDGER.call(lambda: model(_input, **options),
+                                                     lambda output: self.parse_output(_input, output, i), timeout)
+                    else:
+                        output = call_with_timeout(lambda: model(_input, **options), timeout)
+            except Exception as e:
+                breaker.record(False)
+                if callback is not None:
+                    callback.close()
+                check_deadline(deadline, e)
+                raise
+            breaker.record(True)
+            if not hedged:
+                result = self.parse_output(_input, output, i)
             if result:
+                if parser is not None and not parser.received:
+                    # the model did not stream, release the whole response at once
+                    on_token(result["response"])
                 response = result["response"]
-                action_type = result["action_type"]
-                if action_type == "#COMPLETING":
-                    signal_quit = True
+                signal_quit = self.complete_turn(result)
+                break
+            if parser is not None and parser.emitted:
+                # the client has already seen part of this attempt
                 break
         return response, signal_quit
 
+    async def asend(self, deadline: Deadline = None) -> str:
+        """
+        Awaits the chatmodel on the message history
+        and returns the message string, without blocking the event loop,
+        raises DeadlineExceededError once {deadline} passed
+        """
+        signal_quit = False
+        response = None
+
+        with stage('prompt'):
+            _input = self.build_prompt()
+        for i in range(MAX_TRYOUT):
+            timeout = None
+            if deadline is not None:
+                deadline.check()
+                timeout = deadline.remaining()
+            model, breaker = self.select_model()
+            try:
+                with stage('llm'):
+                    output = await asyncio.wait_for(model.apredict(_input, **get_request_options(timeout)), timeout)
+            except asyncio.TimeoutError:
+                breaker.record(False)
+                raise DeadlineExceededError("the LLM did not return within {:.1f}s".format(timeout))
+            except Exception as e:
+                breaker.record(False)
+                check_deadline(deadline, e)
+                raise
+            breaker.record(True)
+            result = self.parse_output(_input, output, i)
+            if result:
+                response = result["response"]
+                signal_quit = self.complete_turn(result)
+                break
+        return response, signal_quit
 
-def generate_single_interview_response(name, plan, conversation):
-    interviewing_agent = InterviewAgent(name=name,
-                                        model=OpenAI(
-                                            model_name='gpt-3.5-turbo',
-                                            temperature=0.5),
-                                        plan=plan,
-                                        )
-    for utterance in conversation:
-        if utterance != "" and utterance["message"]:
-            interviewing_agent.receive(utterance["speaker"], utterance["message"])
 
-    agent_response, signal_completion = interviewing_agent.send()
+def get_fallback_model(plan):
+    """Return the faster, cheaper model of the plan used while the circuit of its model is open, if any."""
+    model_name = plan.get("fallback_model", LLM_FALLBACK_MODEL)
+    return get_llm(model_name) if model_name else None
+
+
+def get_interview_agent(name, plan, session_id=None, plan_id=None):
+    """Return the cached agent of a session, creating it on first use."""
+    if session_id is None:
+        agent = InterviewAgent(name=name, model=get_llm(), plan=plan, plan_id=plan_id)
+    else:
+        key = (session_id, plan_id)
+        agent = AGENT_CACHE.get(key)
+        if agent is None or agent.name != name:
+            agent = InterviewAgent(name=name, model=get_llm(), plan=plan, plan_id=plan_id)
+            AGENT_CACHE.put(key, agent)
+        agent.plan = plan
+    agent.fallback_model = get_fallback_model(plan)
+    return agent
+
+
+def get_turn_deadline(plan, deadline=None):
+    """@return: the deadline of a turn, in {deadline} seconds or the deadline of the plan"""
+    return Deadline(plan.get("deadline_seconds", LLM_DEADLINE_SECONDS) if deadline is None else deadline)
+
+
+def generate_single_interview_response(name, plan, conversation, session_id=None, plan_id=None, on_token=None,
+                                       summary=None, deadline=None, coverage=None):
+    """{coverage} the QuestionCoverage of the session, updated with the generated turn"""
+    deadline = get_turn_deadline(plan, deadline)
+    interviewing_agent = get_interview_agent(name, plan, session_id=session_id, plan_id=plan_id)
+    with interviewing_agent.held(deadline):
+        if on_token and interviewing_agent.streaming_model is None:
+            interviewing_agent.streaming_model = get_llm(streaming=True)
+        interviewing_agent.coverage = coverage
+        interviewing_agent.sync_conversation(conversation)
+        if summary:
+            interviewing_agent.set_summary(*summary)
+        agent_response, signal_completion = interviewing_agent.send(on_token=on_token, deadline=deadline)
     return agent_response, signal_completion
+
+
+async def agenerate_single_interview_response(name, plan, conversation, session_id=None, plan_id=None,
+                                              summary=None, deadline=None, coverage=None):
+    deadline = get_turn_deadline(plan, deadline)
+    interviewing_agent = get_interview_agent(name, plan, session_id=session_id, plan_id=plan_id)
+    async with interviewing_agent.hold(deadline):
+        interviewing_agent.coverage = coverage
+        interviewing_agent.sync_conversation(conversation)
+        if summary:
+            interviewing_agent.set_summary(*summary)
+        agent_response, signal_completion = await interviewing_agent.asend(deadline=deadline)
+    return agent_response, signal_completion
+
+
+def update_session_summary(name, plan, session_id, plan_id=None):
+    """Fold the older turns of a session into its rolling summary when its history is over budget
+    @return: (summary, upto) when the summary changed, None otherwise
+    """
+    deadline = get_turn_deadline(plan)
+    interviewing_agent = get_interview_agent(name, plan, session_id=session_id, plan_id=plan_id)
+    with interviewing_agent.held(deadline):
+        if not interviewing_agent.needs_summary():
+            return None
+        return interviewing_agent.update_summary(deadline=deadline)
+
+
+def generate_opening_messages(name, plan, plan_id=None, count=OPENING_POOL_SIZE):
+    """Generate alternative opening turns of a plan, served to sessions that have not started"""
+    interviewing_agent = InterviewAgent(name=name, model=get_llm(temperature=OPENING_TEMPERATURE), plan=plan,
+                                        plan_id=plan_id)
+    openings = []
+    for _ in range(count):
+        agent_response, signal_completion = interviewing_agent.send(deadline=get_turn_deadline(plan))
+        if agent_response and agent_response not in openings:
+            openings.append(agent_response)
+    return openings
@@ -0,0 +1,103 @@
+"""Process-wide pool of LLM clients sharing one keep-alive HTTP session"""
+import os
+import threading
+
+import aiohttp
+import openai
+import requests
+from dotenv import load_dotenv, find_dotenv
+from requests.adapters import HTTPAdapter
+from langchain.llms import OpenAI
+
+DEFAULT_MODEL_NAME = 'gpt-3.5-turbo'
+DEFAULT_TEMPERATURE = 0.5
+HTTP_POOL_SIZE = 32
+# retries of the openai client itself, the turn retries and deadline of the agents and the circuit
+# breakers only see and bound the calls they make when it does not retry behind them
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 0))
+
+_lock = threading.Lock()
+_llm_pool = {}
+_http_session = None
+_aio_session = None
+_configured = False
+
+
+def configure():
+    """Read the local .env file and the openai api key, once per process, on the first LLM client"""
+    global _configured
+    with _lock:
+        if not _configured:
+            load_dotenv(find_dotenv())
+            openai.api_key = os.environ['OPENAI_API_KEY']
+            _configured = True
+
+
+def get_http_session():
+    """Return the shared requests session used by the openai client.
+
+    The session keeps connections to the API alive between calls, so a turn
+    does not pay for a fresh TCP and TLS handshake.
+    """
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+            openai.requestssession = session
+        return _http_session
+
+
+def get_aio_session():
+    """Return the shared aiohttp session for the asyncio serving mode.
+
+    It must be called from the running event loop, and is bound to the
+    current context so the openai async calls of this request reuse it.
+    """
+    global _aio_session
+    if _aio_session is None or _aio_session.closed:
+        _aio_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE))
+    openai.aiosession.set(_aio_session)
+    return _aio_session
+
+
+async def close_aio_session():
+    global _aio_session
+    if _aio_session is not None:
+        await _aio_session.close()
+        _aio_session = None
+
+
+def get_llm(model_name=DEFAULT_MODEL_NAME, temperature=DEFAULT_TEMPERATURE, **kwargs):
+    """Return a pooled langchain client for the given model settings."""
+    configure()
+    get_http_session()
+    kwargs.setdefault('max_retries', LLM_MAX_RETRIES)
+    key = (model_name, temperature, tuple(sorted(kwargs.items())))
+    with _lock:
+        llm = _llm_pool.get(key)
+        if llm is None:
+            llm = OpenAI(model_name=model_name, temperature=temperature, **kwargs)
+            _llm_pool[key] = llm
+        return llm
+
+
+def reset_clients(close=True):
+    """Drop every pooled client and close the shared HTTP session.
+    A forked worker passes close=False, the connections it inherited belong to its parent.
+    """
+    global _http_session, _aio_session
+    with _lock:
+        _llm_pool.clear()
+        if _http_session is not None:
+            if close:
+                _http_session.close()
+            if openai.requestssession is _http_session:
+                openai.requestssession = None
+            _http_session = None
+        # the aiohttp session belongs to the event loop it was made on, it is dropped and the next
+        # get_aio_session makes a new one, close_aio_session closes it from its loop
+        _aio_session = None
@@ -0,0 +1,90 @@
+"""Which questions of a plan an interview has covered, tracked from the action type of each turn"""
+import re
+
+# share of the content words of a question a response must repeat to be matched to it
+MATCH_THRESHOLD = 0.5
+WORD = re.compile(r"[a-z0-9']+")
+STOP_WORDS = frozenset("""
+a about am an and any are as at be been but by can could did do does for from had has have how i if in into is it
+its me my of on or our so than that the their them then there these they this those to us was we were what when
+where which who whom why will with would you your yours
+""".split())
+
+
+def content_words(text):
+    return {word for word in WORD.findall(text.lower()) if word not in STOP_WORDS}
+
+
+def match_question(message, questions, candidates=None):
+    """Find the question of {questions} that {message} asks, comparing their content words
+    @return: the index of the best matching question among {candidates}, the earliest on a tie,
+             None when none is close enough
+    """
+    words = content_words(message)
+    best, best_score = None, 0
+    for i in (range(len(questions)) if candidates is None else candidates):
+        question_words = content_words(questions[i])
+        if not question_words:
+            continue
+        score = len(words & question_words) / len(question_words)
+        if score >= MATCH_THRESHOLD and score > best_score:
+            best, best_score = i, score
+    return best
+
+
+class QuestionCoverage(object):
+    """The plan questions an interview has covered, and the one it is asking.
+
+    A question is asked when a turn starts the interview or moves to the next question, and is
+    covered once a later turn moves on from it. Follow ups and repeated questions stay on it.
+    """
+
+    def __init__(self, questions, covered=(), current=None):
+        self.questions = list(questions)
+        # the plan may have changed since the indices were stored
+        self.covered = {i for i in covered if 0 <= i < len(self.questions)}
+        self.current = current if current is not None and 0 <= current < len(self.questions) else None
+
+    def remaining(self):
+        """@return: the indices of the questions neither covered nor being asked, in the plan order"""
+        return [i for i in range(len(self.questions)) if i not in self.covered and i != self.current]
+
+    def complete(self):
+        return bool(self.questions) and len(self.covered) == len(self.questions)
+
+    def update(self, action_type, message):
+        """Record the turn of the agent, which took {action_type} and said {message}"""
+        if action_type == "#COMPLETING":
+            self.covered.update(range(len(self.questions)))
+            self.current = None
+        elif action_type in ("#STARTING", "#NEXTQUESTION"):
+            if self.current is not None:
+                self.covered.add(self.current)
+            remaining = self.remaining()
+            asked = match_question(message, self.questions, remaining)
+            # a paraphrased question is assumed to follow the plan order
+            self.current = asked if asked is not None else (remaining[0] if remaining else None)
+        elif self.current is None:
+            self.current = match_question(message, self.questions, self.remaining())
+
+    def render(self):
+        """@return: the questions still to ask, for the prompt, the one being asked first"""
+        if self.complete():
+            return "Every suggested question has been covered, please complete the interview."
+        lines = ["The questions still to ask are:"]
+        if self.current is not None:
+            lines.append("{} (the current question)".format(self.questions[self.current]))
+        lines += [self.questions[i] for i in self.remaining()]
+        return "\n".join(lines)
+
+    def key(self):
+        return tuple(sorted(self.covered)), self.current
+
+    def to_dict(self):
+        """@return: the session fields storing the coverage"""
+        return {"coveredQuestions": sorted(self.covered), "currentQuestion": self.current}
+
+    @classmethod
+    def from_session(cls, plan, interview_session):
+        return cls(plan.get("questions") or [], interview_session.get("coveredQuestions") or [],
+                   interview_session.get("currentQuestion"))
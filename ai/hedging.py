@@ -0,0 +1,137 @@
+"""Hedged LLM calls: an identical second request is sent when the first is slower than most recent calls"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from ai.resilience import Deadline, DeadlineExceededError, spawn
+
+HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', '0') != '0'
+# a call still running after this percentile of the recent latencies is hedged
+HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', 95))
+# at most this share of the recent calls is hedged, each hedge is a paid completion
+HEDGE_MAX_RATE = float(os.environ.get('LLM_HEDGE_MAX_RATE', 0.1))
+HEDGE_WINDOW = 500
+HEDGE_MIN_SAMPLES = 20
+
+
+class LatencyWindow(object):
+    """The latencies of the last {size} requests"""
+
+    def __init__(self, size=HEDGE_WINDOW):
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, percentile, min_samples=HEDGE_MIN_SAMPLES):
+        """@return: the {percentile} of the window, None until it holds {min_samples} latencies"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < max(min_samples, 1):
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+class Hedger(object):
+    """Sends a second, identical request when the first has not returned after the
+    {percentile} of the recent request latencies, and keeps the first valid output.
+
+    No more than {max_rate} of the last {window} calls are hedged. A request cannot be
+    interrupted once sent, the output of the losing one is dropped when it returns.
+    """
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, max_rate=HEDGE_MAX_RATE, window=HEDGE_WINDOW,
+                 min_samples=HEDGE_MIN_SAMPLES):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.latencies = LatencyWindow(window)
+        # whether each of the recent calls was hedged
+        self._hedged = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "hedges": 0, "hedge_wins": 0, "hedge_saved_seconds": 0.0}
+
+    def delay(self):
+        """@return: the seconds after which a call is hedged, None while there are too few latencies"""
+        return self.latencies.percentile(self.percentile, self.min_samples)
+
+    def _record(self, hedge):
+        """Count a call, hedged when {hedge} and the hedge rate allows it
+        @return: whether the call is hedged"""
+        with self._lock:
+            hedge = hedge and sum(self._hedged) + 1 <= self.max_rate * (len(self._hedged) + 1)
+            self._hedged.append(hedge)
+            self._stats["calls"] += 1
+            self._stats["hedges"] += int(hedge)
+            return hedge
+
+    def _submit(self, fn):
+        def timed():
+            started = time.perf_counter()
+            output = fn()
+            self.latencies.observe(time.perf_counter() - started)
+            return output
+        return spawn(timed)
+
+    def _saved(self, won_at):
+        def record(_future):
+            with self._lock:
+                self._stats["hedge_saved_seconds"] += time.perf_counter() - won_at
+        return record
+
+    def call(self, fn, validate, timeout=None):
+        """Call {fn}, hedged when it is slow, and pass its output to {validate}
+        @return: (result, output) of the first output {validate} returned a result for,
+                 (None, output) of the last one when it returned none
+        @raise DeadlineExceededError: no valid output was returned within {timeout} seconds
+        @raise: the error of the last request when every request failed
+        """
+        deadline = Deadline(timeout)
+        primary = self._submit(fn)
+        delay = self.delay()
+        hedge = None
+        if delay is None or (timeout is not None and delay >= timeout) or wait([primary], timeout=delay).done:
+            self._record(False)
+        elif self._record(True):
+            hedge = self._submit(fn)
+
+        pending = [future for future in (primary, hedge) if future is not None]
+        result = output = error = None
+        winner = None
+        while pending and winner is None:
+            done = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED).done
+            if not done:
+                for future in pending:
+                    future.cancel()
+                raise DeadlineExceededError("the LLM did not return within {:.1f}s".format(timeout))
+            # on a tie the primary is checked first
+            for future in [future for future in pending if future in done]:
+                pending.remove(future)
+                try:
+                    output = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                result = validate(output)
+                if result:
+                    winner = future
+                    break
+        if winner is hedge and hedge is not None:
+            with self._lock:
+                self._stats["hedge_wins"] += 1
+            # the primary request keeps running, the time saved is known once it returns
+            primary.add_done_callback(self._saved(time.perf_counter()))
+        if output is None and error is not None:
+            raise error
+        return result, output
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hedge_rate"] = stats["hedges"] / stats["calls"] if stats["calls"] else 0
+        stats["hedge_delay_seconds"] = self.delay() or 0
+        return stats
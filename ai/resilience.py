@@ -0,0 +1,203 @@
+"""Deadlines and circuit breakers, so a slow or failing LLM upstream does not hold the workers"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait
+
+# wall-clock seconds a turn may spend on the LLM, every attempt included, overridable per plan
+LLM_DEADLINE_SECONDS = float(os.environ.get('LLM_DEADLINE_SECONDS', 45))
+# the model a turn falls back to while the circuit of its model is open, overridable per plan
+LLM_FALLBACK_MODEL = os.environ.get('LLM_FALLBACK_MODEL') or None
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 20))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 10))
+BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 30))
+# threads LLM calls run on, calls beyond them wait for one to be free
+LLM_CALL_THREADS = int(os.environ.get('LLM_CALL_THREADS', 64))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class DeadlineExceededError(TimeoutError):
+    """Exception raised when a turn runs out of time before the LLM returned."""
+
+
+class CircuitOpenError(Exception):
+    """Exception raised when the circuit of a model is open and no fallback model is configured."""
+
+
+class Deadline(object):
+
+    def __init__(self, seconds=None):
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+
+    def remaining(self):
+        """@return: the seconds left, None when there is no deadline"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceededError("the deadline of the turn has passed")
+
+
+class _DaemonThreads(object):
+    """Runs calls on at most {max_threads} daemon threads, reusing the idle ones and starting a thread
+    when none is. Calls beyond them wait for a thread, a call cancelled while waiting is skipped.
+    Unlike an executor, a call stuck on the network never blocks the exit of the process.
+    """
+
+    def __init__(self, max_threads=LLM_CALL_THREADS):
+        self.max_threads = max_threads
+        self.reset()
+
+    def reset(self):
+        """Forget the threads, e.g. in a forked process where they did not survive"""
+        self._calls = queue.SimpleQueue()
+        self._threads = 0
+        # idle threads no call was handed to yet, and calls waiting for a thread
+        self._idle = 0
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn):
+        future = Future()
+        with self._lock:
+            start = False
+            if self._idle:
+                self._idle -= 1
+            elif self._threads < self.max_threads:
+                self._threads += 1
+                start = True
+            else:
+                self._waiting += 1
+        self._calls.put((future, fn))
+        if start:
+            threading.Thread(target=self._work, args=(self._calls,), daemon=True).start()
+        return future
+
+    def _work(self, calls):
+        while True:
+            future, fn = calls.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn()
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self._lock:
+                if self._waiting:
+                    self._waiting -= 1
+                else:
+                    self._idle += 1
+
+    def stats(self):
+        with self._lock:
+            return {"threads": self._threads, "idle": self._idle, "waiting": self._waiting}
+
+
+_threads = _DaemonThreads()
+os.register_at_fork(after_in_child=_threads.reset)
+
+
+def spawn(fn):
+    """Run {fn} on a daemon thread
+    @return: a future of its result
+    """
+    return _threads.submit(fn)
+
+
+def call_with_timeout(fn, timeout=None):
+    """Call {fn}, waiting at most {timeout} seconds for it to return.
+    A call that timed out cannot be interrupted, its result is dropped when it returns,
+    {fn} should bound its own request by {timeout} so its thread is freed.
+    @raise DeadlineExceededError: {fn} did not return in time
+    """
+    if timeout is None:
+        return fn()
+    future = spawn(fn)
+    if not wait([future], timeout=timeout).done:
+        # a call still waiting for a thread never runs
+        future.cancel()
+        raise DeadlineExceededError("the LLM did not return within {:.1f}s".format(timeout))
+    return future.result()
+
+
+class CircuitBreaker(object):
+    """Opens once {failure_rate} of the last {window} calls failed, at least {min_calls} of them,
+    and calls are refused for {open_seconds}. A single call then probes the upstream,
+    closing the circuit when it succeeds and opening it again when it fails.
+    """
+
+    def __init__(self, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, failure_rate=BREAKER_FAILURE_RATE,
+                 open_seconds=BREAKER_OPEN_SECONDS):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = None
+        self.opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """@return: whether a call may go to the upstream now"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == CLOSED or (self.state == HALF_OPEN and not self._probing):
+                self._probing = self.state == HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok):
+        """Count the outcome of an allowed call, an error or a timeout is a failure"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and failures >= self.failure_rate * len(self._outcomes)):
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.opened += 1
+
+    def stats(self):
+        with self._lock:
+            return {"open": int(self.state != CLOSED), "opened": self.opened, "rejected": self.rejected}
+
+
+_lock = threading.Lock()
+BREAKERS = {}
+
+
+def get_breaker(name):
+    """Return the circuit breaker of the upstream model {name}, shared by every agent of the process."""
+    with _lock:
+        breaker = BREAKERS.get(name)
+        if breaker is None:
+            breaker = BREAKERS[name] = CircuitBreaker()
+        return breaker
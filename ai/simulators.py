@@ -1,8 +1,23 @@
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Callable
 from ai.agents import InterviewAgent, HumanAgent, DialogueAgent
+from ai.clients import get_llm
+from ai.utilities import count_tokens
 from langchain.chat_models import ChatOpenAI
 from langchain.llms import OpenAI
 
+PERSONA_TEMPLATE = """You are {name} and you are being interviewed. {persona}
+Stay in character and reply to the last message of the interviewer in one to three sentences, as {name} would.
+
+Dialogue so far:
+{history}
+{name}:"""
+
+
 class DialogueSimulator:
     def __init__(
             self,
@@ -53,6 +68,115 @@ class DialogueSimulator:
         return speaker.name, message, termination
 
 
+class PersonaAgent(DialogueAgent):
+    """A simulated interviewee, answering in character of a persona spec."""
+
+    def __init__(
+            self,
+            name: str,
+            persona: str,
+            model: OpenAI,
+    ) -> None:
+        super().__init__(name, "", model)
+        self.persona = persona
+
+    def send(self) -> str:
+        """
+        Applies the model to the persona and message history
+        and returns the message string
+        """
+        prompt = PERSONA_TEMPLATE.format(name=self.name, persona=self.persona,
+                                         history="\n".join(self.message_history))
+        return self.model(prompt).strip(), False
+
+
+class BatchSimulator:
+    """Runs one simulated interview per persona, at most {concurrency} at a time,
+    and writes every transcript as a line of {output_path}."""
+
+    def __init__(
+            self,
+            agent_name: str,
+            plan: dict,
+            interviewer_model: OpenAI,
+            interviewee_model: OpenAI,
+            concurrency: int = 8,
+            max_iters: int = 20,
+            plan_id: str = None,
+    ) -> None:
+        self.agent_name = agent_name
+        self.plan = plan
+        self.plan_id = plan_id
+        self.interviewer_model = interviewer_model
+        self.interviewee_model = interviewee_model
+        self.concurrency = concurrency
+        self.max_iters = max_iters
+        self._write_lock = threading.Lock()
+
+    def simulate(self, persona: dict) -> dict:
+        interviewer = InterviewAgent(name=self.agent_name, model=self.interviewer_model, plan=self.plan,
+                                     plan_id=self.plan_id)
+        interviewee = PersonaAgent(persona["name"], persona.get("persona", ""), self.interviewee_model)
+        simulator = DialogueSimulator(agents=[interviewer, interviewee], selection_function=select_next_speaker)
+        simulator.max_iters = self.max_iters
+        simulator.reset()
+
+        turns = []
+        started = time.perf_counter()
+        completed = False
+        error = None
+        while simulator._step < simulator.max_iters:
+            speaker = simulator.agents[simulator.select_next_speaker(simulator._step, simulator.agents)]
+            prompt_tokens = count_tokens(speaker.build_prompt()) if speaker is interviewer else None
+            turn_started = time.perf_counter()
+            try:
+                name, message, termination = simulator.step()
+            except Exception as e:
+                error = str(e)
+                break
+            turns.append({
+                "speaker": name,
+                "message": message,
+                "latency": time.perf_counter() - turn_started,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": count_tokens(message) if message else 0,
+            })
+            if not message:
+                error = "no valid response was generated"
+                break
+            if termination:
+                completed = speaker is interviewer
+                break
+        return {
+            "persona": persona["name"],
+            "plan_id": self.plan_id,
+            "completed": completed,
+            "error": error,
+            "duration": time.perf_counter() - started,
+            "turns": turns,
+        }
+
+    def run(self, personas: List[dict], output_path: str) -> List[dict]:
+        summaries = []
+        with open(output_path, "a", encoding="utf-8") as output, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._simulate_safely, persona) for persona in personas]
+            for future in as_completed(futures):
+                transcript = future.result()
+                with self._write_lock:
+                    output.write(json.dumps(transcript, default=str) + "\n")
+                    output.flush()
+                summaries.append({key: transcript[key] for key in ("persona", "completed", "error", "duration")})
+        return summaries
+
+    def _simulate_safely(self, persona: dict) -> dict:
+        try:
+            return self.simulate(persona)
+        except Exception as e:
+            return {"persona": persona.get("name"), "plan_id": self.plan_id, "completed": False, "error": str(e),
+                    "duration": 0, "turns": []}
+
+
 
 from ai.utilities import select_next_speaker
 import os
@@ -106,6 +230,38 @@ def main():
             break
 
 
+def batch_main():
+    parser = argparse.ArgumentParser(description="Simulate interviews of a plan against a set of personas")
+    parser.add_argument('--plan', required=True, help="json file of the interview plan")
+    parser.add_argument('--personas', required=True, help="jsonl file, one {\"name\", \"persona\"} spec per line")
+    parser.add_argument('--output', required=True, help="jsonl file the transcripts are appended to")
+    parser.add_argument('--plan-id', default=None)
+    parser.add_argument('--agent-name', default=None, help="defaults to the \"agent name\" of the plan")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--max-iters', type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.plan, encoding="utf-8") as plan_file:
+        plan = json.load(plan_file)
+    with open(args.personas, encoding="utf-8") as personas_file:
+        personas = [json.loads(line) for line in personas_file if line.strip()]
+    simulator = BatchSimulator(agent_name=args.agent_name or plan.get("agent name", "Cojo"),
+                               plan=plan,
+                               interviewer_model=get_llm(temperature=0.2),
+                               interviewee_model=get_llm(temperature=0.8),
+                               concurrency=args.concurrency,
+                               max_iters=args.max_iters,
+                               plan_id=args.plan_id)
+    summaries = simulator.run(personas, args.output)
+    completed = sum(1 for summary in summaries if summary["completed"])
+    print(f"{completed}/{len(summaries)} interviews completed, transcripts written to {args.output}")
+
+
 # Press the green button in the gutter to run the script.
+# Without arguments it runs an interactive interview, with --plan/--personas a batch simulation.
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    import sys
+    if len(sys.argv) > 1:
+        batch_main()
+    else:
+        main()
\ No newline at end of file
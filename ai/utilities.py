@@ -1,5 +1,12 @@
+import json
+import re
 from typing import List
 
+try:
+    import tiktoken
+except ImportError:  # optional, fall back to a character based estimate
+    tiktoken = None
+
 ACTION_TYPES = ["#NEXTQUESTION", "#STARTING", "#FOLLOWUPQUESTION", "#ASKAGAIN", "#COMPLETING"]
 class LLMOutSchemaMisalignmentError(Exception):
     """Exception raised when the LLM output does not fit with the predefined schema.
@@ -19,7 +26,14 @@ def select_next_speaker(step: int, agents) -> int:
     idx = (step) % len(agents)
     return idx
 
+def count_tokens(text, model_name="gpt-3.5-turbo"):
+    if tiktoken is None:
+        return len(text) // 4 + 1
+    return len(tiktoken.encoding_for_model(model_name).encode(text))
+
 def get_field_value(field_string, field_name):
+    if ":" not in field_string:
+        raise LLMOutSchemaMisalignmentError(field_string, field_name)
     extracted_filed_name = field_string[:field_string.index(":")].replace('"', '')
     if extracted_filed_name != field_name:
         raise LLMOutSchemaMisalignmentError(field_string, field_name)
@@ -27,20 +41,112 @@ def get_field_value(field_string, field_name):
         value = field_string[field_string.index(":") + 2:].replace('"', '').strip()
         return value
 
-def parsing_response(output):
-    output_fields = output.split("\n")
-    parsed_output = {
-        "action_type": None,
-        "response": None
-    }
+def normalize_action_type(value):
+    letters = re.sub(r'[^A-Z]', '', str(value).upper())
+    for action_type in ACTION_TYPES:
+        if action_type[1:] == letters:
+            return action_type
+    raise LLMOutSchemaMisalignmentError(value, "action_type")
+
+def validate_output(parsed_output, output):
+    if not isinstance(parsed_output, dict):
+        raise LLMOutSchemaMisalignmentError(output, "")
+    if parsed_output.get("action_type") not in ACTION_TYPES:
+        raise LLMOutSchemaMisalignmentError(output, "action_type")
+    if not isinstance(parsed_output.get("response"), str) or not parsed_output["response"].strip():
+        raise LLMOutSchemaMisalignmentError(output, "response")
+    return {"action_type": parsed_output["action_type"], "response": parsed_output["response"].strip()}
+
+def parse_json_output(output):
     try:
-        if len(output_fields) != 2:
-            raise LLMOutSchemaMisalignmentError(output, "")
-        parsed_output["action_type"] = get_field_value(output_fields[0], "action_type")
-        parsed_output["response"] = get_field_value(output_fields[1], "response")
-        if not parsed_output["action_type"] in ACTION_TYPES:
-            raise LLMOutSchemaMisalignmentError(output_fields[0], "action_type")
-        return parsed_output
+        parsed_output = json.loads(output)
+    except ValueError:
+        raise LLMOutSchemaMisalignmentError(output, "")
+    return validate_output(parsed_output, output)
+
+def parse_line_output(output):
+    # "action_type": ".." on the first line, "response": ".." on the following ones
+    output_fields = [line for line in output.split("\n") if line.strip()]
+    if len(output_fields) < 2:
+        raise LLMOutSchemaMisalignmentError(output, "")
+    action_type = get_field_value(output_fields[0], "action_type")
+    response = get_field_value("\n".join(output_fields[1:]), "response")
+    return validate_output({"action_type": action_type, "response": response}, output)
+
+def repair_output(output):
+    # salvage near misses: code fences, prose around a json object, loose field labels, odd action types
+    text = re.sub(r'```[a-zA-Z]*', '', output).strip()
+    start, end = text.find("{"), text.rfind("}")
+    if 0 <= start < end:
+        try:
+            parsed_output = json.loads(text[start:end + 1])
+            if isinstance(parsed_output, dict) and "action_type" in parsed_output:
+                parsed_output["action_type"] = normalize_action_type(parsed_output["action_type"])
+            return validate_output(parsed_output, output)
+        except (ValueError, LLMOutSchemaMisalignmentError):
+            pass
+    action_type = re.search(r'action[ _]?type"?\s*:\s*"?\s*(#?[A-Za-z_ ]+)', text, re.IGNORECASE)
+    response = re.search(r'"?response"?\s*:\s*(.*)', text, re.IGNORECASE | re.DOTALL)
+    if not action_type or not response:
+        raise LLMOutSchemaMisalignmentError(output, "")
+    return validate_output({"action_type": normalize_action_type(action_type.group(1)),
+                            "response": response.group(1).strip().rstrip("}").strip().strip('"')}, output)
+
+def parse_structured_output(output):
+    """Parse the LLM output into its action_type and response.
+    The json schema and the legacy line format are accepted as is,
+    anything else goes through a local repair step before it is rejected.
+    @return: (parsed_output or None, repaired)
+    """
+    for parse in (parse_json_output, parse_line_output):
+        try:
+            return parse(output), False
+        except LLMOutSchemaMisalignmentError:
+            pass
+    try:
+        return repair_output(output), True
     except LLMOutSchemaMisalignmentError:
-        return None
+        return None, False
+
+def parsing_response(output):
+    parsed_output, repaired = parse_structured_output(output)
+    return parsed_output
+
+
+class StreamingResponseParser(object):
+    """Extracts the response field from an LLM output while it is being streamed.
+
+    Text is only released once the "response" field has started, and trailing
+    quotes, braces, escapes and whitespace are held back until more content
+    follows them.
+    """
+    RESPONSE_FIELD = re.compile(r'"?response"?\s*:')
+
+    def __init__(self):
+        self.buffer = ""
+        self.received = False
+        self.emitted = False
+        self._position = None
+
+    def feed(self, token):
+        if token:
+            self.received = True
+        self.buffer += token
+        if self._position is None:
+            match = self.RESPONSE_FIELD.search(self.buffer)
+            if not match:
+                return ""
+            self._position = match.end()
+        if not self.emitted:
+            while self._position < len(self.buffer) and self.buffer[self._position] in ' \t"':
+                self._position += 1
+        pending = self.buffer[self._position:]
+        ready = len(pending.rstrip(' \t\n"}\\'))
+        self._position += ready
+        text = pending[:ready].replace('\\n', '\n').replace('\\"', '\x00').replace('"', '').replace('\x00', '"')
+        if text:
+            self.emitted = True
+        return text
 
+    def result(self):
+        return parsing_response(self.buffer)
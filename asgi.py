@@ -0,0 +1,13 @@
+"""ASGI entry point serving the interviewer ai on asyncio
+To serve it type,
+$ uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+/ask_quento awaits the LLM and Firestore instead of pinning a worker,
+every other endpoint is served by the flask app.
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+from main import app as flask_app
+from routes.ai_api_async import AsyncAIApp
+
+app = AsyncAIApp(fallback=WsgiToAsgi(flask_app))
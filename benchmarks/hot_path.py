@@ -0,0 +1,239 @@
+"""Offline micro-benchmarks of the interview hot path.
+A deterministic fake LLM stands in for OpenAI and the memory storage backend for Firestore,
+so no credentials or network are needed.
+
+To run the benchmarks type,
+$ python -m benchmarks.hot_path
+$ python -m benchmarks.hot_path --save      # record the baselines of this machine
+$ python -m benchmarks.hot_path --check     # exit 1 when a benchmark is slower than its baseline
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from typing import Any, List, Optional
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+from langchain.llms.base import LLM  # noqa: E402
+
+from ai import agents, utilities  # noqa: E402
+
+DIR_PATH = os.path.dirname(__file__)
+BASELINES_PATH = os.path.join(DIR_PATH, 'baselines.json')
+TRANSCRIPT_LENGTHS = (10, 50, 200)
+DEFAULT_TOLERANCE = 1.5
+REPEAT = 5
+
+PLAN = {
+    "agent name": "Cojo",
+    "purpose": "learning how developers keep their code reliable",
+    "background": "a benchmark of the interviewer",
+    "target_audience": "software developers",
+    "questions": ["How do you test your code?", "What makes a test worth keeping?",
+                  "How do you find the slow parts of a service?", "What would you change in your review process?"],
+}
+OUTPUT = '{"action_type": "#FOLLOWUPQUESTION", "response": "Could you tell me more about how you go about that?"}'
+REPAIRED_OUTPUT = 'Sure!\n```json\n{"action_type": "follow-up question", "response": "Could you tell me more about that?"}\n```'
+LINE_OUTPUT = '"action_type": "#NEXTQUESTION"\n"response": "What makes a test worth keeping?"'
+SUMMARY = "The interviewee tests with pytest and reviews every change."
+
+
+class FakeInterviewLLM(LLM):
+    """Answers every prompt with the same valid interviewer output, or a summary when asked for one."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-interview"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        return SUMMARY if prompt.startswith("Progressively summarize") else OUTPUT
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None,
+                     **kwargs: Any) -> str:
+        return self._call(prompt, stop)
+
+
+def make_conversation(length):
+    """A transcript of {length} utterances ending on the interviewer, as stored on a session"""
+    return [{"messageId": "m%d" % i, "isAI": (length - i) % 2 == 1,
+             "speaker": "Cojo" if (length - i) % 2 == 1 else "Bryan",
+             "message": "Utterance number %d, about tests, reviews and the odd production incident." % i}
+            for i in range(length)]
+
+
+def make_agent(plan_id="bench"):
+    return agents.InterviewAgent("Cojo", FakeInterviewLLM(), PLAN, plan_id=plan_id)
+
+
+def bench_parse(output):
+    if utilities.parsing_response(output) is None:
+        raise Exception("the benchmark output does not parse: {}".format(output))
+    return lambda: utilities.parsing_response(output)
+
+
+def bench_parse_clean(length):
+    return bench_parse(OUTPUT)
+
+
+def bench_parse_lines(length):
+    return bench_parse(LINE_OUTPUT)
+
+
+def bench_parse_repaired(length):
+    return bench_parse(REPAIRED_OUTPUT)
+
+
+def bench_build_prompt(length):
+    agent = make_agent()
+    agent.sync_conversation(make_conversation(length))
+    return agent.build_prompt
+
+
+def bench_send(length):
+    agent = make_agent()
+    agent.sync_conversation(make_conversation(length))
+    return agent.send
+
+
+def bench_generate_cold(length):
+    """A session seen for the first time, its whole history is built"""
+    conversation = make_conversation(length)
+    counter = iter(range(sys.maxsize))
+
+    def run():
+        session_id = "cold-%d-%d" % (length, next(counter))
+        agents.AGENT_CACHE.put((session_id, "bench"), make_agent())
+        agents.generate_single_interview_response("Cojo", PLAN, conversation, session_id=session_id,
+                                                  plan_id="bench")
+        agents.AGENT_CACHE.pop((session_id, "bench"))
+    return run
+
+
+def bench_generate_cached(length):
+    """A session whose agent is cached and already holds its history"""
+    conversation = make_conversation(length)
+    session_id = "cached-%d" % length
+    agents.AGENT_CACHE.put((session_id, "bench"), make_agent())
+    return lambda: agents.generate_single_interview_response("Cojo", PLAN, conversation, session_id=session_id,
+                                                             plan_id="bench")
+
+
+_client = None
+
+
+def get_test_client():
+    """The flask test client of main.app, on the storage backend set by STORAGE_BACKEND"""
+    global _client
+    if _client is None:
+        import main
+        _client = main.app.test_client()
+    return _client
+
+
+def bench_ask_quento(length):
+    """POST /ask_quento end to end, the session is restored after every request"""
+    client = get_test_client()
+    from routes import ai_api
+    # one plan takes every request, keep its buckets checked but never empty
+    ai_api.admission.limits = {'tenant': (1e9, 1e9), 'plan': (1e9, 1e9)}
+    session_id = "ask-%d" % length
+    ai_api.db_connection.insert(dict(PLAN), collection="plans", doc_id="bench")
+    ai_api.db_connection.insert({"planId": "bench", "completion": False, "conversation": make_conversation(length)},
+                                collection="interviews", doc_id=session_id)
+    agents.AGENT_CACHE.put((session_id, "bench"), make_agent())
+    session = ai_api.db_connection.find_one(session_id).to_dict()
+    body = {"session_id": session_id, "plan_id": "bench"}
+
+    def run():
+        response = client.post('/ask_quento', json=body)
+        if response.status_code != 201:
+            raise Exception("/ask_quento returned {}: {}".format(response.status_code, response.get_data()))
+        ai_api.db_connection.insert(session, collection="interviews", doc_id=session_id)
+    return run
+
+
+# (name, transcript lengths, setup), a setup returns the callable to time
+BENCHMARKS = [
+    ("parsing_response[json]", (None,), bench_parse_clean),
+    ("parsing_response[lines]", (None,), bench_parse_lines),
+    ("parsing_response[repaired]", (None,), bench_parse_repaired),
+    ("InterviewAgent.build_prompt", TRANSCRIPT_LENGTHS, bench_build_prompt),
+    ("InterviewAgent.send", TRANSCRIPT_LENGTHS, bench_send),
+    ("generate_single_interview_response[cold]", TRANSCRIPT_LENGTHS, bench_generate_cold),
+    ("generate_single_interview_response[cached]", TRANSCRIPT_LENGTHS, bench_generate_cached),
+    ("POST /ask_quento", TRANSCRIPT_LENGTHS, bench_ask_quento),
+]
+
+
+def run_benchmarks(names=None, lengths=None, repeat=REPEAT, number=None):
+    """Time every benchmark, filtered by name substrings and transcript lengths
+    @return: {"<name>@<length>": seconds per call}, the best of {repeat} rounds
+    """
+    results = {}
+    for name, bench_lengths, setup in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        for length in bench_lengths:
+            if lengths and length is not None and length not in lengths:
+                continue
+            key = name if length is None else "{}@{}".format(name, length)
+            timer = timeit.Timer(setup(length))
+            calls = number or timer.autorange()[0]
+            rounds = timer.repeat(repeat=repeat, number=calls)
+            results[key] = min(rounds) / calls
+    return results
+
+
+def load_baselines(path=BASELINES_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as baselines_file:
+        return json.load(baselines_file)
+
+
+def save_baselines(results, path=BASELINES_PATH):
+    baselines = load_baselines(path)
+    baselines.update({key: round(seconds, 9) for key, seconds in results.items()})
+    with open(path, 'w', encoding='utf-8') as baselines_file:
+        json.dump(dict(sorted(baselines.items())), baselines_file, indent=2)
+        baselines_file.write('\n')
+
+
+def compare(results, baselines, tolerance=DEFAULT_TOLERANCE):
+    """@return: the keys of {results} slower than {tolerance} times their baseline"""
+    return [key for key, seconds in results.items() if key in baselines and seconds > baselines[key] * tolerance]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks of the interview hot path")
+    parser.add_argument('--filter', action='append', help="only run benchmarks whose name contains this")
+    parser.add_argument('--lengths', type=int, nargs='+', help="transcript lengths, default {}".format(
+        TRANSCRIPT_LENGTHS))
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--save', action='store_true', help="store the results as the new baselines")
+    parser.add_argument('--check', action='store_true', help="exit 1 when a benchmark regressed")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="slowdown over the baseline counted as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.filter, args.lengths, args.repeat)
+    baselines = load_baselines()
+    regressions = compare(results, baselines, args.tolerance)
+    print("{:<52} {:>14} {:>14} {:>8}".format("benchmark", "us/call", "baseline", "ratio"))
+    for key, seconds in results.items():
+        baseline = baselines.get(key)
+        print("{:<52} {:>14.2f} {:>14} {:>8}{}".format(
+            key, seconds * 1e6, "%.2f" % (baseline * 1e6) if baseline else "-",
+            "%.2f" % (seconds / baseline) if baseline else "-", "  REGRESSED" if key in regressions else ""))
+    if args.save:
+        save_baselines(results)
+        print("baselines saved to {}".format(BASELINES_PATH))
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
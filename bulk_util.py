@@ -0,0 +1,103 @@
+"""Bulk writes committed as concurrent batches, retried with backoff, with a result per document"""
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions
+
+BULK_WRITE_WORKERS = int(os.environ.get('BULK_WRITE_WORKERS', 8))
+BULK_WRITE_RETRIES = int(os.environ.get('BULK_WRITE_RETRIES', 5))
+# failures worth retrying, anything else is reported at once
+TRANSIENT_ERRORS = (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded, exceptions.InternalServerError,
+                    exceptions.Aborted, exceptions.ResourceExhausted, exceptions.TooManyRequests,
+                    exceptions.Unknown, ConnectionError, TimeoutError)
+
+
+class WriteResult(object):
+
+    def __init__(self, doc_id, ok, error=None, attempts=1):
+        self.doc_id = doc_id
+        self.ok = ok
+        self.error = error
+        self.attempts = attempts
+
+    def to_dict(self):
+        return {"doc_id": self.doc_id, "ok": self.ok, "error": self.error, "attempts": self.attempts}
+
+
+class BulkWriter(object):
+    """Splits writes into batches of {batch_size} committed by {workers} threads.
+
+    {commit} is called with a list of (doc_id, data) and writes them atomically.
+    A batch failing with one of {transient_errors} is retried up to {max_retries}
+    times with exponential backoff and jitter. A batch failing otherwise is split,
+    so one bad document does not fail the others.
+    """
+
+    def __init__(self, commit, batch_size=450, workers=BULK_WRITE_WORKERS, max_retries=BULK_WRITE_RETRIES,
+                 backoff=0.5, max_backoff=30, transient_errors=TRANSIENT_ERRORS):
+        self.commit = commit
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.transient_errors = transient_errors
+
+    def _batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _commit_with_retries(self, batch):
+        """@return: the number of attempts, raise the last error when they all failed"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.commit(batch)
+                return attempt
+            except self.transient_errors:
+                if attempt > self.max_retries:
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+    def _write_batch(self, batch):
+        try:
+            attempts = self._commit_with_retries(batch)
+        except self.transient_errors as e:
+            return [WriteResult(doc_id, False, error=str(e), attempts=self.max_retries + 1) for doc_id, _ in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                return [WriteResult(batch[0][0], False, error=str(e))]
+            # find the documents at fault one by one
+            return [result for item in batch for result in self._write_batch([item])]
+        return [WriteResult(doc_id, True, attempts=attempts) for doc_id, _ in batch]
+
+    def write(self, items):
+        """Write every (doc_id, data) of {items}, holding at most two batches per worker in memory
+        @return: a WriteResult per document, in the order of {items}
+        """
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            for batch in self._batches(items):
+                pending.append(executor.submit(self._write_batch, batch))
+                if len(pending) >= 2 * self.workers:
+                    results += pending.pop(0).result()
+            for future in pending:
+                results += future.result()
+        return results
+
+
+def summarize(results):
+    """@return: the count of written and failed documents, with the failures"""
+    failures = [result.to_dict() for result in results if not result.ok]
+    return {"written": len(results) - len(failures), "failed": len(failures), "failures": failures}
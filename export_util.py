@@ -0,0 +1,173 @@
+"""Streaming export of the interviews of a plan, as JSONL or Parquet, in constant memory.
+
+To export from the command line type,
+$ python export_util.py <plan_id> --format jsonl --output interviews.jsonl
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional, only the parquet format needs it
+    pyarrow = None
+
+from firebase_db_util import Firestore_query, iter_documents
+from storage_util import get_connection
+
+EXPORT_FORMATS = ('jsonl', 'parquet')
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 200))
+# a larger page_size is capped, a page is held in memory while it is written
+EXPORT_MAX_PAGE_SIZE = int(os.environ.get('EXPORT_MAX_PAGE_SIZE', 1000))
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 1000))
+
+
+class ExportFormatError(Exception):
+    """Exception raised when an export format is unknown or its optional dependency is missing."""
+
+
+def check_format(export_format):
+    if export_format not in EXPORT_FORMATS:
+        raise ExportFormatError("export format {} is invalid, expected one of {}".format(export_format,
+                                                                                         EXPORT_FORMATS))
+    if export_format == 'parquet' and pyarrow is None:
+        raise ExportFormatError("the parquet export needs pyarrow, pip install pyarrow")
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def to_json(value):
+    return json.dumps(value, default=_json_default, ensure_ascii=False)
+
+
+def get_field(data, field):
+    """@return: the value at the dotted {field} path of {data}, None when missing"""
+    for part in field.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+def iter_interviews(db_connection, plan_id, fields=None, page_size=EXPORT_PAGE_SIZE):
+    """Iterate over the interview sessions of a plan, projected on {fields} when given"""
+    return iter_documents(db_connection, collection='interviews', query=[Firestore_query('planId', '==', plan_id)],
+                          select=fields, page_size=page_size)
+
+
+def jsonl_chunks(snapshots):
+    """Render documents as JSONL, one {"id": ..., **fields} line per document"""
+    for snapshot in snapshots:
+        row = {"id": snapshot.id}
+        row.update(snapshot.to_dict() or {})
+        yield to_json(row) + "\n"
+
+
+class _ChunkSink(object):
+    """A write-only file handing out what was written since the last drain, for a streamed parquet file"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def parquet_chunks(snapshots, fields=None, row_group_size=PARQUET_ROW_GROUP_SIZE):
+    """Render documents as a Parquet file, one row group per {row_group_size} documents.
+    There is a string column per field of {fields}, holding its JSON value, or a single "document"
+    column holding the whole document when no fields are given.
+    """
+    check_format('parquet')
+    columns = ["id"] + (list(fields) if fields else ["document"])
+    schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'), schema)
+
+    def row_group(rows):
+        writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+        return sink.drain()
+
+    rows = []
+    for snapshot in snapshots:
+        data = snapshot.to_dict() or {}
+        row = {"id": snapshot.id}
+        if fields:
+            for field in fields:
+                value = get_field(data, field)
+                row[field] = None if value is None else to_json(value)
+        else:
+            row["document"] = to_json(data)
+        rows.append(row)
+        if len(rows) == row_group_size:
+            yield row_group(rows)
+            rows = []
+    if rows:
+        yield row_group(rows)
+    writer.close()
+    yield sink.drain()
+
+
+def export_chunks(db_connection, plan_id, export_format='jsonl', fields=None, page_size=EXPORT_PAGE_SIZE):
+    """Stream the interviews of a plan in {export_format}, as str chunks for jsonl and bytes chunks for parquet"""
+    check_format(export_format)
+    snapshots = iter_interviews(db_connection, plan_id, fields=fields, page_size=page_size)
+    if export_format == 'parquet':
+        return parquet_chunks(snapshots, fields=fields)
+    return jsonl_chunks(snapshots)
+
+
+def export_interviews(db_connection, plan_id, path, export_format='jsonl', fields=None, page_size=EXPORT_PAGE_SIZE):
+    """Write the interviews of a plan to the file at {path}
+    @return: the number of bytes written
+    """
+    written = 0
+    with open(path, 'wb') as output:
+        for chunk in export_chunks(db_connection, plan_id, export_format, fields, page_size):
+            written += output.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the interviews of a plan")
+    parser.add_argument('plan_id')
+    parser.add_argument('--format', default='jsonl', choices=EXPORT_FORMATS)
+    parser.add_argument('--output', help="defaults to <plan_id>.<format>")
+    parser.add_argument('--fields', nargs='+', help="only export these fields, e.g. conversation completion")
+    parser.add_argument('--page-size', type=int, default=EXPORT_PAGE_SIZE)
+    args = parser.parse_args()
+    if args.page_size < 1:
+        parser.error("--page-size must be at least 1")
+
+    output = args.output or "{}.{}".format(args.plan_id, args.format)
+    written = export_interviews(get_connection(base_collection='interviews'), args.plan_id, output,
+                                export_format=args.format, fields=args.fields, page_size=args.page_size)
+    print("{} bytes written to {}".format(written, output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
 # Import the Firebase service
-from firebase_admin import firestore, credentials
+from firebase_admin import firestore, firestore_async, credentials
 import firebase_admin
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from bulk_util import BulkWriter, BULK_WRITE_WORKERS
+from cache_util import LRUCache
+from metrics_util import stage
 
 DIR_PATH = os.path.dirname(__file__)
 FILE_PATH = os.path.join(DIR_PATH, 'key.json')
+DEFAULT_PAGE_SIZE = 200
 
 def firebase_init():
     if not len(firebase_admin._apps):
@@ -12,6 +18,13 @@ def firebase_init():
         firebase_admin.initialize_app(cred)
 
 
+def firebase_reset():
+    """Forget the apps and the clients they cache, e.g. in a forked worker,
+    the next firebase_init creates new ones."""
+    for app in list(firebase_admin._apps.values()):
+        firebase_admin.delete_app(app)
+
+
 class Firestore_query(object):
     QUERY_OPERATORS = ['<', '<=', '==', '>', '>=', 'array-contains', 'in', 'array-contains-any']
 
@@ -52,35 +65,72 @@ class Firestore_order(object):
 
 class FirebaseConnection(object):
     MAX_BATCH_WRITE = 450
+    DEFAULT_CACHE_SIZE = 1024
 
-    def __init__(self, base_collection=None):
+    def __init__(self, base_collection=None, cache_config=None):
         firebase_init()
         self.cli = firestore.client()
+        self._async_cli = None
         self.base_collection = base_collection
+        # read-through caches of find_one, per collection path, e.g. {'plans': {'ttl': 300, 'maxsize': 1024}}
+        self.caches = {}
+        for collection, config in (cache_config or {}).items():
+            self.caches[collection] = LRUCache(maxsize=config.get('maxsize', self.DEFAULT_CACHE_SIZE),
+                                               ttl=config.get('ttl'))
+
+    def invalidate(self, doc_id, collection=None):
+        if not collection:
+            collection = self.base_collection
+        cache = self.caches.get(collection)
+        if cache is not None:
+            cache.pop(doc_id)
+
+    def _invalidate_ref(self, ref):
+        # only document references can hold a cached entry
+        path = getattr(ref, 'path', None)
+        if path and path.count('/') % 2 == 1:
+            collection, doc_id = path.rsplit('/', 1)
+            self.invalidate(doc_id, collection)
+
+    def cache_stats(self):
+        return {collection: cache.stats() for collection, cache in self.caches.items()}
+
+    @property
+    def async_cli(self):
+        # created on first use, the asyncio client binds to the running event loop
+        if self._async_cli is None:
+            self._async_cli = firestore_async.client()
+        return self._async_cli
 
 
     # Add single doc into the collection with or without the custom key
     def insert(self, data, collection=None, doc_id=None, reference=None, mode='set', merge=False):
         if not collection:
             collection = self.base_collection
-        try:
-            if doc_id:
-                if reference:
-                    ref = reference
+        with stage('insert'):
+            try:
+                if doc_id:
+                    if reference:
+                        ref = reference
+                    else:
+                        ref = self.cli.collection(collection).document(doc_id)
+                    self._invalidate_ref(ref)
+                    try:
+                        if mode == 'set':
+                            ref.set(data, merge=merge)
+                        elif mode == 'update':
+                            ref.update(data)
+                    finally:
+                        # a read racing the write may have cached the old snapshot again
+                        self._invalidate_ref(ref)
                 else:
-                    ref = self.cli.collection(collection).document(doc_id)
-                if mode == 'set':
-                    ref.set(data, merge=merge)
-                elif mode == 'update':
-                    ref.update(data)
-            else:
-                if reference:
-                    ref = reference
-                else:
-                    ref = self.cli.collection(collection)
-                ref.add(data)
-        except Exception as e:
-            print(e)
+                    if reference:
+                        ref = reference
+                    else:
+                        ref = self.cli.collection(collection)
+                    ref.add(data)
+            except Exception as e:
+                print(e)
 
     def nesting_insert(self, ref_path, data, collection=None, mode='set', merge=False):
         if not collection:
@@ -97,39 +147,140 @@ class FirebaseConnection(object):
             elif fb_type == 'document':
                 ref = ref.document(obj_id)
                 doc_id = obj_id
+            cur_type = fb_type
         self.insert(data, reference=ref, mode=mode, doc_id=doc_id, merge=merge)
 
-    def bulk_insert(self, data_list, collection=None, mode='set'):
+    # Append values to an array field without rewriting the rest of the document
+    def append(self, doc_id, field, values, collection=None, data=None):
+        update = dict(data or {})
+        update[field] = firestore.ArrayUnion(values)
+        self.insert(update, collection=collection, doc_id=doc_id, mode='update')
+
+    def remove(self, doc_id, field, values, collection=None):
+        self.insert({field: firestore.ArrayRemove(values)}, collection=collection, doc_id=doc_id, mode='update')
+
+    # Write many docs as concurrent batches, retried on transient failures
+    def bulk_insert(self, data_list, collection=None, mode='set', workers=BULK_WRITE_WORKERS):
+        """@return: a WriteResult per document of {data_list}"""
         if not collection:
             collection = self.base_collection
-        count = 0
-        batch = self.cli.batch()
-        try:
-            for doc_id, data in data_list:
-                if count > self.MAX_BATCH_WRITE:
-                    batch.commit()
-                    batch = self.cli.batch()
-                    count = 0
+
+        def commit(chunk):
+            batch = self.cli.batch()
+            for doc_id, data in chunk:
                 ref = self.cli.collection(collection).document(doc_id)
+                self.invalidate(doc_id, collection)
                 if mode == 'set':
                     batch.set(ref, data)
                 elif mode == 'update':
                     batch.update(ref, data)
-                count += 1
-            if count > 0:
-                batch.commit()
-        except Exception as e:
-            print(e)
+            try:
+                with stage('bulk_insert'):
+                    batch.commit()
+            finally:
+                for doc_id, _ in chunk:
+                    self.invalidate(doc_id, collection)
+
+        return BulkWriter(commit, batch_size=self.MAX_BATCH_WRITE, workers=workers).write(data_list)
 
     def find_one(self, doc_id, collection=None):
         if not collection:
             collection = self.base_collection
-        return self.cli.collection(collection).document(doc_id).get()
+        cache = self.caches.get(collection)
+        if cache is not None:
+            snapshot = cache.get(doc_id)
+            if snapshot is not None:
+                return snapshot
+        with stage('find_one'):
+            snapshot = self.cli.collection(collection).document(doc_id).get()
+        if cache is not None and snapshot.exists:
+            cache.put(doc_id, snapshot)
+        return snapshot
 
-    def find_many(self, collection=None, query=None, orders_by=[], start_after=None, limit=None):
+    # Fetch several documents, possibly from different collections, in one batched read
+    def find_all(self, keys):
+        snapshots, missing = self._find_all_cached(keys, self.cli)
+        with stage('find_all'):
+            if len(missing) == 1:
+                ref, collection, indices = next(iter(missing.values()))
+                fetched = [ref.get()]
+            else:
+                fetched = list(self.cli.get_all([ref for ref, _, _ in missing.values()])) if missing else []
+        return self._find_all_fill(snapshots, missing, fetched)
+
+    def _find_all_cached(self, keys, cli):
+        snapshots = [None] * len(keys)
+        missing = {}
+        for i, (doc_id, collection) in enumerate(keys):
+            if not collection:
+                collection = self.base_collection
+            cache = self.caches.get(collection)
+            snapshot = cache.get(doc_id) if cache is not None else None
+            if snapshot is not None:
+                snapshots[i] = snapshot
+            else:
+                ref = cli.collection(collection).document(doc_id)
+                missing.setdefault(ref.path, (ref, collection, []))[2].append(i)
+        return snapshots, missing
+
+    def _find_all_fill(self, snapshots, missing, fetched):
+        for snapshot in fetched:
+            ref, collection, indices = missing[snapshot.reference.path]
+            cache = self.caches.get(collection)
+            if cache is not None and snapshot.exists:
+                cache.put(snapshot.id, snapshot)
+            for i in indices:
+                snapshots[i] = snapshot
+        return snapshots
+
+    # asyncio variants of the hot path reads and writes, on the async client
+    async def afind_one(self, doc_id, collection=None):
+        return (await self.afind_all([(doc_id, collection)]))[0]
+
+    async def afind_all(self, keys):
+        snapshots, missing = self._find_all_cached(keys, self.async_cli)
+        with stage('find_all'):
+            if len(missing) == 1:
+                ref, collection, indices = next(iter(missing.values()))
+                fetched = [await ref.get()]
+            else:
+                fetched = [snapshot async for snapshot in
+                           self.async_cli.get_all([ref for ref, _, _ in missing.values()])] if missing else []
+        return self._find_all_fill(snapshots, missing, fetched)
+
+    async def ainsert(self, data, collection=None, doc_id=None, mode='set', merge=False):
+        if not collection:
+            collection = self.base_collection
+        with stage('insert'):
+            try:
+                if doc_id:
+                    ref = self.async_cli.collection(collection).document(doc_id)
+                    self._invalidate_ref(ref)
+                    try:
+                        if mode == 'set':
+                            await ref.set(data, merge=merge)
+                        elif mode == 'update':
+                            await ref.update(data)
+                    finally:
+                        # a read racing the write may have cached the old snapshot again
+                        self._invalidate_ref(ref)
+                else:
+                    await self.async_cli.collection(collection).add(data)
+            except Exception as e:
+                print(e)
+
+    async def aappend(self, doc_id, field, values, collection=None, data=None):
+        update = dict(data or {})
+        update[field] = firestore.ArrayUnion(values)
+        await self.ainsert(update, collection=collection, doc_id=doc_id, mode='update')
+
+    # {select} projects the documents on these field paths, an empty list keeps only the ids
+    def find_many(self, collection=None, query=None, orders_by=[], start_after=None, limit=None, select=None):
         if not collection:
             collection = self.base_collection
         ref = self.cli.collection(collection)
+        if select is not None:
+            ref = ref.select(select)
         if query:
             for q in query:
                 ref = q.join_query(ref)
@@ -144,6 +295,44 @@ class FirebaseConnection(object):
         return results
 
 
+def iter_documents(db_connection, collection=None, query=None, orders_by=[], select=None,
+                   page_size=DEFAULT_PAGE_SIZE, prefetch=True):
+    """Iterate over the documents of a query one page at a time, with a cursor on the last document read.
+    While a page is consumed the next one is fetched in the background, so at most two pages are held in memory.
+    """
+    if select is not None:
+        # the cursor is built from the order fields of the last document
+        select = list(select) + [order_by.field for order_by in orders_by
+                                 if order_by.field and order_by.field not in select]
+
+    def fetch(cursor):
+        return list(db_connection.find_many(collection=collection, query=query, orders_by=orders_by,
+                                            start_after=cursor, limit=page_size, select=select))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = fetch(None)
+        while page:
+            more = len(page) == page_size
+            next_page = executor.submit(fetch, page[-1]) if more and prefetch else None
+            for snapshot in page:
+                yield snapshot
+            if not more:
+                return
+            page = next_page.result() if next_page is not None else fetch(page[-1])
+
+
+def migrate_conversations(db_connection, collection='interviews', field='conversation'):
+    """Strip the legacy empty placeholders from every conversation array,
+    so sessions can be extended with array-union appends."""
+    migrated = 0
+    for doc in iter_documents(db_connection, collection=collection, select=[field]):
+        data = doc.to_dict() or {}
+        if "" in data.get(field, []):
+            db_connection.remove(doc.id, field, [""], collection=collection)
+            migrated += 1
+    return migrated
+
+
 def db_test():
     firebase_db = FirebaseConnection(base_collection='interviews')
     # data = [('monkey', {'weight': 50, 'name': 'John'}), ('Cat', {'weight': 10, 'name': 'cathy'})]
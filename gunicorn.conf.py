@@ -0,0 +1,42 @@
+"""Production serving mode, to start it type,
+$ gunicorn -c gunicorn.conf.py main:app
+
+The app is imported once by the master and forked into the workers. Importing it
+creates no client, and post_fork drops any the master created anyway, since gRPC
+channels and keep-alive connections cannot be shared across fork(). On shutdown
+a worker stops taking requests, then waits for the generations in progress and
+its queued jobs for up to graceful_timeout seconds.
+"""
+import multiprocessing
+import os
+
+CORES = multiprocessing.cpu_count()
+# the memory and sqlite backends, single flight and admission buckets of a process are not seen by the
+# others, several workers only share them on firestore
+SHARED_STATE = os.environ.get('STORAGE_BACKEND', 'firestore') == 'firestore'
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 5000))
+preload_app = True
+# a turn mostly waits on the LLM, so each worker takes several at once on threads
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', CORES * 2 + 1 if SHARED_STATE else 1))
+if workers > 1 and SHARED_STATE:
+    # read by the routes when the master preloads the app
+    os.environ.setdefault('SINGLE_FLIGHT_BACKEND', 'firestore')
+    os.environ.setdefault('ADMISSION_BACKEND', 'firestore')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# a generation, retries included, can take a while
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 120))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    from routes import ai_api
+    ai_api.reset_after_fork()
+
+
+def worker_exit(server, worker):
+    from routes import ai_api
+    if not ai_api.drain(timeout=graceful_timeout):
+        server.log.warning("worker %s exited before its generations finished", worker.pid)
@@ -0,0 +1,175 @@
+"""Background jobs, so HTTP requests do not wait on slow generations"""
+import queue
+import threading
+import time
+
+import shortuuid
+
+from cache_util import LRUCache
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    """Exception raised when a job is submitted to a queue at its maximum depth."""
+
+
+class Job(object):
+
+    def __init__(self, fn, args, kwargs):
+        self.id = shortuuid.ShortUUID().random(length=12)
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def run(self):
+        self.status = RUNNING
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+            self.status = SUCCEEDED
+        except Exception as e:
+            print(e)
+            self.error = str(e)
+            self.status = FAILED
+        finally:
+            self.finished_at = time.time()
+            self.done.set()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class LocalJobQueue(object):
+    """An in-process job queue drained by a fixed pool of worker threads.
+
+    Workers are started on the first submit. Finished jobs are kept for
+    status lookups in a bounded cache of ``history`` entries. ``on_update`` is
+    called with a job when it is queued and when it finished, e.g. to store its
+    status where the other processes of the app can look it up.
+    """
+
+    def __init__(self, workers=4, max_depth=100, history=10000, on_update=None):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.on_update = on_update
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._jobs = LRUCache(maxsize=history)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                job.run()
+                self._notify(job)
+            finally:
+                self._queue.task_done()
+
+    def _notify(self, job):
+        if self.on_update is not None:
+            try:
+                self.on_update(job)
+            except Exception as e:
+                print(e)
+
+    def submit(self, fn, *args, **kwargs):
+        job = Job(fn, args, kwargs)
+        self._start()
+        # notified before a worker can finish it, so the queued status never lands after the final one
+        self._notify(job)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            job.status, job.error, job.finished_at = FAILED, "the job queue was full", time.time()
+            self._notify(job)
+            raise QueueFullError("job queue is full ({} jobs waiting)".format(self.max_depth))
+        self._jobs.put(job.id, job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop the workers once the queued jobs are done
+        @return: True when every worker stopped, False when {timeout} seconds passed first
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            for thread in threads:
+                thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def reset(self):
+        """Forget the queue and the workers, e.g. in a forked process where the worker threads did not survive.
+        The lock is replaced too, another thread may have held it at the fork."""
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=self.max_depth)
+        self._threads = []
+
+
+class InFlight(object):
+    """Counts the calls in progress, so a process can wait for them before it exits
+
+    Usage: ``with in_flight: ...`` around each call, ``in_flight.wait(timeout)`` to drain.
+    """
+
+    def __init__(self):
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            self._count += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._condition:
+            self._count -= 1
+            self._condition.notify_all()
+        return False
+
+    def count(self):
+        return self._count
+
+    def wait(self, timeout=None):
+        """@return: True once no call is in progress, False when {timeout} seconds passed first"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._count == 0, timeout)
+
+    def reset(self):
+        self._count = 0
+        self._condition = threading.Condition()
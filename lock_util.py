@@ -0,0 +1,231 @@
+"""Single-flight execution, so concurrent identical requests share one result"""
+import asyncio
+import threading
+import time
+
+import shortuuid
+from firebase_admin import firestore
+
+
+class SingleFlightError(Exception):
+    """Exception raised when a shared call failed or did not finish in time."""
+
+
+class LocalLockBackend(object):
+    """Leases held in this process, the default backend of SingleFlight."""
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, token, lease):
+        now = time.time()
+        with self._lock:
+            held = self._leases.get(key)
+            # a call in flight, or done with a result still kept, is shared rather than run again
+            if held and held["expires"] > now and (not held["done"] or held["result"] is not None):
+                return False
+            self._leases[key] = {"token": token, "expires": now + lease, "done": False, "result": None}
+            return True
+
+    def release(self, key, token, result=None, keep=60):
+        with self._lock:
+            held = self._leases.get(key)
+            if held and held["token"] == token:
+                held.update(done=True, result=result, expires=time.time() + keep)
+            for stale in [k for k, v in self._leases.items() if v["done"] and v["expires"] < time.time()]:
+                del self._leases[stale]
+
+    def get_result(self, key):
+        with self._lock:
+            held = self._leases.get(key)
+            if held is None or held["expires"] < time.time():
+                return True, None
+            return held["done"], held["result"]
+
+
+class FirestoreLockBackend(object):
+    """Leases stored as documents of {collection}, shared by every process of the app."""
+
+    def __init__(self, db_connection, collection='flights'):
+        self.db_connection = db_connection
+        self.collection = collection
+
+    def _ref(self, key):
+        return self.db_connection.cli.collection(self.collection).document(key)
+
+    def acquire(self, key, token, lease):
+        ref = self._ref(key)
+
+        @firestore.transactional
+        def take(transaction):
+            held = ref.get(transaction=transaction).to_dict()
+            if held and held.get("expires", 0) > time.time() and (not held.get("done")
+                                                                  or held.get("result") is not None):
+                return False
+            transaction.set(ref, {"token": token, "expires": time.time() + lease, "done": False, "result": None})
+            return True
+
+        return take(self.db_connection.cli.transaction())
+
+    def release(self, key, token, result=None, keep=60):
+        ref = self._ref(key)
+
+        @firestore.transactional
+        def finish(transaction):
+            held = ref.get(transaction=transaction).to_dict()
+            if held and held.get("token") == token:
+                transaction.update(ref, {"done": True, "result": result, "expires": time.time() + keep})
+
+        finish(self.db_connection.cli.transaction())
+
+    def get_result(self, key):
+        held = self._ref(key).get().to_dict()
+        if held is None or held.get("expires", 0) < time.time():
+            return True, None
+        return held.get("done", False), held.get("result")
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time, every concurrent caller gets its result.
+
+    Callers in this process wait on the in-flight call directly. Across
+    processes the lock backend elects one leader, and the others poll the
+    backend for the result it publishes.
+    """
+
+    def __init__(self, backend=None, lease=120, wait_timeout=120, poll_interval=0.25):
+        self.backend = backend or LocalLockBackend()
+        self.lease = lease
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Run {fn} for {key} unless the same key is in flight, then share its result
+        @return: (result, shared), shared is True when the result came from another caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                raise SingleFlightError("timed out waiting for {}".format(key))
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._lead(key, fn)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, shared
+
+    def _lead(self, key, fn):
+        token = shortuuid.uuid()
+        if self.backend.acquire(key, token, self.lease):
+            result = None
+            try:
+                result = fn()
+            finally:
+                self.backend.release(key, token, result)
+            return result, False
+
+        # another process holds the lease, wait for the result it publishes
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            done, result = self.backend.get_result(key)
+            if done:
+                if result is None:
+                    raise SingleFlightError("the call for {} failed in another process".format(key))
+                return result, True
+            time.sleep(self.poll_interval)
+        raise SingleFlightError("timed out waiting for {}".format(key))
+
+
+class _AsyncCall(object):
+
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.result = None
+        self.error = None
+
+
+class AsyncSingleFlight(object):
+    """Asyncio variant of SingleFlight, for the coroutines of one event loop.
+
+    Coroutines of this loop await the in-flight call directly. The lock
+    backend, which may wait on the network, is called off the event loop,
+    so it can be shared with the SingleFlight of the threaded routes.
+    """
+
+    def __init__(self, backend=None, lease=120, wait_timeout=120, poll_interval=0.25):
+        self.backend = backend or LocalLockBackend()
+        self.lease = lease
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._calls = {}
+
+    async def do(self, key, fn):
+        """Await {fn}() for {key} unless the same key is in flight, then share its result
+        @return: (result, shared), shared is True when the result came from another caller
+        """
+        call = self._calls.get(key)
+        if call is not None:
+            try:
+                await asyncio.wait_for(call.done.wait(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                raise SingleFlightError("timed out waiting for {}".format(key))
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        call = self._calls[key] = _AsyncCall()
+        try:
+            call.result, shared = await self._lead(key, fn)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            del self._calls[key]
+            call.done.set()
+        return call.result, shared
+
+    async def _lead(self, key, fn):
+        loop = asyncio.get_running_loop()
+        token = shortuuid.uuid()
+        if await loop.run_in_executor(None, self.backend.acquire, key, token, self.lease):
+            result = None
+            try:
+                result = await fn()
+            finally:
+                await loop.run_in_executor(None, self.backend.release, key, token, result)
+            return result, False
+
+        # another process, or a thread of this one, holds the lease, wait for the result it publishes
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            done, result = await loop.run_in_executor(None, self.backend.get_result, key)
+            if done:
+                if result is None:
+                    raise SingleFlightError("the call for {} failed in another process".format(key))
+                return result, True
+            await asyncio.sleep(self.poll_interval)
+        raise SingleFlightError("timed out waiting for {}".format(key))
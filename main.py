@@ -1,11 +1,13 @@
 """A Python Flask REST API BoilerPlate (CRUD) Style"""
+import time
+_IMPORT_STARTED = time.perf_counter()
 
 import argparse
 import os
 from flask import Flask, jsonify, make_response
 from flask_cors import CORS
 from flask_swagger_ui import get_swaggerui_blueprint
-from routes import request_api, ai_api
+from routes import request_api, ai_api, metrics_api, export_api, health_api
 
 app = Flask(__name__)
 
@@ -25,6 +27,15 @@ app.register_blueprint(SWAGGERUI_BLUEPRINT, url_prefix=SWAGGER_URL)
 
 app.register_blueprint(request_api.get_blueprint())
 app.register_blueprint(ai_api.get_blueprint())
+app.register_blueprint(metrics_api.get_blueprint())
+app.register_blueprint(export_api.get_blueprint())
+app.register_blueprint(health_api.get_blueprint())
+
+# clients are created on first use or by /ready, so a worker boots on imports alone
+IMPORT_TIME_BUDGET = float(os.environ.get('IMPORT_TIME_BUDGET', 1.5))
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+if IMPORT_SECONDS > IMPORT_TIME_BUDGET:
+    print("importing the app took {:.2f}s, over its {}s budget".format(IMPORT_SECONDS, IMPORT_TIME_BUDGET))
 
 
 @app.errorhandler(400)
@@ -0,0 +1,162 @@
+"""In-process metrics of the interview pipeline, rendered in the Prometheus text format"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class Counter(object):
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append('{}{} {}'.format(self.name, _format_labels(key), value))
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def _time(self, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def time(self, **labels):
+        """Context manager observing the seconds spent in its block"""
+        if not METRICS_ENABLED:
+            return _NULL_TIMER
+        return self._time(labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for key, (counts, total, observed) in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key, [('le', bound)]), count))
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key, [('le', '+Inf')]), observed))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), total))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(key), observed))
+        return lines
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Registry(object):
+    """Holds the metrics of the process and the collectors of gauges computed on scrape.
+
+    A collector is a callable returning (name, documentation, [(labels, value)]).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            return self._metrics[name]
+
+    def counter(self, name, documentation):
+        return self._get(Counter, name, documentation)
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, buckets)
+
+    def register_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            for name, documentation, samples in collector():
+                lines.append('# HELP {} {}'.format(name, documentation))
+                lines.append('# TYPE {} gauge'.format(name))
+                for labels, value in samples:
+                    lines.append('{}{} {}'.format(name, _format_labels(_label_key(labels)), value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram('interview_stage_seconds', 'Seconds spent in each stage of an interview turn.')
+LLM_TOKENS = REGISTRY.histogram('interview_llm_tokens', 'Prompt and completion tokens of each LLM call.',
+                                TOKEN_BUCKETS)
+LLM_RETRIES = REGISTRY.counter('interview_llm_retries_total', 'LLM calls repeated after an unparsable output.')
+LLM_FALLBACKS = REGISTRY.counter('interview_llm_fallbacks_total',
+                                 'LLM calls sent to the fallback model while the circuit of the plan model is open.')
+
+
+def stage(name):
+    """Time a stage of the interview pipeline, e.g. `with stage('llm'):`"""
+    return STAGE_SECONDS.time(stage=name)
@@ -1,21 +1,64 @@
 """The Endpoints to interviewer ai"""
-from flask import jsonify, abort, request, Blueprint
+from flask import jsonify, abort, request, Blueprint, Response
 import os
+import json
+import queue
+import random
+import sys
+import threading
+import time
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import shortuuid
-import openai
-from dotenv import load_dotenv, find_dotenv
 
-from firebase_db_util import FirebaseConnection
-from ai.agents import generate_single_interview_response
+from admission_util import AdmissionController, AdmissionRejectedError, LocalBucketBackend, FirestoreBucketBackend
+from ai.coverage import QuestionCoverage
+from ai.resilience import DeadlineExceededError, CircuitOpenError
+from firebase_db_util import firebase_reset
+from storage_util import get_connection, LazyConnection
+from job_util import LocalJobQueue, QueueFullError, InFlight
+from metrics_util import stage
+from lock_util import SingleFlight, SingleFlightError, LocalLockBackend, FirestoreLockBackend
 
+# ai.agents imports langchain, so it is imported by the functions using it, on the first turn
+# or by /ready rather than when a worker boots
 
-_ = load_dotenv(find_dotenv()) # read local .env file
-openai.api_key = os.environ['OPENAI_API_KEY']
+PLAN_CACHE_TTL = int(os.environ.get('PLAN_CACHE_TTL', 300))
+PLAN_CACHE_SIZE = int(os.environ.get('PLAN_CACHE_SIZE', 1024))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_QUEUE_DEPTH = int(os.environ.get('JOB_QUEUE_DEPTH', 100))
+OPENING_POOL_SIZE = int(os.environ.get('OPENING_POOL_SIZE', 5))
+# 'local' coalesces duplicate turns within a process, 'firestore' across every process
+SINGLE_FLIGHT_BACKEND = os.environ.get('SINGLE_FLIGHT_BACKEND', 'local')
+# 'local' rate limits tenants and plans within a process, 'firestore' across every process
+ADMISSION_BACKEND = os.environ.get('ADMISSION_BACKEND', 'local')
+
+# the firestore lock and bucket backends keep their documents next to the sessions
+for backend_name, backend in (('SINGLE_FLIGHT_BACKEND', SINGLE_FLIGHT_BACKEND),
+                              ('ADMISSION_BACKEND', ADMISSION_BACKEND)):
+    if backend == 'firestore' and os.environ.get('STORAGE_BACKEND', 'firestore') != 'firestore':
+        raise Exception("{}=firestore needs STORAGE_BACKEND=firestore".format(backend_name))
 
 AI_API = Blueprint('ai_api', __name__)
-db_connection = FirebaseConnection(base_collection='interviews')
+# connected on first use, so importing the routes does not need key.json or the network
+db_connection = LazyConnection(lambda: get_connection(
+    base_collection='interviews', cache_config={'plans': {'ttl': PLAN_CACHE_TTL, 'maxsize': PLAN_CACHE_SIZE}}))
+# the status of each job is stored too, a poll may reach another worker than the one running the job
+job_queue = LocalJobQueue(workers=JOB_WORKERS, max_depth=JOB_QUEUE_DEPTH, on_update=lambda job: store_job(job))
+# the generations in progress, waited for before the process exits
+in_flight = InFlight()
+single_flight = SingleFlight(FirestoreLockBackend(db_connection) if SINGLE_FLIGHT_BACKEND == 'firestore'
+                             else LocalLockBackend())
+admission = AdmissionController(FirestoreBucketBackend(db_connection) if ADMISSION_BACKEND == 'firestore'
+                                else LocalBucketBackend())
+
+
+def store_job(job):
+    db_connection.insert(job.to_dict(), collection="jobs", doc_id=job.id)
+
+
+class ResponseGenerationError(Exception):
+    """Exception raised when no valid response could be generated for a turn."""
 
 
 def get_blueprint():
@@ -23,61 +66,406 @@ def get_blueprint():
     return AI_API
 
 
-@AI_API.route('/ask_quento', methods=['POST'])
-def get_ai_reponse():
-    """Create a request for quento ai to generate response
-    @param session: post : the session id
-    @return: 201: a response as a flask/response object \
-    with application/json mimetype.
-    @raise 400: misunderstood request
+def warm_up():
+    """Connect to the db and create the LLM clients, so the first turn does not wait on them"""
+    from ai.clients import get_llm
+    import ai.agents  # noqa: F401
+    db_connection.connect()
+    get_llm()
+
+
+def reset_after_fork():
+    """Drop the clients and worker threads a forked worker inherited from its parent,
+    gRPC channels and keep-alive connections cannot be shared across fork(). They are recreated on first use.
+    """
+    db_connection.reset()
+    firebase_reset()
+    clients = sys.modules.get('ai.clients')
+    if clients is not None:
+        clients.reset_clients(close=False)
+    job_queue.reset()
+    in_flight.reset()
+    admission.reset()
+
+
+def drain(timeout=None):
+    """Wait for the generations in progress and the queued jobs, before the process exits
+    @return: True when everything finished within {timeout} seconds
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    generated = in_flight.wait(timeout)
+    remaining = None if deadline is None else max(0, deadline - time.monotonic())
+    return job_queue.shutdown(wait=True, timeout=remaining) and generated
+
+
+def load_interview_turn(payload):
+    """Load the session and plan of a turn request
+    @return: (turn, None) when a response can be generated, \
+    (None, (message, status)) otherwise.
     """
-    if not request.get_json():
-        abort(400)
-    payload = request.get_json(force=True)
     session_id = payload["session_id"]
-    interview_db_obj = db_connection.find_one(session_id)
+    # the plan is resolved in the same batched read when the client already knows it
+    requested_plan_id = payload.get("plan_id")
+    if requested_plan_id:
+        interview_db_obj, plan_db_obj = db_connection.find_all([(session_id, "interviews"),
+                                                                (requested_plan_id, "plans")])
+    else:
+        interview_db_obj, plan_db_obj = db_connection.find_one(session_id), None
     interview_session = interview_db_obj._data
+    error = check_interview_session(interview_session)
+    if error:
+        return None, error
+
+    plan_id = interview_session["planId"]
+    if plan_db_obj is None or plan_id != requested_plan_id:
+        plan_db_obj = db_connection.find_one(plan_id, "plans")
+    return build_interview_turn(session_id, interview_session, plan_id, plan_db_obj._data)
+
 
+def check_interview_session(interview_session):
+    """@return: the (message, status) error of a session that cannot take a turn, None otherwise"""
     # check if session exist.
     if not interview_session:
-        return jsonify({"response": "session does not exist."}), 400
-    interviewee = interview_session.get("interviewee", "annonymous user")
-    conversation = interview_session["conversation"]
+        return "session does not exist.", 400
 
     # check if session has been completed.
     completion = interview_session.get("completion", True)
     if completion:
-        return jsonify({"response": "session has been completed."}), 400
+        return "session has been completed.", 400
+    return None
+
 
+def build_interview_turn(session_id, interview_session, plan_id, plan):
+    """@return: (turn, None) when a response can be generated, (None, (message, status)) otherwise."""
     # check if interview plan exist.
-    plan_id = interview_session["planId"]
-    plan_db_obj = db_connection.find_one(plan_id, "plans")
-    plan = plan_db_obj._data
     if not plan:
-        return jsonify({"response": "interview plan does not exist."}), 400
-    agent_name = plan["agent name"]
+        return None, ("interview plan does not exist.", 400)
 
+    conversation = interview_session["conversation"]
     if len(conversation) > 0 and not conversation[-1]["isAI"]:
-        return jsonify({"response": "waiting for user reply"}), 400
+        return None, ("waiting for user reply", 400)
 
-    # generate agent response
-    agent_response, signal_completion = generate_single_interview_response(agent_name, plan, conversation)
-    if agent_response:
-        new_utterance = {
-            "messageId": shortuuid.ShortUUID().random(length=8),
-            "isAI": True,
-            "message": agent_response,
-            "speaker": agent_name,
-            "time": datetime.now(tz=ZoneInfo('Australia/Sydney'))
-        }
+    return {
+        "session_id": session_id,
+        "interview_session": interview_session,
+        "conversation": conversation,
+        "plan_id": plan_id,
+        "plan": plan,
+        "agent_name": plan["agent name"],
+        "summary": (interview_session.get("summary"), interview_session.get("summaryUpTo", 0)),
+        "coverage": QuestionCoverage.from_session(plan, interview_session),
+    }, None
+
+
+def generate_turn_response(turn, on_token=None):
+    """Generate the agent response of a loaded turn"""
+    from ai.agents import generate_single_interview_response
+    with stage('generate'):
+        return generate_single_interview_response(turn["agent_name"], turn["plan"], turn["conversation"],
+                                                  session_id=turn["session_id"], plan_id=turn["plan_id"],
+                                                  on_token=on_token, summary=turn["summary"],
+                                                  coverage=turn["coverage"])
+
+
+def get_tenant(turn):
+    """@return: the tenant of the plan, or of the session, None when unknown. It is never taken from
+    the request, a client could otherwise pick a fresh bucket for every turn
+    """
+    return turn["plan"].get("tenantId") or turn["interview_session"].get("tenantId")
+
+
+def too_many_requests(error):
+    """Return a http 429 error to client, telling when to retry"""
+    response = jsonify({"response": "{}, please retry later.".format(error)})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 429
+
+
+def make_agent_utterance(turn, agent_response):
+    return {
+        "messageId": shortuuid.ShortUUID().random(length=8),
+        "isAI": True,
+        "message": agent_response,
+        "speaker": turn["agent_name"],
+        "time": datetime.now(tz=ZoneInfo('Australia/Sydney'))
+    }
+
+
+def get_utterance_fields(turn, completed=False):
+    """@return: the session fields written with an utterance, its question coverage and whether it completes"""
+    fields = turn["coverage"].to_dict()
+    if completed:
+        fields["completion"] = True
+    return fields
+
+
+def store_agent_utterance(turn, agent_response, completed=False):
+    """Append the generated utterance to the session, with the question coverage it leads to,
+    and mark the session completed when {completed}
+    @return: the stored utterance
+    """
+    session_id = turn["session_id"]
+    interview_session = turn["interview_session"]
+    new_utterance = make_agent_utterance(turn, agent_response)
+    fields = get_utterance_fields(turn, completed)
+    if "" in interview_session["conversation"]:
+        # legacy session with empty placeholders, rewrite it once in the clean shape
         interview_session["conversation"].append(new_utterance)
         interview_session["conversation"] = [c for c in interview_session["conversation"] if c != ""]
+        interview_session.update(fields)
         db_connection.insert(interview_session, collection="interviews", doc_id=session_id, mode='set')
-
-        # HTTP 201 Created
-        return jsonify({"response": "response successfully generated and stored in db."}), 201
     else:
+        db_connection.append(session_id, "conversation", [new_utterance], collection="interviews", data=fields)
+    return new_utterance
+
+
+def get_turn_key(turn):
+    """Identify a turn by its session and the last utterance it answers"""
+    conversation = [c for c in turn["conversation"] if c != ""]
+    state = conversation[-1].get("messageId") if conversation else None
+    return "{}-{}".format(turn["session_id"], state or len(conversation))
+
+
+def respond_to_turn(turn, on_token=None):
+    """Generate and store the response of a turn, once for all concurrent requests of the same turn
+    @return: the stored response and its message id
+    @raise ResponseGenerationError: no valid response was generated
+    @raise SingleFlightError: the shared generation did not complete
+    @raise DeadlineExceededError: the LLM did not respond before the deadline of the turn
+    @raise CircuitOpenError: the LLM is failing and the plan has no fallback model
+    """
+    def respond():
+        agent_response = get_opening_message(turn)
+        signal_completion = False
+        if agent_response:
+            turn["coverage"].update("#STARTING", agent_response)
+            if on_token:
+                on_token(agent_response)
+        else:
+            agent_response, signal_completion = generate_turn_response(turn, on_token=on_token)
+        if not agent_response:
+            raise ResponseGenerationError("something went wrong, the response generation was not completed")
+        utterance = store_agent_utterance(turn, agent_response, completed=signal_completion)
+        try:
+            job_queue.submit(store_session_summary, turn)
+        except QueueFullError:
+            pass  # the summary catches up on a later turn
+        return {"response": agent_response, "messageId": utterance["messageId"]}
+
+    with in_flight:
+        result, shared = single_flight.do(get_turn_key(turn), respond)
+    return result
+
+
+def respond_in_background(turn):
+    """Generate a queued turn in a slot of the admission control, as the turns answered at once"""
+    admission.enter_turn(get_tenant(turn), turn["plan_id"])
+    try:
+        return respond_to_turn(turn)
+    finally:
+        admission.leave()
+
+
+def get_opening_pool(plan):
+    """@return: the precomputed opening messages of the plan, empty when missing or out of date"""
+    from ai.agents import get_plan_version
+    openings = plan.get("openings") or {}
+    if openings.get("version") != get_plan_version(plan) or openings.get("agentName") != plan["agent name"]:
+        return []
+    return openings.get("messages") or []
+
+
+def get_opening_message(turn):
+    """Pick a precomputed opening for a session that has not started
+    @return: the opening message, None when the turn is not an opening or the pool is not ready
+    """
+    if [c for c in turn["conversation"] if c != ""]:
+        return None
+    pool = get_opening_pool(turn["plan"])
+    if pool:
+        return random.choice(pool)
+    try:
+        job_queue.submit(single_flight.do, "openings-{}".format(turn["plan_id"]),
+                         lambda: precompute_openings(turn["plan_id"]))
+    except QueueFullError:
+        pass  # the pool is built by a later opening
+    return None
+
+
+def precompute_openings(plan_id, force=False):
+    """Generate and store the pool of opening messages of a plan, unless it is up to date
+    @return: the number of opening messages in the pool
+    """
+    from ai.agents import generate_opening_messages, get_plan_version
+    plan = db_connection.find_one(plan_id, "plans")._data
+    if not plan:
+        raise Exception("interview plan does not exist.")
+    pool = get_opening_pool(plan)
+    if pool and not force:
+        return len(pool)
+    messages = generate_opening_messages(plan["agent name"], plan, plan_id=plan_id,
+                                         count=plan.get("opening_pool_size", OPENING_POOL_SIZE))
+    db_connection.insert({"openings": {"version": get_plan_version(plan), "agentName": plan["agent name"],
+                                       "messages": messages}},
+                         collection="plans", doc_id=plan_id, mode='update')
+    return len(messages)
+
+
+def store_session_summary(turn):
+    """Update the rolling summary of the session once its history is over the plan context budget"""
+    from ai.agents import update_session_summary
+    summary = update_session_summary(turn["agent_name"], turn["plan"], turn["session_id"], plan_id=turn["plan_id"])
+    if summary:
+        db_connection.insert({"summary": summary[0], "summaryUpTo": summary[1]}, collection="interviews",
+                             doc_id=turn["session_id"], mode='update')
+
+
+@AI_API.route('/ask_quento', methods=['POST'])
+def get_ai_reponse():
+    """Create a request for quento ai to generate response
+    @param session_id: post : the session id
+    @param plan_id: post : optional, the plan id of the session, fetched together with the session
+    @param background: post : optional, queue the generation and return without waiting for it
+    @return: 201: a response as a flask/response object \
+    with application/json mimetype.
+    @return: 202: the queued job id, when background is set.
+    @raise 400: misunderstood request
+    @raise 429: the tenant or plan is over its rate limit, or too many responses are being generated, \
+    retry after the seconds of the Retry-After header
+    @raise 503: the job queue is full, or the LLM is failing
+    @raise 504: the LLM did not respond in time
+    """
+    if not request.get_json():
+        abort(400)
+    payload = request.get_json(force=True)
+    with stage('load'):
+        turn, error = load_interview_turn(payload)
+    if error:
+        return jsonify({"response": error[0]}), error[1]
+    try:
+        admission.check_rate(get_tenant(turn), turn["plan_id"])
+    except AdmissionRejectedError as e:
+        return too_many_requests(e)
+
+    if payload.get("background"):
+        try:
+            job = job_queue.submit(respond_in_background, turn)
+        except QueueFullError:
+            admission.refund(get_tenant(turn), turn["plan_id"])
+            return jsonify({"response": "too many responses are being generated, please retry later."}), 503
+        # HTTP 202 Accepted
+        return jsonify({"response": "response generation queued.", "job_id": job.id}), 202
+
+    # generate agent response
+    try:
+        admission.enter_turn(get_tenant(turn), turn["plan_id"])
+    except AdmissionRejectedError as e:
+        return too_many_requests(e)
+    try:
+        respond_to_turn(turn)
+    except (ResponseGenerationError, SingleFlightError):
         return jsonify({"response": "something went wrong, the response generation was not completed"}), 400
+    except DeadlineExceededError:
+        return jsonify({"response": "the response generation timed out, please retry."}), 504
+    except CircuitOpenError:
+        return jsonify({"response": "the response generation is unavailable, please retry later."}), 503
+    finally:
+        admission.leave()
+
+    # HTTP 201 Created
+    return jsonify({"response": "response successfully generated and stored in db."}), 201
+
+
+@AI_API.route('/ask_quento/stream', methods=['POST'])
+def stream_ai_response():
+    """Create a request for quento ai to generate response, streamed as server-sent events
+    @param session_id: post : the session id
+    @param plan_id: post : optional, the plan id of the session, fetched together with the session
+    @return: 200: a text/event-stream of "token" events carrying the response text, \
+    closed by a "done" event once the utterance is stored in db, or an "error" event.
+    @raise 400: misunderstood request
+    @raise 429: the tenant or plan is over its rate limit, or too many responses are being generated, \
+    retry after the seconds of the Retry-After header
+    """
+    if not request.get_json():
+        abort(400)
+    payload = request.get_json(force=True)
+    turn, error = load_interview_turn(payload)
+    if error:
+        return jsonify({"response": error[0]}), error[1]
+    try:
+        admission.check_rate(get_tenant(turn), turn["plan_id"])
+        admission.enter_turn(get_tenant(turn), turn["plan_id"])
+    except AdmissionRejectedError as e:
+        return too_many_requests(e)
+
+    events = queue.Queue()
 
+    def generate():
+        # runs outside the request, so the utterance is stored even if the client goes away
+        try:
+            # a request joining a generation already in flight only receives the done event
+            result = respond_to_turn(turn, on_token=lambda text: events.put(("token", {"token": text})))
+            events.put(("done", result))
+        except Exception as e:
+            print(e)
+            events.put(("error", {"response": "something went wrong, the response generation was not completed"}))
+        finally:
+            admission.leave()
+            events.put(None)
 
+    threading.Thread(target=generate, daemon=True).start()
 
+    def event_stream():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield "event: {}\ndata: {}\n\n".format(event[0], json.dumps(event[1]))
+
+    return Response(event_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@AI_API.route('/plans/<string:plan_id>/openings', methods=['POST'])
+def create_plan_openings(plan_id):
+    """Precompute the opening messages of a plan, call it when the plan is created or changed
+    @param plan_id: the plan id
+    @return: 202: the queued job id as a flask/response object \
+    with application/json mimetype.
+    @raise 503: the job queue is full
+    """
+    try:
+        job = job_queue.submit(precompute_openings, plan_id, force=True)
+    except QueueFullError:
+        return jsonify({"response": "too many jobs are queued, please retry later."}), 503
+    # HTTP 202 Accepted
+    return jsonify({"response": "opening messages generation queued.", "job_id": job.id}), 202
+
+
+@AI_API.route('/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get the status of a queued response generation
+    @param job_id: the job id
+    @return: 200: the job as a flask/response object \
+    with application/json mimetype.
+    @raise 404: if the job is not found
+    """
+    job = job_queue.get(job_id)
+    if job is not None:
+        return jsonify(job.to_dict()), 200
+    # queued by another worker
+    snapshot = db_connection.find_one(job_id, "jobs")
+    if not snapshot.exists:
+        abort(404)
+    return jsonify(snapshot.to_dict()), 200
+
+
+@AI_API.route('/parse_stats', methods=['GET'])
+def get_parse_stats():
+    """Return how the LLM outputs of each plan were parsed
+    @return: 200: the outputs, repairs, parse_failures and retries \
+    counted per plan id, as a flask/response object with application/json mimetype.
+    """
+    from ai.agents import PARSE_STATS
+    return jsonify(PARSE_STATS.to_dict()), 200
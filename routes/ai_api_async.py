@@ -0,0 +1,183 @@
+"""The asyncio endpoints to interviewer ai, served by asgi.py
+Requests to any other path are handed to the flask app.
+"""
+import json
+
+from ai.agents import agenerate_single_interview_response
+from admission_util import AdmissionRejectedError
+from ai.clients import get_aio_session, close_aio_session
+from ai.resilience import DeadlineExceededError, CircuitOpenError
+from job_util import QueueFullError
+from lock_util import AsyncSingleFlight, SingleFlightError
+from routes.ai_api import db_connection, job_queue, admission, single_flight, check_interview_session, \
+    build_interview_turn, make_agent_utterance, get_utterance_fields, store_session_summary, get_opening_message, get_turn_key, \
+    get_tenant, ResponseGenerationError
+
+# shares the leases of the threaded routes, so a turn is generated once whichever route serves it
+async_single_flight = AsyncSingleFlight(single_flight.backend)
+
+
+async def load_interview_turn(payload):
+    """Asyncio variant of routes.ai_api.load_interview_turn"""
+    session_id = payload["session_id"]
+    requested_plan_id = payload.get("plan_id")
+    if requested_plan_id:
+        interview_db_obj, plan_db_obj = await db_connection.afind_all([(session_id, "interviews"),
+                                                                       (requested_plan_id, "plans")])
+    else:
+        interview_db_obj, plan_db_obj = await db_connection.afind_one(session_id), None
+    interview_session = interview_db_obj._data
+    error = check_interview_session(interview_session)
+    if error:
+        return None, error
+
+    plan_id = interview_session["planId"]
+    if plan_db_obj is None or plan_id != requested_plan_id:
+        plan_db_obj = await db_connection.afind_one(plan_id, "plans")
+    return build_interview_turn(session_id, interview_session, plan_id, plan_db_obj._data)
+
+
+async def store_agent_utterance(turn, agent_response, completed=False):
+    """Asyncio variant of routes.ai_api.store_agent_utterance"""
+    session_id = turn["session_id"]
+    interview_session = turn["interview_session"]
+    new_utterance = make_agent_utterance(turn, agent_response)
+    fields = get_utterance_fields(turn, completed)
+    if "" in interview_session["conversation"]:
+        interview_session["conversation"].append(new_utterance)
+        interview_session["conversation"] = [c for c in interview_session["conversation"] if c != ""]
+        interview_session.update(fields)
+        await db_connection.ainsert(interview_session, collection="interviews", doc_id=session_id, mode='set')
+    else:
+        await db_connection.aappend(session_id, "conversation", [new_utterance], collection="interviews",
+                                    data=fields)
+    return new_utterance
+
+
+async def get_ai_reponse(payload):
+    """Create a request for quento ai to generate response
+    @param session_id: post : the session id
+    @param plan_id: post : optional, the plan id of the session, fetched together with the session
+    @return: 201: a response as a json body.
+    @raise 400: misunderstood request
+    @raise 429: the tenant or plan is over its rate limit, or every response slot is taken, \
+    retry after the seconds of the Retry-After header
+    @raise 503: the LLM is failing
+    @raise 504: the LLM did not respond in time
+    """
+    if not payload:
+        return {'error': 'Misunderstood'}, 400
+    turn, error = await load_interview_turn(payload)
+    if error:
+        return {"response": error[0]}, error[1]
+    try:
+        # waiting for a slot would block the event loop, a turn is admitted at once or rejected
+        admission.check_rate(get_tenant(turn), turn["plan_id"])
+        admission.enter_turn(get_tenant(turn), turn["plan_id"], wait=False)
+    except AdmissionRejectedError as e:
+        return {"response": "{}, please retry later.".format(e)}, 429, {"Retry-After": str(e.retry_after)}
+    try:
+        await respond_to_turn(turn)
+    except (ResponseGenerationError, SingleFlightError):
+        return {"response": "something went wrong, the response generation was not completed"}, 400
+    except DeadlineExceededError:
+        return {"response": "the response generation timed out, please retry."}, 504
+    except CircuitOpenError:
+        return {"response": "the response generation is unavailable, please retry later."}, 503
+    finally:
+        admission.leave()
+
+    # HTTP 201 Created
+    return {"response": "response successfully generated and stored in db."}, 201
+
+
+async def respond_to_turn(turn):
+    """Asyncio variant of routes.ai_api.respond_to_turn, concurrent requests of the same turn share one response
+    @return: the stored response and its message id
+    """
+    async def respond():
+        agent_response = get_opening_message(turn)
+        signal_completion = False
+        if agent_response:
+            turn["coverage"].update("#STARTING", agent_response)
+        else:
+            get_aio_session()
+            agent_response, signal_completion = await agenerate_single_interview_response(
+                turn["agent_name"], turn["plan"], turn["conversation"], session_id=turn["session_id"],
+                plan_id=turn["plan_id"], summary=turn["summary"], coverage=turn["coverage"])
+        if not agent_response:
+            raise ResponseGenerationError("something went wrong, the response generation was not completed")
+        utterance = await store_agent_utterance(turn, agent_response, completed=signal_completion)
+        try:
+            job_queue.submit(store_session_summary, turn)
+        except QueueFullError:
+            pass  # the summary catches up on a later turn
+        return {"response": agent_response, "messageId": utterance["messageId"]}
+
+    result, shared = await async_single_flight.do(get_turn_key(turn), respond)
+    return result
+
+
+ROUTES = {
+    ('POST', '/ask_quento'): get_ai_reponse,
+}
+
+
+class AsyncAIApp(object):
+    """ASGI application serving ROUTES natively and everything else through {fallback}"""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        handler = None
+        if scope['type'] == 'http':
+            handler = ROUTES.get((scope['method'], scope['path']))
+        if handler is None:
+            await self.fallback(scope, receive, send)
+            return
+
+        try:
+            body = await read_body(receive)
+            payload = json.loads(body) if body else None
+            data, status, *headers = await handler(payload)
+        except ValueError:
+            data, status, headers = {'error': 'Misunderstood'}, 400, []
+        except Exception as e:
+            print(e)
+            data, status, headers = {'error': 'Server error'}, 500, []
+        await send_json(send, data, status, headers[0] if headers else None)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_aio_session()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_json(send, data, status, headers=None):
+    body = json.dumps(data).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+                   + [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
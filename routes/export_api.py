@@ -0,0 +1,39 @@
+"""The Endpoint streaming the interviews of a plan out of the db"""
+from flask import Blueprint, Response, jsonify, request
+
+from export_util import ExportFormatError, EXPORT_PAGE_SIZE, EXPORT_MAX_PAGE_SIZE, check_format, export_chunks
+from routes.ai_api import db_connection
+
+EXPORT_API = Blueprint('export_api', __name__)
+MIMETYPES = {'jsonl': 'application/x-ndjson', 'parquet': 'application/vnd.apache.parquet'}
+
+
+def get_blueprint():
+    """Return the blueprint for the main app module"""
+    return EXPORT_API
+
+
+@EXPORT_API.route('/plans/<string:plan_id>/interviews/export', methods=['GET'])
+def export_plan_interviews(plan_id):
+    """Stream the interview sessions of a plan, read page by page
+    @param plan_id: the plan id
+    @param format: query : optional, jsonl (default) or parquet
+    @param fields: query : optional, comma separated fields to export, e.g. conversation,completion
+    @param page_size: query : optional, the documents read from the db at a time, at most EXPORT_MAX_PAGE_SIZE
+    @return: 200: the sessions as a jsonl or parquet attachment.
+    @raise 400: the format is invalid or not available, or the page size is below 1
+    """
+    export_format = request.args.get('format', 'jsonl')
+    fields = [field for field in request.args.get('fields', '').split(',') if field] or None
+    page_size = request.args.get('page_size', EXPORT_PAGE_SIZE, type=int)
+    # checked before the response starts, a failing read cannot change the status of a stream
+    if page_size < 1:
+        return jsonify({"response": "page_size must be at least 1."}), 400
+    page_size = min(page_size, EXPORT_MAX_PAGE_SIZE)
+    try:
+        check_format(export_format)
+    except ExportFormatError as e:
+        return jsonify({"response": str(e)}), 400
+    chunks = export_chunks(db_connection, plan_id, export_format, fields=fields, page_size=page_size)
+    return Response(chunks, mimetype=MIMETYPES[export_format],
+                    headers={'Content-Disposition': 'attachment; filename={}.{}'.format(plan_id, export_format)})
@@ -0,0 +1,26 @@
+"""The Endpoint telling a load balancer whether this worker can take interview turns"""
+from flask import Blueprint, jsonify
+
+from routes.ai_api import warm_up
+
+HEALTH_API = Blueprint('health_api', __name__)
+
+
+def get_blueprint():
+    """Return the blueprint for the main app module"""
+    return HEALTH_API
+
+
+@HEALTH_API.route('/ready', methods=['GET'])
+def get_readiness():
+    """Warm the db and LLM clients of the worker, created lazily otherwise
+    @return: 200: the worker is ready to take turns, as a flask/response object \
+    with application/json mimetype.
+    @raise 503: a client could not be created, e.g. a missing key.json or OPENAI_API_KEY
+    """
+    try:
+        warm_up()
+    except Exception as e:
+        print(e)
+        return jsonify({"ready": False, "error": str(e)}), 503
+    return jsonify({"ready": True}), 200
@@ -0,0 +1,89 @@
+"""The Endpoint exposing the interview pipeline metrics"""
+import sys
+
+from flask import Blueprint, Response
+
+from metrics_util import REGISTRY
+from routes.ai_api import db_connection, admission
+
+METRICS_API = Blueprint('metrics_api', __name__)
+
+
+def get_blueprint():
+    """Return the blueprint for the main app module"""
+    return METRICS_API
+
+
+def loaded(name):
+    """@return: the module {name} once a turn has imported it, None before,
+    so a scrape neither imports langchain nor connects to the db of an idle worker
+    """
+    return sys.modules.get(name)
+
+
+def collect_cache_metrics():
+    caches = []
+    agents = loaded('ai.agents')
+    if agents is not None:
+        caches += [("agents", agents.AGENT_CACHE.stats()), ("compiled_plans", agents.COMPILED_PLAN_CACHE.stats())]
+    if db_connection.connected:
+        caches += [("db_" + collection, stats) for collection, stats in db_connection.cache_stats().items()]
+    ratios, sizes = [], []
+    for name, stats in caches:
+        lookups = stats["hits"] + stats["misses"]
+        ratios.append(({"cache": name}, stats["hits"] / lookups if lookups else 0))
+        sizes.append(({"cache": name}, stats["size"]))
+    return [("interview_cache_hit_ratio", "Share of cache lookups served from the cache.", ratios),
+            ("interview_cache_size", "Entries held by each cache.", sizes)]
+
+
+def collect_parse_metrics():
+    agents = loaded('ai.agents')
+    if agents is None:
+        return []
+    samples = {}
+    for plan_id, stats in agents.PARSE_STATS.to_dict().items():
+        for name, value in stats.items():
+            samples.setdefault(name, []).append(({"plan": plan_id}, value))
+    return [("interview_plan_" + name, "LLM {} counted per plan.".format(name.replace("_", " ")), values)
+            for name, values in samples.items()]
+
+
+def collect_hedge_metrics():
+    agents = loaded('ai.agents')
+    if agents is None:
+        return []
+    return [("interview_llm_" + name, "LLM call hedging, {}.".format(name.replace("_", " ")), [({}, value)])
+            for name, value in agents.HEDGER.stats().items()]
+
+
+def collect_breaker_metrics():
+    resilience = loaded('ai.resilience')
+    if resilience is None:
+        return []
+    samples = {}
+    for model, breaker in list(resilience.BREAKERS.items()):
+        for name, value in breaker.stats().items():
+            samples.setdefault(name, []).append(({"model": model}, value))
+    return [("interview_llm_circuit_" + name, "LLM circuit breaker {}, per model.".format(name), values)
+            for name, values in samples.items()]
+
+
+def collect_admission_metrics():
+    return [("interview_admission_" + name, "Turns {}, by the admission control.".format(name.replace("_", " ")),
+             [({}, value)]) for name, value in admission.stats().items()]
+
+
+REGISTRY.register_collector(collect_cache_metrics)
+REGISTRY.register_collector(collect_parse_metrics)
+REGISTRY.register_collector(collect_hedge_metrics)
+REGISTRY.register_collector(collect_breaker_metrics)
+REGISTRY.register_collector(collect_admission_metrics)
+
+
+@METRICS_API.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Return the stage latencies, token counts, retries, hedges and cache hit ratios
+    @return: 200: the metrics in the Prometheus text format.
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
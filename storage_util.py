@@ -0,0 +1,555 @@
+"""Local storage engines behind the FirebaseConnection interface, for self-hosted
+and single node deployments, tests and benchmarks, without cloud credentials.
+
+The backend is chosen with STORAGE_BACKEND: 'firestore' (default), 'memory' or 'sqlite'.
+"""
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import cmp_to_key
+
+import shortuuid
+from firebase_admin import firestore
+
+from bulk_util import BulkWriter
+from firebase_db_util import FirebaseConnection
+from metrics_util import stage
+
+DIR_PATH = os.path.dirname(__file__)
+DEFAULT_SQLITE_PATH = os.path.join(DIR_PATH, 'quento.db')
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def get_connection(base_collection=None, cache_config=None, backend=None):
+    """Return the connection of the storage backend, STORAGE_BACKEND by default"""
+    backend = backend or os.environ.get('STORAGE_BACKEND', 'firestore')
+    if backend == 'firestore':
+        return FirebaseConnection(base_collection=base_collection, cache_config=cache_config)
+    if backend == 'memory':
+        return LocalConnection(MemoryEngine(), base_collection=base_collection)
+    if backend == 'sqlite':
+        return LocalConnection(SQLiteEngine(os.environ.get('SQLITE_PATH', DEFAULT_SQLITE_PATH)),
+                               base_collection=base_collection)
+    raise Exception("Storage backend {} is invalid".format(backend))
+
+
+class LazyConnection(object):
+    """A connection created by {factory} on first use, from whichever thread comes first.
+    Every other attribute is forwarded to the connection.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        connection = self._connection
+        if connection is None:
+            with self._lock:
+                if self._connection is None:
+                    self._connection = self._factory()
+                connection = self._connection
+        return connection
+
+    @property
+    def connected(self):
+        return self._connection is not None
+
+    def reset(self):
+        """Drop the connection, the next use creates a new one"""
+        with self._lock:
+            self._connection = None
+
+    def __getattr__(self, name):
+        return getattr(self.connect(), name)
+
+
+# field paths and values, with the semantics of firestore
+def _get_field(data, field):
+    """@return: (found, value) of the dotted {field} path in {data}"""
+    value = data
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+
+def _resolve(value, current):
+    """Apply the firestore sentinels of a written value to the value it replaces"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(tz=timezone.utc)
+    if isinstance(value, firestore.ArrayUnion):
+        current = list(current) if isinstance(current, list) else []
+        return current + [v for v in value.values if v not in current]
+    if isinstance(value, firestore.ArrayRemove):
+        return [v for v in current if v not in value.values] if isinstance(current, list) else []
+    if isinstance(value, firestore.Increment):
+        return current + value.value if isinstance(current, (int, float)) else value.value
+    if isinstance(value, dict):
+        return {k: _resolve(v, None) for k, v in value.items() if v is not firestore.DELETE_FIELD}
+    return value
+
+
+def _merge(doc, data):
+    for key, value in data.items():
+        if value is firestore.DELETE_FIELD:
+            doc.pop(key, None)
+        elif isinstance(value, dict) and isinstance(doc.get(key), dict):
+            _merge(doc[key], value)
+        else:
+            doc[key] = _resolve(value, doc.get(key))
+
+
+def _update(doc, data):
+    for field, value in data.items():
+        parent = doc
+        parts = field.split('.')
+        for part in parts[:-1]:
+            if not isinstance(parent.get(part), dict):
+                parent[part] = {}
+            parent = parent[part]
+        if value is firestore.DELETE_FIELD:
+            parent.pop(parts[-1], None)
+        else:
+            parent[parts[-1]] = _resolve(value, parent.get(parts[-1]))
+
+
+def apply_write(current, data, mode='set', merge=False):
+    """@return: the document {current} becomes once {data} is written with {mode}, \
+    {current} is changed in place and the result may share values with {data}
+    """
+    if mode == 'update':
+        if current is None:
+            raise Exception("No document to update")
+        doc = current
+        _update(doc, data)
+    elif mode == 'set':
+        doc = current if merge and current is not None else {}
+        _merge(doc, data)
+    else:
+        raise Exception("Write mode {} is invalid".format(mode))
+    return doc
+
+
+def _sort_key(value):
+    # firestore orders the values of different types as null, boolean, number, timestamp, string, bytes, array, map
+    if value is None:
+        return 0, 0
+    if isinstance(value, bool):
+        return 1, value
+    if isinstance(value, (int, float)):
+        return 2, value
+    if isinstance(value, datetime):
+        return 3, value.timestamp()
+    if isinstance(value, str):
+        return 4, value
+    if isinstance(value, bytes):
+        return 5, value
+    if isinstance(value, list):
+        return 8, [_sort_key(v) for v in value]
+    if isinstance(value, dict):
+        return 9, sorted((k, _sort_key(v)) for k, v in value.items())
+    return 10, str(value)
+
+
+def _compare(a, b):
+    a, b = _sort_key(a), _sort_key(b)
+    return (a > b) - (a < b)
+
+
+def _matches(data, field, operator, value):
+    found, current = _get_field(data, field)
+    if not found:
+        return False
+    if operator == 'array-contains':
+        return isinstance(current, list) and any(_compare(v, value) == 0 for v in current)
+    if operator == 'array-contains-any':
+        return isinstance(current, list) and any(_compare(v, w) == 0 for v in current for w in value)
+    if operator == 'in':
+        return any(_compare(current, v) == 0 for v in value)
+    # range and equality filters only match values of the same type
+    if _sort_key(current)[0] != _sort_key(value)[0]:
+        return False
+    c = _compare(current, value)
+    return {'==': c == 0, '<': c < 0, '<=': c <= 0, '>': c > 0, '>=': c >= 0}[operator]
+
+
+def _project(data, select):
+    """@return: the fields of {data} at the dotted paths of {select}, the missing ones left out"""
+    projected = {}
+    for field in select:
+        found, value = _get_field(data, field)
+        if found:
+            _update(projected, {field: value})
+    return projected
+
+
+def _compare_docs(a, b, orders):
+    """Compare (doc_id, data) pairs by {orders}, then by id, a None id compares equal to any id"""
+    for field, desc in orders:
+        c = _compare(_get_field(a[1], field)[1], _get_field(b[1], field)[1])
+        if c:
+            return -c if desc else c
+    if a[0] is None or b[0] is None:
+        return 0
+    c = (a[0] > b[0]) - (a[0] < b[0])
+    return -c if orders and orders[-1][1] else c
+
+
+class LocalSnapshot(object):
+    """The part of a firestore DocumentSnapshot read by the app"""
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return self._data
+
+    def get(self, field):
+        return _get_field(self._data or {}, field)[1]
+
+
+class MemoryEngine(object):
+    """Documents held in this process, lost when it exits.
+
+    Documents are kept pickled, so every read returns a copy the caller may change,
+    at a fraction of the cost of copy.deepcopy.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._collections = {}
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            yield
+
+    def get(self, collection, doc_id):
+        with self.lock:
+            data = self._collections.get(collection, {}).get(doc_id)
+        return pickle.loads(data) if data is not None else None
+
+    def put(self, collection, doc_id, data):
+        data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self._collections.setdefault(collection, {})[doc_id] = data
+
+    def query(self, collection, filters=(), orders=(), cursor=None, limit=None, select=None):
+        with self.lock:
+            docs = list(self._collections.get(collection, {}).items())
+        docs = [(doc_id, pickle.loads(data)) for doc_id, data in docs]
+        docs = [doc for doc in docs if all(_matches(doc[1], *f) for f in filters)
+                and all(_get_field(doc[1], field)[0] for field, _ in orders)]
+        docs.sort(key=cmp_to_key(lambda a, b: _compare_docs(a, b, orders)))
+        if cursor is not None:
+            docs = [doc for doc in docs if _compare_docs(doc, cursor, orders) > 0]
+        if limit:
+            docs = docs[:limit]
+        if select is not None:
+            docs = [(doc_id, _project(data, select)) for doc_id, data in docs]
+        return docs
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.astimezone()
+        return {"__datetime__": value.astimezone(timezone.utc).strftime(DATETIME_FORMAT)}
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def _decode(obj):
+    if len(obj) == 1 and "__datetime__" in obj:
+        return datetime.strptime(obj["__datetime__"], DATETIME_FORMAT).replace(tzinfo=timezone.utc)
+    return obj
+
+
+def _dumps(value):
+    # compact, as sqlite renders the json values it extracts
+    return json.dumps(value, default=_encode, separators=(',', ':'), ensure_ascii=False)
+
+
+def _loads(text):
+    return json.loads(text, object_hook=_decode)
+
+
+def _json_path(field):
+    path = '$' + ''.join('."{}"'.format(part) for part in field.split('.'))
+    return "'{}'".format(path.replace("'", "''"))
+
+
+def _json_types(value):
+    if value is None:
+        return ('null',)
+    if isinstance(value, bool):
+        return ('true', 'false')
+    if isinstance(value, (int, float)):
+        return ('integer', 'real')
+    if isinstance(value, str):
+        return ('text',)
+    if isinstance(value, list):
+        return ('array',)
+    return ('object',)
+
+
+def _sql_value(value):
+    if isinstance(value, bool):
+        return int(value)
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return _dumps(value)
+
+
+def _projected_row(select, columns):
+    projected = {}
+    for field, value, json_type in zip(select, columns[0::2], columns[1::2]):
+        if json_type is None:
+            continue
+        if json_type in ('object', 'array'):
+            value = _loads(value)
+        elif json_type in ('true', 'false'):
+            value = json_type == 'true'
+        _update(projected, {field: value})
+    return projected
+
+
+class SQLiteEngine(object):
+    """Documents stored as json rows of a sqlite file, with an index on every queried field."""
+
+    def __init__(self, path=':memory:'):
+        self.lock = threading.RLock()
+        self._depth = 0
+        self._indexes = set()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS documents (collection TEXT NOT NULL, doc_id TEXT NOT NULL, '
+                         'data TEXT NOT NULL, PRIMARY KEY (collection, doc_id)) WITHOUT ROWID')
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            self._db.execute('BEGIN IMMEDIATE')
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            else:
+                self._db.execute('COMMIT')
+            finally:
+                self._depth = 0
+
+    def get(self, collection, doc_id):
+        with self.lock:
+            row = self._db.execute('SELECT data FROM documents WHERE collection = ? AND doc_id = ?',
+                                   (collection, doc_id)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def put(self, collection, doc_id, data):
+        with self.lock:
+            self._db.execute('INSERT OR REPLACE INTO documents (collection, doc_id, data) VALUES (?, ?, ?)',
+                             (collection, doc_id, _dumps(data)))
+
+    def _extract(self, field):
+        """@return: the sql expression of {field}, indexed on first use"""
+        expression = 'json_extract(data, {})'.format(_json_path(field))
+        if field not in self._indexes:
+            name = 'documents_' + hashlib.sha1(field.encode('utf-8')).hexdigest()[:16]
+            self._db.execute('CREATE INDEX IF NOT EXISTS {} ON documents (collection, {})'.format(name, expression))
+            self._indexes.add(field)
+        return expression
+
+    def _filter(self, field, operator, value):
+        path = _json_path(field)
+        if operator in ('array-contains', 'array-contains-any'):
+            values = [value] if operator == 'array-contains' else list(value)
+            return ("json_type(data, {0}) = 'array' AND EXISTS (SELECT 1 FROM json_each(data, {0}) "
+                    "WHERE json_each.value IN ({1}))".format(path, ', '.join('?' * len(values))),
+                    [_sql_value(v) for v in values])
+        expression = self._extract(field)
+        if operator == 'in':
+            return '{} IN ({})'.format(expression, ', '.join('?' * len(value))), [_sql_value(v) for v in value]
+        if value is None:
+            return "json_type(data, {}) = 'null'".format(path), []
+        types = _json_types(value)
+        return ('{} {} ? AND json_type(data, {}) IN ({})'.format(expression, '=' if operator == '==' else operator,
+                                                                 path, ', '.join("'{}'".format(t) for t in types)),
+                [_sql_value(value)])
+
+    def query(self, collection, filters=(), orders=(), cursor=None, limit=None, select=None):
+        with self.lock:
+            clauses, params = ['collection = ?'], [collection]
+            for field, operator, value in filters:
+                clause, clause_params = self._filter(field, operator, value)
+                clauses.append(clause)
+                params += clause_params
+            terms = []
+            for field, desc in orders:
+                clauses.append('json_type(data, {}) IS NOT NULL'.format(_json_path(field)))
+                terms.append((self._extract(field), desc, field))
+            last_desc = bool(orders) and orders[-1][1]
+            if cursor is not None:
+                keys = [(expression, desc, _sql_value(_get_field(cursor[1], field)[1]))
+                        for expression, desc, field in terms]
+                if cursor[0] is not None:
+                    keys.append(('doc_id', last_desc, cursor[0]))
+                # keyset pagination, after the cursor in the order of the query
+                alternatives = []
+                for i, (expression, desc, value) in enumerate(keys):
+                    alternative = ['{} = ?'.format(k[0]) for k in keys[:i]] + \
+                                  ['{} {} ?'.format(expression, '<' if desc else '>')]
+                    alternatives.append('(' + ' AND '.join(alternative) + ')')
+                    params += [k[2] for k in keys[:i]] + [value]
+                if alternatives:
+                    clauses.append('(' + ' OR '.join(alternatives) + ')')
+            order_by = ['{}{}'.format(expression, ' DESC' if desc else '') for expression, desc, _ in terms]
+            order_by.append('doc_id DESC' if last_desc else 'doc_id')
+            # a projection is extracted by sqlite, so the rest of each document is never parsed
+            columns = 'data' if select is None else ', '.join(
+                ['json_extract(data, {0}), json_type(data, {0})'.format(_json_path(field)) for field in select]
+                or ['NULL'])
+            sql = 'SELECT doc_id, {} FROM documents WHERE {} ORDER BY {}'.format(columns, ' AND '.join(clauses),
+                                                                                ', '.join(order_by))
+            if limit:
+                sql += ' LIMIT ?'
+                params.append(limit)
+            rows = self._db.execute(sql, params).fetchall()
+        if select is None:
+            return [(doc_id, _loads(data)) for doc_id, data in rows]
+        return [(row[0], _projected_row(select, row[1:])) for row in rows]
+
+
+class LocalConnection(object):
+    """FirebaseConnection on a local storage engine.
+
+    Reads are served by the engine directly, so no read-through cache is kept,
+    and the asyncio variants run inline.
+    """
+
+    def __init__(self, engine, base_collection=None):
+        self.engine = engine
+        self.base_collection = base_collection
+        self.caches = {}
+
+    def invalidate(self, doc_id, collection=None):
+        pass
+
+    def cache_stats(self):
+        return {}
+
+    def _write(self, data, collection, doc_id, mode, merge):
+        if not doc_id:
+            doc_id, mode, merge = shortuuid.ShortUUID().random(length=20), 'set', False
+        current = self.engine.get(collection, doc_id) if mode == 'update' or merge else None
+        self.engine.put(collection, doc_id, apply_write(current, data, mode, merge))
+
+    # Add single doc into the collection with or without the custom key
+    def insert(self, data, collection=None, doc_id=None, reference=None, mode='set', merge=False):
+        if not collection:
+            collection = self.base_collection
+        with stage('insert'):
+            try:
+                with self.engine.transaction():
+                    self._write(data, reference or collection, doc_id, mode, merge)
+            except Exception as e:
+                print(e)
+
+    def nesting_insert(self, ref_path, data, collection=None, mode='set', merge=False):
+        if not collection:
+            collection = self.base_collection
+        path = [collection]
+        cur_type = 'collection'
+        doc_id = None
+        for fb_type, obj_id in ref_path:
+            if cur_type == 'collection' and cur_type == fb_type: raise Exception(
+                'Nesting {} directly under {}'.format(cur_type, cur_type))
+            if doc_id:
+                path.append(doc_id)
+            if fb_type == 'collection':
+                path.append(obj_id)
+                doc_id = None
+            elif fb_type == 'document':
+                doc_id = obj_id
+            cur_type = fb_type
+        self.insert(data, reference='/'.join(path), mode=mode, doc_id=doc_id, merge=merge)
+
+    # Append values to an array field without rewriting the rest of the document
+    def append(self, doc_id, field, values, collection=None, data=None):
+        update = dict(data or {})
+        update[field] = firestore.ArrayUnion(values)
+        self.insert(update, collection=collection, doc_id=doc_id, mode='update')
+
+    def remove(self, doc_id, field, values, collection=None):
+        self.insert({field: firestore.ArrayRemove(values)}, collection=collection, doc_id=doc_id, mode='update')
+
+    def bulk_insert(self, data_list, collection=None, mode='set', workers=1):
+        """@return: a WriteResult per document of {data_list}"""
+        if not collection:
+            collection = self.base_collection
+
+        def commit(chunk):
+            with self.engine.transaction():
+                for doc_id, data in chunk:
+                    self._write(data, collection, doc_id, mode, False)
+
+        # a local engine has a single writer, so batches are not committed concurrently by default
+        return BulkWriter(commit, batch_size=FirebaseConnection.MAX_BATCH_WRITE, workers=workers,
+                          transient_errors=(sqlite3.OperationalError,)).write(data_list)
+
+    def find_one(self, doc_id, collection=None):
+        if not collection:
+            collection = self.base_collection
+        with stage('find_one'):
+            return LocalSnapshot(doc_id, self.engine.get(collection, doc_id))
+
+    def find_all(self, keys):
+        with stage('find_all'):
+            return [LocalSnapshot(doc_id, self.engine.get(collection or self.base_collection, doc_id))
+                    for doc_id, collection in keys]
+
+    def find_many(self, collection=None, query=None, orders_by=[], start_after=None, limit=None, select=None):
+        if not collection:
+            collection = self.base_collection
+        # a Firestore_query without a value is ignored, as in join_query
+        filters = [q.to_tuple() for q in query or [] if q.to_tuple()]
+        orders = [(order_by.field, order_by.desc) for order_by in orders_by if order_by.field]
+        cursor = None
+        if start_after is not None:
+            if isinstance(start_after, dict):
+                cursor = (None, start_after)
+            else:
+                cursor = (start_after.id, start_after.to_dict() or {})
+        docs = self.engine.query(collection, filters, orders, cursor, limit, select)
+        return (LocalSnapshot(doc_id, data) for doc_id, data in docs)
+
+    # asyncio variants, local reads and writes do not wait on the network
+    async def afind_one(self, doc_id, collection=None):
+        return self.find_one(doc_id, collection)
+
+    async def afind_all(self, keys):
+        return self.find_all(keys)
+
+    async def ainsert(self, data, collection=None, doc_id=None, mode='set', merge=False):
+        self.insert(data, collection=collection, doc_id=doc_id, mode=mode, merge=merge)
+
+    async def aappend(self, doc_id, field, values, collection=None, data=None):
+        self.append(doc_id, field, values, collection=collection, data=data)
@@ -0,0 +1,82 @@
+"""Tests for the admission control of generation.
+To run the tests type,
+$ python -m pytest tests/admission_test.py
+"""
+import threading
+import time
+
+from nose.tools import assert_true
+
+from admission_util import AdmissionController, AdmissionRejectedError, take_token
+
+
+def test_token_bucket_refills_at_its_rate():
+    "Test a bucket admits its burst, then tells how long until its next token"
+    bucket, waits = None, []
+    for _ in range(3):
+        bucket, wait = take_token(bucket, 0.0, rate=2, burst=2)
+        waits.append(wait)
+    assert_true(waits == [0, 0, 0.5])
+    assert_true(take_token(bucket, 0.5, rate=2, burst=2)[1] == 0)
+
+
+def test_tenants_and_plans_are_limited_apart():
+    "Test an empty tenant bucket rejects its turns only, with a retry after"
+    admission = AdmissionController(tenant_rate=0.5, tenant_burst=1, plan_rate=0, plan_burst=0)
+    admission.check_rate("acme", "p1")
+    try:
+        admission.check_rate("acme", "p2")
+        assert_true(False)
+    except AdmissionRejectedError as e:
+        assert_true(e.reason == 'tenant' and e.retry_after == 2)
+    admission.check_rate("globex", "p1")
+    admission.check_rate(None, "p1")
+    assert_true(admission.stats()["rejected_tenant"] == 1)
+
+
+def test_a_rejected_turn_takes_no_token():
+    "Test a turn rejected by its plan bucket leaves the token of its tenant"
+    admission = AdmissionController(tenant_rate=0.01, tenant_burst=2, plan_rate=0.01, plan_burst=1)
+    admission.check_rate("acme", "p1")
+    for tenant, plan_id, reason in (("acme", "p1", 'plan'), ("acme", "p2", None), ("acme", "p3", 'tenant')):
+        try:
+            admission.check_rate(tenant, plan_id)
+            assert_true(reason is None)
+        except AdmissionRejectedError as e:
+            assert_true(e.reason == reason)
+    assert_true(admission.stats()["rejected_plan"] == 1 and admission.stats()["rejected_tenant"] == 1)
+
+
+def test_a_turn_without_a_slot_gives_its_tokens_back():
+    "Test a turn rate checked then rejected for want of a slot leaves the tokens of its tenant and plan"
+    admission = AdmissionController(max_in_flight=1, max_queue=0, tenant_rate=0.01, tenant_burst=1,
+                                    plan_rate=0.01, plan_burst=1)
+    admission.enter()
+    admission.check_rate("acme", "p1")
+    try:
+        admission.enter_turn("acme", "p1")
+        assert_true(False)
+    except AdmissionRejectedError as e:
+        assert_true(e.reason == 'queue')
+    admission.leave()
+    with admission.admit("acme", "p1"):
+        assert_true(admission.stats()["in_flight"] == 1)
+
+
+def test_turns_in_flight_are_bounded():
+    "Test turns over the in flight limit wait in a bounded queue, then are rejected"
+    admission = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5, retry_after=3)
+    admission.enter()
+    waiter = threading.Thread(target=admission.enter)
+    waiter.start()
+    time.sleep(0.05)
+    assert_true(admission.stats()["waiting"] == 1)
+    try:
+        admission.enter()
+        assert_true(False)
+    except AdmissionRejectedError as e:
+        assert_true(e.reason == 'queue' and e.retry_after == 3)
+    admission.leave()
+    waiter.join(5)
+    stats = admission.stats()
+    assert_true(stats["admitted"] == 2 and stats["in_flight"] == 1 and stats["waiting"] == 0)
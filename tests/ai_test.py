@@ -0,0 +1,357 @@
+"""Offline tests for the interviewer ai package.
+To run the tests type,
+$ python -m pytest tests/ai_test.py
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from nose.tools import assert_true
+from langchain.llms.fake import FakeListLLM
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+
+from ai import agents, clients, hedging, resilience, utilities  # noqa: E402
+from ai import coverage as coverage_util  # noqa: E402
+
+PLAN = {
+    "agent name": "Cojo",
+    "purpose": "testing",
+    "background": "an offline test",
+    "target_audience": "developers",
+    "questions": ["How do you test?", "Why do you test?"],
+}
+OUTPUT = '"action_type": "#NEXTQUESTION"\n"response": "Why do you test?"'
+
+
+def make_conversation(length):
+    return [{"messageId": "m%d" % i, "isAI": i % 2 == 0, "speaker": "Cojo" if i % 2 == 0 else "Bryan",
+             "message": "utterance %d" % i} for i in range(length)]
+
+
+def test_llm_clients_are_pooled():
+    "Test the same model settings share one client and http session"
+    first = clients.get_llm('gpt-3.5-turbo', 0.5)
+    assert_true(first is clients.get_llm('gpt-3.5-turbo', 0.5))
+    assert_true(first is not clients.get_llm('gpt-3.5-turbo', 0.2))
+    assert_true(first.max_retries == clients.LLM_MAX_RETRIES == 0)
+    assert_true(clients.get_http_session() is clients.get_http_session())
+
+
+def test_reset_drops_every_pooled_client():
+    "Test reset_clients drops the llm clients and both the requests and the aiohttp session"
+    llm, session = clients.get_llm('gpt-3.5-turbo', 0.5), clients.get_http_session()
+
+    async def reset():
+        aio_session = clients.get_aio_session()
+        clients.reset_clients(close=False)
+        assert_true(clients._aio_session is None)
+        renewed = clients.get_aio_session()
+        await aio_session.close()
+        await clients.close_aio_session()
+        return aio_session is not renewed
+
+    assert_true(asyncio.run(reset()))
+    assert_true(clients.get_llm('gpt-3.5-turbo', 0.5) is not llm and clients.get_http_session() is not session)
+
+
+def test_agent_is_reused_per_session():
+    "Test an agent is cached by session and plan"
+    agents.AGENT_CACHE.clear()
+    agent = agents.get_interview_agent("Cojo", PLAN, session_id="s1", plan_id="p1")
+    assert_true(agent is agents.get_interview_agent("Cojo", PLAN, session_id="s1", plan_id="p1"))
+    assert_true(agent is not agents.get_interview_agent("Cojo", PLAN, session_id="s2", plan_id="p1"))
+
+
+def test_generate_single_interview_response():
+    "Test a turn is generated with a cached agent"
+    agents.AGENT_CACHE.clear()
+    agent = agents.get_interview_agent("Cojo", PLAN, session_id="s1", plan_id="p1")
+    agent.model = FakeListLLM(responses=[OUTPUT, OUTPUT])
+    for _ in range(2):
+        response, completed = agents.generate_single_interview_response(
+            "Cojo", PLAN, make_conversation(3), session_id="s1", plan_id="p1")
+        assert_true(response == "Why do you test?")
+        assert_true(not completed)
+        assert_true(len(agent.message_history) == 3)
+
+
+def test_compiled_plan_is_shared():
+    "Test the static prompt prefix is rendered once per plan version"
+    agents.COMPILED_PLAN_CACHE.clear()
+    first = agents.InterviewAgent("Cojo", FakeListLLM(responses=[OUTPUT]), PLAN, plan_id="p1")
+    second = agents.InterviewAgent("Cojo", FakeListLLM(responses=[OUTPUT]), PLAN, plan_id="p1")
+    compiled = first.compile_plan()
+    assert_true(compiled is second.compile_plan())
+    assert_true(compiled.token_count > 0)
+    assert_true("Your name is Cojo" in compiled.prefix and "How do you test?" not in compiled.prefix)
+    changed = dict(PLAN, questions=["What changed?"])
+    assert_true(agents.InterviewAgent("Cojo", None, changed, plan_id="p1").compile_plan() is not compiled)
+
+
+def test_history_is_extended_incrementally():
+    "Test only new utterances are received and a broken id chain rebuilds"
+    agent = agents.InterviewAgent("Cojo", None, PLAN)
+    conversation = make_conversation(4)
+    agent.sync_conversation(conversation[:2])
+    agent.sync_conversation(conversation)
+    assert_true(agent.history == "\n".join(agent.message_history))
+    assert_true(len(agent.message_history) == 4)
+    edited = conversation[:3] + [dict(conversation[3], messageId="edited", message="edited")]
+    agent.sync_conversation(edited + make_conversation(5)[4:])
+    assert_true(len(agent.message_history) == 5)
+    assert_true(agent.message_history[3] == "Bryan: edited")
+    agent.sync_conversation(conversation[:2])
+    assert_true(agent.history == "Cojo: utterance 0\nBryan: utterance 1")
+
+
+def test_streaming_parser_releases_response_text():
+    "Test the response field is released token by token without its framing"
+    parser = utilities.StreamingResponseParser()
+    tokens = ['"action', '_type": "#NEXT', 'QUESTION"\n"resp', 'onse": "', 'Why ', 'do you', ' test?', '"']
+    streamed = "".join(parser.feed(token) for token in tokens)
+    assert_true(streamed == "Why do you test?")
+    assert_true(parser.result() == {"action_type": "#NEXTQUESTION", "response": "Why do you test?"})
+
+
+def test_send_forwards_tokens():
+    "Test a model without streaming support still reaches the token callback"
+    agent = agents.InterviewAgent("Cojo", FakeListLLM(responses=[OUTPUT]), PLAN)
+    tokens = []
+    response, _ = agent.send(on_token=tokens.append)
+    assert_true(tokens == [response])
+
+
+
+def test_slow_calls_are_hedged():
+    "Test a call slower than the recent ones is hedged and the first valid output wins"
+    hedger = hedging.Hedger(percentile=50, max_rate=0.5, min_samples=1)
+    hedger.latencies.observe(0.01)
+    calls = []
+
+    def complete():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return "slow"
+        return "fast"
+
+    # the hedge rate is capped, the first call alone cannot be hedged
+    assert_true(hedger.call(lambda: "no hedge", lambda output: None) == (None, "no hedge"))
+    assert_true(hedger.call(complete, lambda output: output) == ("fast", "fast"))
+    stats = hedger.stats()
+    assert_true(stats["calls"] == 2 and stats["hedges"] == 1 and stats["hedge_wins"] == 1)
+    agent = agents.InterviewAgent("Cojo", FakeListLLM(responses=[OUTPUT]), dict(PLAN, hedge=True))
+    assert_true(agent.send() == ("Why do you test?", False))
+
+
+class StuckLLM(FakeListLLM):
+    """Hangs for a second, or fails at the request_timeout it is called with, as the openai client does"""
+    timeouts: list = []
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        timeout = kwargs.get("request_timeout")
+        self.timeouts.append(timeout)
+        if timeout is not None and timeout < 1:
+            time.sleep(timeout)
+            raise TimeoutError("the request timed out")
+        time.sleep(1)
+        return super()._call(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+
+class FastLLM(FakeListLLM):
+    pass
+
+
+def test_stuck_model_times_out_then_falls_back():
+    "Test a turn stops at its deadline and the open circuit sends the next turns to the fallback model"
+    resilience.BREAKERS.clear()
+    resilience.BREAKERS["StuckLLM"] = resilience.CircuitBreaker(min_calls=1, open_seconds=60)
+    agent = agents.InterviewAgent("Cojo", StuckLLM(responses=[OUTPUT] * 3), PLAN)
+    started = time.monotonic()
+    try:
+        agent.send(deadline=resilience.Deadline(0.1))
+        assert_true(False)
+    except resilience.DeadlineExceededError:
+        pass
+    assert_true(time.monotonic() - started < 0.5 and 0 < agent.model.timeouts[0] <= 0.1)
+    try:
+        agent.send()
+        assert_true(False)
+    except resilience.CircuitOpenError:
+        pass
+    agent.fallback_model = FastLLM(responses=[OUTPUT])
+    assert_true(agent.send(deadline=resilience.Deadline(0.5)) == ("Why do you test?", False))
+    assert_true(resilience.BREAKERS["StuckLLM"].stats() == {"open": 1, "opened": 1, "rejected": 2})
+
+
+def test_llm_call_threads_are_capped():
+    "Test calls over the thread cap wait for a free thread, and a call abandoned while waiting never runs"
+    threads = resilience._DaemonThreads(max_threads=2)
+    release = threading.Event()
+    ran = []
+    blocked = [threads.submit(lambda: release.wait(2)) for _ in range(2)]
+    waiting = threads.submit(lambda: ran.append("waiting"))
+    abandoned = threads.submit(lambda: ran.append("abandoned"))
+    time.sleep(0.05)
+    assert_true(threads.stats() == {"threads": 2, "idle": 0, "waiting": 2} and not waiting.done())
+    assert_true(abandoned.cancel())
+    release.set()
+    assert_true(all(future.result(2) for future in blocked) and waiting.result(2) is None)
+    time.sleep(0.05)
+    assert_true(ran == ["waiting"] and threads.stats() == {"threads": 2, "idle": 2, "waiting": 0})
+
+
+def test_prompt_lists_only_the_remaining_questions():
+    "Test turns cover the plan questions, listed after the static prompt prefix, and only a completing turn completes"
+    plan = dict(PLAN, questions=["How do you test?", "Why do you test?", "Which tools do you use?"])
+    coverage = coverage_util.QuestionCoverage(plan["questions"])
+    agent = agents.InterviewAgent("Cojo", FakeListLLM(responses=[
+        '{"action_type": "#STARTING", "response": "Welcome! How do you test?"}',
+        '{"action_type": "#NEXTQUESTION", "response": "Which tools do you use for testing?"}',
+        '{"action_type": "#FOLLOWUPQUESTION", "response": "Why that one?"}',
+        '{"action_type": "#NEXTQUESTION", "response": "And what makes you test at all?"}',
+        '{"action_type": "#NEXTQUESTION", "response": "Anything else?"}',
+        '{"action_type": "#COMPLETING", "response": "Thank you, that was all."}',
+    ]), plan)
+    agent.coverage = coverage
+    assert_true(agent.send() == ("Welcome! How do you test?", False) and coverage.current == 0)
+    agent.send()
+    assert_true(coverage.to_dict() == {"coveredQuestions": [0], "currentQuestion": 2})
+    prefix = agent.compile_plan()
+    agent.send()
+    coverage_section = agent.render_coverage()
+    assert_true(agent.compile_plan() is prefix and agent.build_prompt().startswith(prefix.prefix + coverage_section))
+    assert_true("How do you test?" not in agent.build_prompt()
+                and "Which tools do you use? (the current question)" in coverage_section)
+    agent.send()
+    assert_true(coverage.to_dict() == {"coveredQuestions": [0, 2], "currentQuestion": 1})
+    assert_true(agent.send() == ("Anything else?", True) and coverage.complete())
+    assert_true("please complete the interview" in agent.render_coverage())
+    assert_true(agent.send() == ("Thank you, that was all.", True))
+    agent.coverage = None
+    assert_true(all(question in agent.render_coverage() for question in plan["questions"]))
+
+
+def test_parser_accepts_schema_and_salvages_near_misses():
+    "Test json and line outputs parse, near misses are repaired and garbage is rejected"
+    expected = {"action_type": "#NEXTQUESTION", "response": "Why do you test?"}
+    cases = [
+        ('{"action_type": "#NEXTQUESTION", "response": "Why do you test?"}', False),
+        (OUTPUT, False),
+        ('"action_type": "#NEXTQUESTION"\n\n"response": "Why do you test?"\n', False),
+        ('```json\n{"action_type": "#NEXTQUESTION", "response": "Why do you test?"}\n```', True),
+        ('Sure! {"action_type": "next_question", "response": "Why do you test?"}', True),
+        ('action type: NEXT QUESTION\nResponse: "Why do you test?"', True),
+    ]
+    for output, repaired in cases:
+        assert_true(utilities.parse_structured_output(output) == (expected, repaired))
+    multi_line = utilities.parsing_response('"action_type": "#COMPLETING"\n"response": "Thanks.\nBye."')
+    assert_true(multi_line == {"action_type": "#COMPLETING", "response": "Thanks.\nBye."})
+    assert_true(utilities.parsing_response("I am not sure what to ask.") is None)
+    assert_true(utilities.parsing_response('{"action_type": "#DANCING", "response": "?"}') is None)
+
+
+def test_parse_failures_are_counted_per_plan():
+    "Test retries and parse failures are recorded for the plan"
+    agent = agents.InterviewAgent("Cojo", FakeListLLM(responses=["no idea", OUTPUT]), PLAN, plan_id="stats")
+    assert_true(agent.send()[0] == "Why do you test?")
+    stats = agents.PARSE_STATS.to_dict()["stats"]
+    assert_true(stats == {"outputs": 2, "repairs": 0, "parse_failures": 1, "retries": 1})
+
+
+def test_history_is_windowed_with_a_rolling_summary():
+    "Test an over budget history keeps the recent turns verbatim and summarizes the rest"
+    plan = dict(PLAN, context_budget=20, verbatim_turns=2)
+    agent = agents.InterviewAgent("Cojo", FakeListLLM(responses=["They test a lot.", "They test even more."]), plan)
+    agent.sync_conversation(make_conversation(6))
+    assert_true(agent.needs_summary())
+    assert_true(agent.update_summary() == ("They test a lot.", 4))
+    assert_true(agent.render_history() ==
+                "Summary of the earlier dialogue: They test a lot.\nCojo: utterance 4\nBryan: utterance 5")
+    agent.sync_conversation(make_conversation(9))
+    assert_true(agent.update_summary() == ("They test even more.", 7))
+    assert_true(agent.build_prompt().endswith("Cojo: utterance 8\n        "))
+    short = agents.InterviewAgent("Cojo", None, PLAN)
+    short.sync_conversation(make_conversation(6))
+    assert_true(not short.needs_summary() and short.render_history() == short.history)
+
+
+def test_async_turns_wait_for_the_summary_of_their_agent():
+    "Test an asyncio turn does not use the agent while a summary job holds it, nor block the event loop"
+    agents.AGENT_CACHE.clear()
+    agent = agents.get_interview_agent("Cojo", PLAN, session_id="s-summary", plan_id="p")
+    agent.model = FakeListLLM(responses=[OUTPUT])
+    summarizing = threading.Event()
+
+    def summarize():
+        with agent.lock:
+            summarizing.set()
+            time.sleep(0.2)
+
+    threading.Thread(target=summarize).start()
+    summarizing.wait(1)
+
+    async def turn():
+        ticks = 0
+        generation = asyncio.ensure_future(agents.agenerate_single_interview_response(
+            "Cojo", PLAN, make_conversation(1), session_id="s-summary", plan_id="p"))
+        while not generation.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return generation.result(), ticks
+
+    (response, _), ticks = asyncio.run(turn())
+    assert_true(response == "Why do you test?" and ticks >= 10 and not agent.lock.locked())
+
+
+def test_a_stuck_summary_holds_no_turn_past_its_deadline():
+    "Test a summary call stops at the deadline of its plan, and the turns waiting for its agent at theirs"
+    agents.AGENT_CACHE.clear()
+    resilience.BREAKERS.clear()
+    plan = dict(PLAN, context_budget=20, verbatim_turns=2, deadline_seconds=0.3)
+    agent = agents.get_interview_agent("Cojo", plan, session_id="s-stuck", plan_id="p")
+    agent.model = StuckLLM(responses=["They test."])
+    agent.sync_conversation(make_conversation(6))
+    errors = []
+
+    def summarize():
+        try:
+            agents.update_session_summary("Cojo", plan, "s-stuck", plan_id="p")
+        except resilience.DeadlineExceededError as e:
+            errors.append(e)
+
+    summarizing = threading.Thread(target=summarize)
+    summarizing.start()
+    while not agent.lock.locked():
+        time.sleep(0.001)
+    for generate in (agents.generate_single_interview_response,
+                     lambda *args, **kwargs: asyncio.run(agents.agenerate_single_interview_response(*args, **kwargs))):
+        started = time.monotonic()
+        try:
+            generate("Cojo", plan, make_conversation(6), session_id="s-stuck", plan_id="p", deadline=0.1)
+            assert_true(False)
+        except resilience.DeadlineExceededError:
+            pass
+        assert_true(time.monotonic() - started < 0.25)
+    summarizing.join(1)
+    assert_true(len(errors) == 1 and agent.model.timeouts[0] <= 0.3 and not agent.lock.locked())
+
+
+def test_batch_simulator_writes_transcripts(tmp_path):
+    """Test simulated interviews are written as jsonl transcripts with per turn stats"""
+    from ai import simulators
+    import json
+    completing = '"action_type": "#COMPLETING"\n"response": "Thanks, bye."'
+    simulator = simulators.BatchSimulator("Cojo", PLAN, FakeListLLM(responses=[OUTPUT, completing] * 3),
+                                          FakeListLLM(responses=["I write tests."] * 3), concurrency=1,
+                                          plan_id="sim")
+    output_path = tmp_path / "transcripts.jsonl"
+    summaries = simulator.run([{"name": "Ann", "persona": "A tester."}, {"name": "Bob"}], str(output_path))
+    transcripts = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert_true(all(summary["completed"] for summary in summaries))
+    assert_true(len(transcripts) == 2 and all(len(t["turns"]) == 3 for t in transcripts))
+    assert_true(all(turn["latency"] >= 0 and turn["completion_tokens"] > 0 for turn in transcripts[0]["turns"]))
+    assert_true(transcripts[0]["turns"][0]["prompt_tokens"] > 0)
@@ -0,0 +1,22 @@
+"""Smoke tests of the offline benchmarks, so they keep running as the hot path changes.
+To run the tests type,
+$ python -m pytest tests/benchmark_test.py
+"""
+
+from nose.tools import assert_true
+
+from benchmarks import hot_path
+
+
+def test_benchmarks_run_offline():
+    """Test every benchmark runs once on the fake LLM and the in-memory store"""
+    results = hot_path.run_benchmarks(lengths=(10,), repeat=1, number=1)
+    assert_true(len(results) == len(hot_path.BENCHMARKS))
+    assert_true("POST /ask_quento@10" in results and "parsing_response[json]" in results)
+    assert_true(all(seconds > 0 for seconds in results.values()))
+
+
+def test_regressions_are_compared_to_baselines():
+    """Test a benchmark slower than its baseline by more than the tolerance is reported"""
+    baselines = {"a": 1.0, "b": 1.0}
+    assert_true(hot_path.compare({"a": 1.4, "b": 1.6, "c": 9.0}, baselines, tolerance=1.5) == ["b"])
@@ -0,0 +1,39 @@
+"""Tests of the concurrent bulk writer.
+To run the tests type,
+$ python -m pytest tests/bulk_test.py
+"""
+import threading
+
+from nose.tools import assert_true
+from google.api_core import exceptions
+
+from bulk_util import BulkWriter, summarize
+from storage_util import LocalConnection, MemoryEngine
+
+
+def test_batches_are_full_and_retried():
+    """Test batches hold exactly batch_size writes and transient failures are retried"""
+    committed, failed_once, lock = [], set(), threading.Lock()
+
+    def commit(batch):
+        with lock:
+            if batch[0][0] not in failed_once:
+                failed_once.add(batch[0][0])
+                raise exceptions.ServiceUnavailable("try again")
+            committed.append(len(batch))
+
+    writer = BulkWriter(commit, batch_size=10, workers=4, backoff=0.001)
+    results = writer.write(("doc%d" % i, {"i": i}) for i in range(35))
+    assert_true(sorted(committed) == [5, 10, 10, 10])
+    assert_true([result.doc_id for result in results] == ["doc%d" % i for i in range(35)])
+    assert_true(all(result.ok and result.attempts == 2 for result in results))
+
+
+def test_bad_documents_do_not_fail_their_batch():
+    """Test a permanent failure is reported for the document at fault only"""
+    db = LocalConnection(MemoryEngine(), base_collection='plans')
+    db.insert({"agent name": "Cojo"}, doc_id="p1")
+    results = db.bulk_insert([("p1", {"purpose": "a"}), ("p2", {"purpose": "b"})], mode='update')
+    summary = summarize(results)
+    assert_true(summary["written"] == 1 and summary["failures"][0]["doc_id"] == "p2")
+    assert_true(db.find_one("p1").to_dict() == {"agent name": "Cojo", "purpose": "a"})
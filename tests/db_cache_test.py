@@ -0,0 +1,198 @@
+"""Tests of the read-through cache of FirebaseConnection, on an in-memory stand-in of the firestore client.
+To run the tests type,
+$ python -m pytest tests/db_cache_test.py
+"""
+import time
+
+from nose.tools import assert_true
+
+import firebase_db_util
+from firebase_db_util import FirebaseConnection
+from storage_util import apply_write
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeDocument(object):
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[1]
+
+    def collection(self, name):
+        return FakeCollection(self.client, self.path + '/' + name)
+
+    def get(self):
+        self.client.reads.append(self.path)
+        return FakeSnapshot(self, self.client.docs.get(self.path))
+
+    def set(self, data, merge=False):
+        self.client.write(self.path, data, 'set', merge)
+
+    def update(self, data):
+        self.client.write(self.path, data, 'update', False)
+
+
+class FakeCollection(object):
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+
+    def document(self, doc_id):
+        return FakeDocument(self.client, self.path + '/' + doc_id)
+
+
+class FakeBatch(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append((ref.path, data, 'set'))
+
+    def update(self, ref, data):
+        self.writes.append((ref.path, data, 'update'))
+
+    def commit(self):
+        for path, data, mode in self.writes:
+            self.client.write(path, data, mode, False)
+
+
+class FakeClient(object):
+    """The part of the firestore client used by FirebaseConnection, {during_write} is called
+    before each write lands, as a read racing it would be"""
+
+    def __init__(self):
+        self.docs = {}
+        self.reads = []
+        self.during_write = None
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, refs):
+        self.reads.append([ref.path for ref in refs])
+        return [FakeSnapshot(ref, self.docs.get(ref.path)) for ref in refs]
+
+    def write(self, path, data, mode, merge):
+        if self.during_write is not None:
+            self.during_write()
+        self.docs[path] = apply_write(dict(self.docs.get(path) or {}), data, mode, merge)
+
+
+def make_connection(monkeypatch, cache_config):
+    client = FakeClient()
+    monkeypatch.setattr(firebase_db_util, 'firebase_init', lambda: None)
+    monkeypatch.setattr(firebase_db_util.firestore, 'client', lambda: client)
+    return FirebaseConnection(base_collection='plans', cache_config=cache_config), client
+
+
+def test_reads_are_cached_until_their_ttl(monkeypatch):
+    """Test a cached snapshot is served without a read, counted as a hit, and read again once expired"""
+    db, client = make_connection(monkeypatch, {'plans': {'ttl': 0.05}})
+    client.docs['plans/p1'] = {'version': 1}
+    db.find_one('p1')
+    db.find_one('p1')
+    assert_true(client.reads == ['plans/p1'])
+    assert_true(db.cache_stats()['plans'] == {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 1024})
+    time.sleep(0.1)
+    db.find_one('p1')
+    assert_true(len(client.reads) == 2 and db.cache_stats()['plans']['misses'] == 2)
+
+
+def test_missing_and_uncached_documents_are_not_kept(monkeypatch):
+    """Test a document that does not exist, or of a collection without a cache, is read every time"""
+    db, client = make_connection(monkeypatch, {'plans': {'ttl': 60}})
+    client.docs['interviews/s1'] = {}
+    for _ in range(2):
+        assert_true(not db.find_one('nope').exists)
+        db.find_one('s1', collection='interviews')
+    assert_true(len(client.reads) == 4 and db.cache_stats()['plans']['size'] == 0)
+
+
+def test_least_recently_used_reads_are_evicted(monkeypatch):
+    """Test a full cache evicts the snapshot read least recently"""
+    db, client = make_connection(monkeypatch, {'plans': {'ttl': 60, 'maxsize': 2}})
+    for plan_id in ('p1', 'p2', 'p3'):
+        client.docs['plans/' + plan_id] = {}
+    db.find_one('p1')
+    db.find_one('p2')
+    db.find_one('p1')
+    db.find_one('p3')
+    assert_true('p1' in db.caches['plans'] and 'p2' not in db.caches['plans'])
+    db.find_one('p2')
+    assert_true(client.reads == ['plans/p1', 'plans/p2', 'plans/p3', 'plans/p2'])
+
+
+def test_writes_invalidate_the_cached_snapshot(monkeypatch):
+    """Test insert, nesting_insert and bulk_insert drop the snapshot of the documents they write"""
+    db, client = make_connection(monkeypatch, {'plans': {'ttl': 60}, 'plans/p1/agents': {'ttl': 60}})
+    client.docs['plans/p1'] = {'version': 1}
+    client.docs['plans/p1/agents/a1'] = {'version': 1}
+    client.docs['plans/p2'] = {'version': 1}
+
+    db.find_one('p1')
+    db.insert({'version': 2}, doc_id='p1', mode='update')
+    assert_true(db.find_one('p1').to_dict() == {'version': 2})
+
+    db.find_one('a1', collection='plans/p1/agents')
+    db.nesting_insert([('document', 'p1'), ('collection', 'agents'), ('document', 'a1')], {'version': 2})
+    assert_true(db.find_one('a1', collection='plans/p1/agents').to_dict() == {'version': 2})
+
+    db.find_one('p2')
+    db.bulk_insert([('p2', {'version': 2})], workers=1)
+    assert_true(db.find_one('p2').to_dict() == {'version': 2})
+
+
+def test_a_read_racing_a_write_is_not_kept(monkeypatch):
+    """Test a snapshot cached while a write was in flight is dropped once the write landed"""
+    db, client = make_connection(monkeypatch, {'plans': {'ttl': 60}})
+    client.docs['plans/p1'] = {'version': 1}
+    client.docs['plans/p2'] = {'version': 1}
+    client.during_write = lambda: (db.find_one('p1'), db.find_one('p2'))
+    db.insert({'version': 2}, doc_id='p1')
+    assert_true(db.find_one('p1').to_dict() == {'version': 2})
+    db.bulk_insert([('p2', {'version': 2})], workers=1)
+    client.during_write = None
+    assert_true(db.find_one('p2').to_dict() == {'version': 2})
+
+
+def test_batched_reads_fetch_only_the_uncached_documents(monkeypatch):
+    """Test find_all serves cached snapshots, reads the others in one batch and caches them, in key order"""
+    db, client = make_connection(monkeypatch, {'plans': {'ttl': 60}})
+    client.docs.update({'plans/p1': {'n': 1}, 'plans/p2': {'n': 2}, 'interviews/s1': {'n': 3}})
+    db.find_one('p1')
+    snapshots = db.find_all([('s1', 'interviews'), ('p1', 'plans'), ('p2', 'plans'), ('p3', 'plans')])
+    assert_true([snapshot.to_dict() for snapshot in snapshots] == [{'n': 3}, {'n': 1}, {'n': 2}, None])
+    assert_true(client.reads == ['plans/p1', ['interviews/s1', 'plans/p2', 'plans/p3']])
+    assert_true('p2' in db.caches['plans'] and 'p3' not in db.caches['plans'])
+    db.find_all([('p1', 'plans'), ('p2', 'plans')])
+    assert_true(len(client.reads) == 2)
+
+
+def test_duplicate_keys_are_read_once(monkeypatch):
+    """Test a document asked for several times in find_all is read once and returned at each place"""
+    db, client = make_connection(monkeypatch, {'plans': {'ttl': 60}})
+    client.docs.update({'plans/p1': {'n': 1}, 'plans/p2': {'n': 2}})
+    snapshots = db.find_all([('p1', 'plans'), ('p1', 'plans')])
+    assert_true(client.reads == ['plans/p1'] and snapshots[0] is snapshots[1])
+    db.invalidate('p1', 'plans')
+    snapshots = db.find_all([('p1', 'plans'), ('p2', 'plans'), ('p1', 'plans')])
+    assert_true(client.reads[1] == ['plans/p1', 'plans/p2'])
+    assert_true([snapshot.to_dict()['n'] for snapshot in snapshots] == [1, 2, 1])
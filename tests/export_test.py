@@ -0,0 +1,74 @@
+"""Tests of the paged reads and the streaming export of interviews.
+To run the tests type,
+$ python -m pytest tests/export_test.py
+"""
+import json
+import os
+
+from nose.tools import assert_true
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import export_util  # noqa: E402
+from firebase_db_util import Firestore_order, iter_documents  # noqa: E402
+from storage_util import LocalConnection, MemoryEngine, SQLiteEngine  # noqa: E402
+
+
+def make_sessions(db, plan_id, count):
+    db.bulk_insert([("%s-%03d" % (plan_id, i), {"planId": plan_id, "completion": i % 2 == 0, "order": i,
+                                   "conversation": [{"message": "utterance %d" % j} for j in range(20)]})
+                    for i in range(count)], collection="interviews")
+
+
+def test_documents_are_read_page_by_page():
+    """Test every document is read once across pages, with and without prefetching and projections"""
+    for db in [LocalConnection(MemoryEngine()), LocalConnection(SQLiteEngine())]:
+        make_sessions(db, "p1", 25)
+        for prefetch in (True, False):
+            docs = list(iter_documents(db, collection="interviews", orders_by=[Firestore_order("order")],
+                                       select=["completion"], page_size=10, prefetch=prefetch))
+            assert_true([doc.id for doc in docs] == ["p1-%03d" % i for i in reversed(range(25))])
+            assert_true(docs[0].to_dict() == {"completion": True, "order": 24})
+
+
+def test_interviews_of_a_plan_are_exported_as_jsonl(tmp_path):
+    """Test the export only holds the sessions of the plan, projected on the requested fields"""
+    db = LocalConnection(MemoryEngine())
+    make_sessions(db, "p1", 7)
+    make_sessions(db, "p2", 3)
+    path = tmp_path / "p1.jsonl"
+    export_util.export_interviews(db, "p1", str(path), fields=["completion"], page_size=3)
+    rows = [json.loads(line) for line in path.read_text().splitlines()]
+    assert_true(len(rows) == 7 and rows[0] == {"id": "p1-000", "completion": True})
+
+
+def test_export_endpoint_streams_the_plan_interviews():
+    """Test GET /plans/<plan_id>/interviews/export streams jsonl and rejects unknown formats"""
+    import main
+    from routes import ai_api
+    make_sessions(ai_api.db_connection, "exported", 4)
+    client = main.app.test_client()
+    response = client.get('/plans/exported/interviews/export?fields=conversation&page_size=2')
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert_true(response.status_code == 200 and len(rows) == 4 and len(rows[0]["conversation"]) == 20)
+    assert_true(client.get('/plans/exported/interviews/export?format=csv').status_code == 400)
+
+
+def test_export_endpoint_checks_the_page_size_before_streaming(monkeypatch):
+    """Test a page size below 1 is rejected with a 400 and a larger one than the maximum is capped"""
+    import main
+    from routes import ai_api, export_api
+    make_sessions(ai_api.db_connection, "paged", 5)
+    monkeypatch.setattr(export_api, "EXPORT_MAX_PAGE_SIZE", 2)
+    pages = []
+    read_page = ai_api.db_connection.find_many
+    monkeypatch.setattr(ai_api.db_connection.connect(), "find_many",
+                        lambda *args, **kwargs: pages.append(kwargs["limit"]) or read_page(*args, **kwargs))
+    client = main.app.test_client()
+    for page_size in (0, -1):
+        response = client.get('/plans/paged/interviews/export?page_size=%d' % page_size)
+        assert_true(response.status_code == 400 and "page_size" in response.get_json()["response"])
+    response = client.get('/plans/paged/interviews/export?page_size=1000')
+    assert_true(response.status_code == 200 and len(response.get_data(as_text=True).splitlines()) == 5)
+    assert_true(set(pages) == {2})
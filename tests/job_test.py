@@ -0,0 +1,67 @@
+"""Tests for the background job queue.
+To run the tests type,
+$ python -m pytest tests/job_test.py
+"""
+import threading
+import time
+
+from nose.tools import assert_true
+
+from job_util import InFlight, LocalJobQueue, QueueFullError, SUCCEEDED, FAILED
+
+
+def fail():
+    raise ValueError("boom")
+
+
+def test_jobs_run_on_workers():
+    "Test submitted jobs run and keep their result"
+    jobs = LocalJobQueue(workers=2, max_depth=10)
+    ok, failed = jobs.submit(lambda x: x * 2, 21), jobs.submit(fail)
+    assert_true(ok.done.wait(5) and failed.done.wait(5))
+    assert_true(jobs.get(ok.id).status == SUCCEEDED and ok.result == 42)
+    assert_true(failed.status == FAILED and failed.error == "boom")
+    jobs.shutdown()
+
+
+def test_queue_depth_is_bounded():
+    "Test a full queue rejects new jobs"
+    jobs = LocalJobQueue(workers=0, max_depth=1)
+    jobs.submit(lambda: None)
+    try:
+        jobs.submit(lambda: None)
+        assert_true(False)
+    except QueueFullError:
+        pass
+    assert_true(jobs.depth() == 1)
+
+
+def test_shutdown_times_out_on_a_busy_worker():
+    "Test shutdown reports workers still running after its timeout, and reset forgets them"
+    release = threading.Event()
+    jobs = LocalJobQueue(workers=1, max_depth=10)
+    job = jobs.submit(release.wait, 5)
+    assert_true(not jobs.shutdown(timeout=0.1))
+    release.set()
+    assert_true(job.done.wait(5))
+    jobs.reset()
+    assert_true(jobs.submit(lambda: 1).done.wait(5))
+    assert_true(jobs.shutdown(timeout=5))
+
+
+def test_in_flight_waits_for_calls():
+    "Test in flight calls are counted and waited for"
+    in_flight = InFlight()
+    release = threading.Event()
+
+    def call():
+        with in_flight:
+            release.wait(5)
+
+    thread = threading.Thread(target=call)
+    thread.start()
+    time.sleep(0.05)
+    assert_true(in_flight.count() == 1 and not in_flight.wait(0.05))
+    release.set()
+    assert_true(in_flight.wait(5) and in_flight.count() == 0)
+    thread.join()
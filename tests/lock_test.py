@@ -0,0 +1,84 @@
+"""Tests for single-flight execution.
+To run the tests type,
+$ python -m pytest tests/lock_test.py
+"""
+
+import asyncio
+import threading
+import time
+
+from nose.tools import assert_true
+
+from lock_util import AsyncSingleFlight, SingleFlight, SingleFlightError, LocalLockBackend
+
+
+def test_concurrent_calls_share_one_result():
+    "Test concurrent callers of one key run the function once"
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"response": "shared"}
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do("s1-m1", slow))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_true(len(calls) == 1)
+    assert_true(all(result == {"response": "shared"} for result, _ in results))
+    assert_true(sorted(shared for _, shared in results) == [False, True, True, True, True])
+
+
+def test_leased_key_waits_for_published_result():
+    "Test a key leased by another process waits for the result it publishes"
+    backend = LocalLockBackend()
+    backend.acquire("s1-m1", "elsewhere", 60)
+    flight = SingleFlight(backend, wait_timeout=2, poll_interval=0.01)
+    threading.Timer(0.1, lambda: backend.release("s1-m1", "elsewhere", {"response": "remote"})).start()
+    assert_true(flight.do("s1-m1", lambda: {"response": "local"}) == ({"response": "remote"}, True))
+
+    backend.acquire("s1-m2", "elsewhere", 60)
+    try:
+        SingleFlight(backend, wait_timeout=0.05, poll_interval=0.01).do("s1-m2", lambda: None)
+        assert_true(False)
+    except SingleFlightError:
+        pass
+
+
+def test_a_late_caller_shares_the_kept_result():
+    "Test a caller arriving once the call finished gets its kept result, and a failed call can run again"
+    flight = SingleFlight(LocalLockBackend(), wait_timeout=2, poll_interval=0.01)
+    assert_true(flight.do("s1-m1", lambda: {"response": "first"}) == ({"response": "first"}, False))
+    assert_true(flight.do("s1-m1", lambda: {"response": "second"}) == ({"response": "first"}, True))
+    try:
+        flight.do("s1-m2", lambda: 1 / 0)
+        assert_true(False)
+    except ZeroDivisionError:
+        pass
+    assert_true(flight.do("s1-m2", lambda: {"response": "retried"}) == ({"response": "retried"}, False))
+
+
+def test_concurrent_coroutines_share_one_result():
+    "Test coroutines of one key await a single call, and a key leased elsewhere waits for its result"
+    backend = LocalLockBackend()
+    flight = AsyncSingleFlight(backend, wait_timeout=2, poll_interval=0.01)
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return {"response": "shared"}
+
+    async def run():
+        results = await asyncio.gather(*[flight.do("s1-m1", slow) for _ in range(3)])
+        backend.acquire("s1-m2", "elsewhere", 60)
+        threading.Timer(0.1, lambda: backend.release("s1-m2", "elsewhere", {"response": "remote"})).start()
+        return results, await flight.do("s1-m2", slow)
+
+    results, remote = asyncio.run(run())
+    assert_true(len(calls) == 1 and [shared for _, shared in results] == [False, True, True])
+    assert_true(remote == ({"response": "remote"}, True))
@@ -0,0 +1,38 @@
+"""Tests for the interview pipeline metrics.
+To run the tests type,
+$ python -m pytest tests/metrics_test.py
+"""
+
+from nose.tools import assert_true
+
+import metrics_util
+from metrics_util import Registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    "Test a timed stage renders as a prometheus histogram"
+    registry = Registry()
+    histogram = registry.histogram('stage_seconds', 'Seconds per stage.', buckets=(0.1, 1))
+    histogram.observe(0.05, stage='llm')
+    histogram.observe(0.5, stage='llm')
+    with histogram.time(stage='prompt'):
+        pass
+    text = registry.render()
+    assert_true('stage_seconds_bucket{stage="llm",le="0.1"} 1' in text)
+    assert_true('stage_seconds_bucket{stage="llm",le="1"} 2' in text)
+    assert_true('stage_seconds_count{stage="llm"} 2' in text)
+    assert_true('stage_seconds_count{stage="prompt"} 1' in text)
+
+
+def test_disabled_metrics_record_nothing():
+    "Test disabled instrumentation is a no-op"
+    registry = Registry()
+    counter = registry.counter('retries_total', 'Retries.')
+    metrics_util.METRICS_ENABLED = False
+    try:
+        counter.inc()
+        with registry.histogram('stage_seconds', 'Seconds per stage.').time(stage='llm'):
+            pass
+    finally:
+        metrics_util.METRICS_ENABLED = True
+    assert_true(registry.render().count('\n') == 4)
@@ -0,0 +1,285 @@
+"""Tests of the interviewer endpoints, offline on the memory storage backend.
+To run the tests type,
+$ python -m pytest tests/routes_test.py
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Any, List, Optional
+
+from langchain.llms.base import LLM
+from langchain.llms.fake import FakeListLLM
+from nose.tools import assert_true
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import main  # noqa: E402
+from admission_util import LocalBucketBackend  # noqa: E402
+from job_util import LocalJobQueue  # noqa: E402
+from ai import agents, clients  # noqa: E402
+from routes import ai_api, ai_api_async  # noqa: E402
+
+PLAN = {
+    "agent name": "Cojo",
+    "purpose": "testing",
+    "background": "an offline test",
+    "target_audience": "developers",
+    "questions": ["How do you test?", "Why do you test?"],
+}
+OUTPUT = '{"action_type": "#FOLLOWUPQUESTION", "response": "Could you tell me more?"}'
+OPENINGS = ["Welcome! How do you test?", "Hello, how do you test your code?"]
+
+
+class SlowLLM(LLM):
+    """Answers every prompt with the same follow up question after {delay} seconds, counting its calls"""
+    delay: float = 0.1
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow-interview"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        self.calls += 1
+        return OUTPUT
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None,
+                     **kwargs: Any) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return OUTPUT
+
+
+def make_conversation(length):
+    """A transcript of {length} utterances ending on the interviewer"""
+    return [{"messageId": "m%d" % i, "isAI": (length - i) % 2 == 1, "speaker": "Cojo" if (length - i) % 2 == 1
+             else "Bryan", "message": "utterance %d" % i} for i in range(length)]
+
+
+def make_session(session_id, plan_id, length=1, plan=None, **fields):
+    ai_api.db_connection.insert(dict(plan or PLAN), collection="plans", doc_id=plan_id)
+    ai_api.db_connection.insert(dict(fields, planId=plan_id, completion=False, conversation=make_conversation(length)),
+                                collection="interviews", doc_id=session_id)
+
+
+def with_openings(plan, messages=OPENINGS):
+    """@return: {plan} with an up to date pool of opening {messages}"""
+    return dict(plan, openings={"version": agents.get_plan_version(plan), "agentName": plan["agent name"],
+                                "messages": messages})
+
+
+def opening_llm(messages):
+    """@return: a stand in of agents.get_llm whose model opens the interview with each of {messages}"""
+    outputs = [json.dumps({"action_type": "#STARTING", "response": message}) for message in messages]
+    return lambda **kwargs: FakeListLLM(responses=outputs)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert_true(time.monotonic() < deadline)
+        time.sleep(0.01)
+
+
+def use_agent(session_id, plan_id, llm):
+    agents.AGENT_CACHE.put((session_id, plan_id), agents.InterviewAgent("Cojo", llm, PLAN, plan_id=plan_id))
+
+
+async def asgi_post(app, path, payload):
+    """POST {payload} to the asgi {app}
+    @return: the status and the headers of the response
+    """
+    body = json.dumps(payload).encode()
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        sent.append(message)
+
+    await app({'type': 'http', 'method': 'POST', 'path': path}, receive, send)
+    return sent[0]['status'], dict(sent[0]['headers'])
+
+
+async def asgi_post_once(app, path, payload):
+    """POST {payload} to the asgi {app} on a loop of its own, closing the aiohttp session of the loop"""
+    try:
+        return await asgi_post(app, path, payload)
+    finally:
+        await clients.close_aio_session()
+
+
+def test_a_turn_takes_the_plan_of_its_session():
+    """Test the plan_id of a turn request is only a hint, the plan of the session is the one loaded"""
+    make_session("plan-hint", "hinted")
+    make_session("other", "other", plan=dict(PLAN, **{"agent name": "Otto"}))
+    for plan_id in ("hinted", "other", "missing", None):
+        turn, error = ai_api.load_interview_turn({"session_id": "plan-hint", "plan_id": plan_id})
+        assert_true(error is None and turn["plan_id"] == "hinted" and turn["agent_name"] == "Cojo")
+    turn, error = ai_api.load_interview_turn({"session_id": "missing", "plan_id": "hinted"})
+    assert_true(turn is None and error == ("session does not exist.", 400))
+
+
+def test_utterances_are_appended_with_their_coverage():
+    """Test an utterance is appended to the session together with the question coverage it leads to"""
+    make_session("appended", "appended", length=3)
+    turn, _ = ai_api.load_interview_turn({"session_id": "appended"})
+    turn["coverage"].update("#STARTING", "How do you test?")
+    turn["coverage"].update("#NEXTQUESTION", "Why do you test?")
+    stored = ai_api.store_agent_utterance(turn, "Why do you test?")
+    session = ai_api.db_connection.find_one("appended").to_dict()
+    assert_true(session["conversation"][:3] == make_conversation(3) and session["conversation"][3] == stored)
+    assert_true(session["currentQuestion"] == 1 and session["coveredQuestions"] == [0])
+    assert_true(session["completion"] is False)
+
+
+def test_legacy_sessions_are_rewritten_without_placeholders():
+    """Test the first utterance of a session holding empty placeholders rewrites its conversation without them"""
+    make_session("legacy", "legacy")
+    ai_api.db_connection.insert({"conversation": ["", ""] + make_conversation(3)}, collection="interviews",
+                                doc_id="legacy", mode='update')
+    turn, _ = ai_api.load_interview_turn({"session_id": "legacy"})
+    stored = ai_api.store_agent_utterance(turn, "Thank you, that was all.", completed=True)
+    session = ai_api.db_connection.find_one("legacy").to_dict()
+    assert_true(session["conversation"] == make_conversation(3) + [stored])
+    assert_true(session["completion"] is True and "currentQuestion" in session)
+
+
+def test_concurrent_async_requests_of_a_turn_share_one_response():
+    """Test two simultaneous posts of the same turn to the asgi app generate and store a single utterance"""
+    make_session("async-twice", "async-twice", length=3)
+    llm = SlowLLM()
+    use_agent("async-twice", "async-twice", llm)
+    app = ai_api_async.AsyncAIApp(fallback=None)
+    payload = {"session_id": "async-twice", "plan_id": "async-twice"}
+
+    async def post_twice():
+        try:
+            return await asyncio.gather(asgi_post(app, '/ask_quento', payload), asgi_post(app, '/ask_quento', payload))
+        finally:
+            await clients.close_aio_session()
+
+    responses = asyncio.run(post_twice())
+    assert_true([status for status, _ in responses] == [201, 201] and llm.calls == 1)
+    conversation = ai_api.db_connection.find_one("async-twice").to_dict()["conversation"]
+    assert_true(len(conversation) == 4 and conversation[-1]["message"] == "Could you tell me more?")
+
+
+def test_opening_pool_follows_the_plan_version_and_agent():
+    """Test a pool of openings is served only for the plan version and the agent it was generated for"""
+    plan = with_openings(PLAN)
+    assert_true(ai_api.get_opening_pool(plan) == OPENINGS)
+    assert_true(ai_api.get_opening_pool(dict(plan, purpose="changed")) == [])
+    assert_true(ai_api.get_opening_pool(dict(plan, version=2)) == [])
+    assert_true(ai_api.get_opening_pool(dict(plan, **{"agent name": "Otto"})) == [])
+    assert_true(ai_api.get_opening_pool(PLAN) == [])
+
+
+def test_openings_are_served_from_the_pool_without_the_llm():
+    """Test a session that has not started gets a pooled opening, and the question it asks becomes current"""
+    make_session("pooled", "pooled", length=0, plan=with_openings(PLAN))
+    llm = SlowLLM()
+    use_agent("pooled", "pooled", llm)
+    response = main.app.test_client().post('/ask_quento', json={"session_id": "pooled", "plan_id": "pooled"})
+    session = ai_api.db_connection.find_one("pooled").to_dict()
+    assert_true(response.status_code == 201 and llm.calls == 0)
+    assert_true(len(session["conversation"]) == 1 and session["conversation"][0]["message"] in OPENINGS)
+    assert_true(session["currentQuestion"] == 0 and session["coveredQuestions"] == [])
+
+
+def test_openings_are_precomputed_on_the_first_opening(monkeypatch):
+    """Test an opening without a pool is generated by the agent, and queues the pool of the plan"""
+    monkeypatch.setattr(agents, "get_llm", opening_llm(OPENINGS))
+    make_session("unpooled", "unpooled", length=0, plan=dict(PLAN, opening_pool_size=2))
+    llm = SlowLLM()
+    use_agent("unpooled", "unpooled", llm)
+    response = main.app.test_client().post('/ask_quento', json={"session_id": "unpooled", "plan_id": "unpooled"})
+    assert_true(response.status_code == 201 and llm.calls == 1)
+    wait_for(lambda: ai_api.get_opening_pool(ai_api.db_connection.find_one("unpooled", "plans").to_dict()))
+    assert_true(ai_api.db_connection.find_one("unpooled", "plans").to_dict()["openings"]["messages"] == OPENINGS)
+
+
+def test_openings_endpoint_regenerates_the_pool(monkeypatch):
+    """Test POST /plans/<plan_id>/openings replaces an up to date pool, and its job reports the pool size"""
+    monkeypatch.setattr(agents, "get_llm", opening_llm(["Good morning, how do you test?"] * 2))
+    make_session("regenerated", "regenerated", length=0, plan=with_openings(dict(PLAN, opening_pool_size=2)))
+    client = main.app.test_client()
+    response = client.post('/plans/regenerated/openings')
+    assert_true(response.status_code == 202)
+    job_url = '/jobs/{}'.format(response.get_json()["job_id"])
+    wait_for(lambda: client.get(job_url).get_json()["status"] == "succeeded")
+    assert_true(client.get(job_url).get_json()["result"] == 1)
+    plan = ai_api.db_connection.find_one("regenerated", "plans").to_dict()
+    assert_true(ai_api.get_opening_pool(plan) == ["Good morning, how do you test?"])
+
+
+def test_jobs_are_found_from_any_worker(monkeypatch):
+    """Test the status of a job is stored, so a worker that did not run the job can answer a poll of it"""
+    monkeypatch.setattr(agents, "get_llm", opening_llm(["Good evening, how do you test?"]))
+    make_session("polled", "polled", length=0, plan=dict(PLAN, opening_pool_size=1))
+    client = main.app.test_client()
+    job_id = client.post('/plans/polled/openings').get_json()["job_id"]
+    wait_for(lambda: ai_api.db_connection.find_one(job_id, "jobs").to_dict()["status"] == "succeeded")
+    monkeypatch.setattr(ai_api, "job_queue", LocalJobQueue())
+    job = client.get('/jobs/{}'.format(job_id)).get_json()
+    assert_true(job["id"] == job_id and job["status"] == "succeeded" and job["result"] == 1)
+    assert_true(client.get('/jobs/missing').status_code == 404)
+
+
+def test_a_completing_turn_completes_the_session():
+    """Test the completing turn marks the session completed on both serving modes, and it takes no more turns"""
+    completing = '{"action_type": "#COMPLETING", "response": "Thank you, that was all."}'
+    app = ai_api_async.AsyncAIApp(fallback=None)
+    for session_id in ("completed-sync", "completed-async"):
+        make_session(session_id, session_id, length=3)
+        use_agent(session_id, session_id, FakeListLLM(responses=[completing]))
+        payload = {"session_id": session_id, "plan_id": session_id}
+        if session_id == "completed-sync":
+            status = main.app.test_client().post('/ask_quento', json=payload).status_code
+        else:
+            status = asyncio.run(asgi_post_once(app, '/ask_quento', payload))[0]
+        session = ai_api.db_connection.find_one(session_id).to_dict()
+        assert_true(status == 201 and session["completion"] is True)
+        assert_true(session["conversation"][-1]["message"] == "Thank you, that was all.")
+        response = main.app.test_client().post('/ask_quento', json=payload)
+        assert_true(response.status_code == 400 and response.get_json()["response"] == "session has been completed.")
+
+
+def test_turns_over_the_rate_of_their_tenant_are_rejected(monkeypatch):
+    """Test a tenant over its rate gets a 429 with a Retry-After on both serving modes, whatever headers it sends"""
+    monkeypatch.setattr(ai_api.admission, "backend", LocalBucketBackend())
+    monkeypatch.setattr(ai_api.admission, "limits", {'tenant': (0.5, 1), 'plan': (0, 0)})
+    for session_id in ("limited", "over-limit"):
+        make_session(session_id, session_id, length=3, tenantId="acme")
+        use_agent(session_id, session_id, FakeListLLM(responses=[OUTPUT]))
+    client = main.app.test_client()
+    assert_true(client.post('/ask_quento', json={"session_id": "limited"}).status_code == 201)
+
+    payload = {"session_id": "over-limit"}
+    response = client.post('/ask_quento', json=payload, headers={"X-Tenant-Id": "someone-else"})
+    assert_true(response.status_code == 429 and response.headers["Retry-After"] == "2")
+    assert_true("tenant acme" in response.get_json()["response"])
+    status, headers = asyncio.run(asgi_post(ai_api_async.AsyncAIApp(fallback=None), '/ask_quento', payload))
+    assert_true(status == 429 and headers[b"retry-after"] == b"2")
+    assert_true(ai_api.admission.stats()["rejected_tenant"] >= 2)
+
+
+def test_queued_turns_take_a_slot(monkeypatch):
+    """Test a turn generated in the background waits for a slot, and gives back its tokens when none is free"""
+    monkeypatch.setattr(ai_api.admission, "backend", LocalBucketBackend())
+    monkeypatch.setattr(ai_api.admission, "limits", {'tenant': (0, 0), 'plan': (0.01, 1)})
+    monkeypatch.setattr(ai_api.admission, "max_in_flight", 0)
+    monkeypatch.setattr(ai_api.admission, "max_queue", 0)
+    make_session("queued", "queued", length=3)
+    use_agent("queued", "queued", FakeListLLM(responses=[OUTPUT]))
+    client = main.app.test_client()
+    response = client.post('/ask_quento', json={"session_id": "queued", "background": True})
+    job_url = '/jobs/{}'.format(response.get_json()["job_id"])
+    wait_for(lambda: client.get(job_url).get_json()["status"] == "failed")
+    assert_true("too many responses are being generated" in client.get(job_url).get_json()["error"])
+    monkeypatch.setattr(ai_api.admission, "max_in_flight", 1)
+    response = client.post('/ask_quento', json={"session_id": "queued"})
+    assert_true(response.status_code == 201 and ai_api.admission.stats()["in_flight"] == 0)
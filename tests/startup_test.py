@@ -0,0 +1,72 @@
+"""Tests of the worker startup, which must not create any client.
+To run the tests type,
+$ python -m pytest tests/startup_test.py
+"""
+import json
+import os
+import subprocess
+import sys
+
+from nose.tools import assert_true
+
+DIR_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_CHECK = """
+import json, sys
+import main
+import firebase_admin
+print(json.dumps({"seconds": main.IMPORT_SECONDS, "budget": main.IMPORT_TIME_BUDGET,
+                  "modules": [m for m in ("langchain", "openai") if m in sys.modules],
+                  "firebase_apps": len(firebase_admin._apps)}))
+"""
+
+SCRAPE_CHECK = """
+import json, sys
+import main
+import firebase_admin
+from routes import ai_api
+response = main.app.test_client().get('/metrics')
+print(json.dumps({"status": response.status_code, "connected": ai_api.db_connection.connected,
+                  "modules": [m for m in ("langchain", "openai", "ai.agents") if m in sys.modules],
+                  "firebase_apps": len(firebase_admin._apps)}))
+"""
+
+
+def test_import_is_within_budget_and_creates_no_client():
+    """Test importing the app needs neither key.json nor OPENAI_API_KEY and stays within its budget"""
+    env = {k: v for k, v in os.environ.items() if k not in ('OPENAI_API_KEY', 'STORAGE_BACKEND')}
+    output = subprocess.run([sys.executable, '-c', IMPORT_CHECK], cwd=DIR_PATH, env=env, capture_output=True,
+                            text=True, check=True).stdout
+    startup = json.loads(output.strip().splitlines()[-1])
+    assert_true(startup["modules"] == [] and startup["firebase_apps"] == 0)
+    assert_true(startup["seconds"] < startup["budget"])
+
+
+def test_metrics_scrape_creates_no_client():
+    """Test GET /metrics of an idle worker without key.json neither connects to the db nor imports langchain"""
+    env = {k: v for k, v in os.environ.items() if k not in ('OPENAI_API_KEY', 'STORAGE_BACKEND')}
+    output = subprocess.run([sys.executable, '-c', SCRAPE_CHECK], cwd=DIR_PATH, env=env, capture_output=True,
+                            text=True, check=True).stdout
+    scrape = json.loads(output.strip().splitlines()[-1])
+    assert_true(scrape == {"status": 200, "connected": False, "modules": [], "firebase_apps": 0})
+
+
+def test_firestore_backends_need_firestore_storage():
+    """Test the app refuses to start with a firestore lock or bucket backend on a local storage backend"""
+    for backend_name in ('SINGLE_FLIGHT_BACKEND', 'ADMISSION_BACKEND'):
+        env = dict(os.environ, STORAGE_BACKEND='memory', **{backend_name: 'firestore'})
+        started = subprocess.run([sys.executable, '-c', 'import main'], cwd=DIR_PATH, env=env, capture_output=True,
+                                 text=True)
+        assert_true(started.returncode != 0 and "{}=firestore needs STORAGE_BACKEND=firestore".format(backend_name)
+                    in started.stderr)
+
+
+def test_ready_warms_the_clients():
+    """Test GET /ready connects to the db and creates the LLM client"""
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+    os.environ.setdefault('STORAGE_BACKEND', 'memory')
+    import main
+    from ai import clients
+    from routes import ai_api
+    response = main.app.test_client().get('/ready')
+    assert_true(response.status_code == 200 and response.get_json()["ready"])
+    assert_true(ai_api.db_connection.connected and len(clients._llm_pool) > 0)
@@ -0,0 +1,81 @@
+"""Tests of the local storage engines, on both the memory and the sqlite engine.
+To run the tests type,
+$ python -m pytest tests/storage_test.py
+"""
+from datetime import datetime, timezone
+
+from nose.tools import assert_true
+
+from firebase_db_util import Firestore_query, Firestore_order, migrate_conversations
+from storage_util import LocalConnection, MemoryEngine, SQLiteEngine
+
+ANIMALS = [('monkey', {'weight': 50, 'name': 'John', 'tags': ['tree', 'loud']}),
+           ('cat', {'weight': 10, 'name': 'Cathy', 'tags': ['indoor']}),
+           ('dog', {'weight': 30, 'name': 'Rex', 'tags': ['loud', 'indoor']}),
+           ('fish', {'weight': 1, 'name': 'Nemo'}),
+           ('rock', {'name': 'Pet Rock'})]
+
+
+def make_connections():
+    return [LocalConnection(MemoryEngine(), base_collection='animals'),
+            LocalConnection(SQLiteEngine(), base_collection='animals')]
+
+
+def ids(snapshots):
+    return [snapshot.id for snapshot in snapshots]
+
+
+def test_writes_follow_firestore_modes():
+    """Test set, merge, update and array unions on both engines"""
+    when = datetime(2023, 7, 1, 9, 30, tzinfo=timezone.utc)
+    for db in make_connections():
+        db.insert({'conversation': [], 'meta': {'a': 1}, 'time': when}, doc_id='s1')
+        db.append('s1', 'conversation', [{'message': 'hi'}], data={'completion': False})
+        db.append('s1', 'conversation', [{'message': 'hi'}, {'message': 'bye'}])
+        db.insert({'meta': {'b': 2}}, doc_id='s1', merge=True)
+        db.insert({'meta.c': 3}, doc_id='s1', mode='update')
+        db.insert({'meta': 1}, doc_id='missing', mode='update')
+        session = db.find_one('s1').to_dict()
+        assert_true(session['conversation'] == [{'message': 'hi'}, {'message': 'bye'}])
+        assert_true(session['meta'] == {'a': 1, 'b': 2, 'c': 3} and session['completion'] is False)
+        assert_true(session['time'] == when)
+        assert_true(not db.find_one('missing').exists and db.find_one('missing')._data is None)
+
+
+def test_queries_follow_firestore_semantics():
+    """Test filters, orders, cursors and limits give the same documents on both engines"""
+    for db in make_connections():
+        db.bulk_insert(ANIMALS)
+        by_weight = [Firestore_order('weight', desc=False)]
+        assert_true(ids(db.find_many(orders_by=by_weight)) == ['fish', 'cat', 'dog', 'monkey'])
+        assert_true(ids(db.find_many(query=[Firestore_query('weight', '>=', 30)])) == ['dog', 'monkey'])
+        assert_true(ids(db.find_many(query=[Firestore_query('name', '>', 10)])) == [])
+        assert_true(ids(db.find_many(query=[Firestore_query('tags', 'array-contains', 'loud')])) == ['dog', 'monkey'])
+        assert_true(ids(db.find_many(query=[Firestore_query('tags', 'array-contains-any', ['tree', 'indoor'])]))
+                    == ['cat', 'dog', 'monkey'])
+        assert_true(ids(db.find_many(query=[Firestore_query('name', 'in', ['Rex', 'Nemo'])])) == ['dog', 'fish'])
+        first = list(db.find_many(orders_by=[Firestore_order('weight')], limit=2))
+        assert_true(ids(first) == ['monkey', 'dog'])
+        assert_true(ids(db.find_many(orders_by=[Firestore_order('weight')], start_after=first[-1])) == ['cat', 'fish'])
+        assert_true(ids(db.find_many(orders_by=by_weight, start_after={'weight': 10})) == ['dog', 'monkey'])
+        assert_true(ids(db.find_many(start_after=first[0], limit=1)) == ['rock'])
+
+
+def test_nesting_insert_writes_sub_collections():
+    """Test nesting_insert writes documents of sub collections, apart from their parents"""
+    for db in make_connections():
+        db.nesting_insert([('document', 'zoo'), ('collection', 'keepers'), ('document', 'ann')], {'name': 'Ann'})
+        assert_true(db.find_one('ann', 'animals/zoo/keepers').to_dict() == {'name': 'Ann'})
+        assert_true(not db.find_one('ann').exists)
+
+
+def test_conversations_are_migrated_without_placeholders():
+    """Test migrate_conversations strips the empty placeholders and counts the sessions it changed"""
+    for db in make_connections():
+        db.insert({'conversation': ['', {'message': 'hi'}, '']}, collection='interviews', doc_id='legacy')
+        db.insert({'conversation': [{'message': 'hi'}]}, collection='interviews', doc_id='clean')
+        db.insert({'completion': False}, collection='interviews', doc_id='empty')
+        assert_true(migrate_conversations(db) == 1)
+        assert_true(db.find_one('legacy', 'interviews').to_dict()['conversation'] == [{'message': 'hi'}])
+        assert_true(db.find_one('clean', 'interviews').to_dict()['conversation'] == [{'message': 'hi'}])
+        assert_true(migrate_conversations(db) == 0)